@@ -0,0 +1,315 @@
+'''
+Train the vanilla seq2seq of debug/vanilla.py and lite-seq2seq under the same data, time budget and threads.
+
+Every system trains for the same wall-clock budget on the same training pairs, the training time
+excludes evaluation. The whole validation set is evaluated at fixed intervals of training time,
+so the result is a curve of validation loss and bleu against training seconds. Besides, training
+examples/sec, single sentence latency and batched inference throughput are measured.
+
+Lite ablations tell what its features cost:
+    lite             the default model, bucketed batches, beam search of {beam_width}
+    lite_no_buckets  same model, batches in corpus order as vanilla does
+    lite_greedy      same model, beam width 1
+The vanilla model has neither the bidirectional encoder nor attention, so they are measured jointly
+by the difference between vanilla and lite_no_buckets + lite_greedy.
+
+Usage:
+    python benchmarks/baseline_vs_lite.py --budget 600 --output compare.json
+    python benchmarks/baseline_vs_lite.py --enc data/en --dec data/vi --budget 3600 --threads 4 4
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'debug'))
+from liteSeq2Seq import tf
+from liteSeq2Seq import Seq2seq
+from synthetic import generate_corpus
+import vanilla
+
+SYSTEMS = ('vanilla', 'lite', 'lite_no_buckets', 'lite_greedy')
+
+
+class LiteSystem:
+    def __init__(self, model):
+        '''
+        Lite seq2seq with its graph built
+        @model: Seq2seq, the model with dictionaries set and graph built
+        '''
+        self.model = model
+        graph = model.graph
+        self.train_op, self.cost, _ = graph.get_collection('optimization')
+        self.inputs = graph.get_tensor_by_name('inputs:0')
+        self.inputs_lens = graph.get_tensor_by_name('source_lens:0')
+        self.targets = graph.get_tensor_by_name('targets:0')
+        self.targets_lens = graph.get_tensor_by_name('target_lens:0')
+        self.keep_prob = graph.get_tensor_by_name('dropout:0')
+        self.lr = graph.get_tensor_by_name('optimization/learning_rate:0')
+        self.prediction = graph.get_tensor_by_name('optimization/predictions:0')
+
+    def train_step(self, batch):
+        inputs, inputs_lens, targets, targets_lens = batch
+        return self.model.sess.run([self.train_op, self.cost], feed_dict={
+            self.inputs: inputs,
+            self.inputs_lens: inputs_lens,
+            self.targets: targets,
+            self.targets_lens: targets_lens,
+            self.keep_prob: self.model.hyparams.keep_prob,
+            self.lr: self.model.hyparams.learning_rate,
+            })[1]
+
+    def evaluate(self, eval_set):
+        return self.model._evaluate(eval_set)
+
+    def predict(self, inputs, inputs_lens):
+        return self.model.sess.run(self.prediction, feed_dict={
+            self.inputs: inputs,
+            self.inputs_lens: inputs_lens,
+            self.keep_prob: 1.0,
+            })
+
+
+class VanillaSystem:
+    def __init__(self, bleu_model, hyparams, threads):
+        '''
+        Vanilla seq2seq of debug/vanilla.py with the same sizes as lite
+        @bleu_model: Seq2seq, lite model whose dictionaries and bleu methods are shared
+        @hyparams: Hyparams, sizes, learning rate and keep probability are taken from it
+        @threads: tuple, (intra_op_threads, inter_op_threads)
+        '''
+        self.bleu_model = bleu_model
+        self.hyparams = hyparams
+        self.graph, (self.inputs, self.targets, self.lr, self.keep_prob, self.targets_lens, self.inputs_lens,
+                self.prediction, self.cost, self.train_op) = vanilla.build_graph(
+                        len(bleu_model.encoder_vocab_to_int), bleu_model.decoder_vocab_to_int,
+                        rnn_size=hyparams.rnn_layer_size, num_layers=hyparams.n_rnn_layers,
+                        encoding_embedding_size=hyparams.embedding_dim, decoding_embedding_size=hyparams.embedding_dim)
+        with self.graph.as_default():
+            self.sess = tf.Session(config=tf.ConfigProto(
+                intra_op_parallelism_threads=threads[0], inter_op_parallelism_threads=threads[1]))
+            self.sess.run(tf.global_variables_initializer())
+
+    def train_step(self, batch):
+        inputs, inputs_lens, targets, targets_lens = batch
+        return self.sess.run([self.train_op, self.cost], feed_dict={
+            self.inputs: inputs,
+            self.inputs_lens: inputs_lens,
+            self.targets: targets,
+            self.targets_lens: targets_lens,
+            self.keep_prob: self.hyparams.keep_prob,
+            self.lr: self.hyparams.learning_rate,
+            })[1]
+
+    def evaluate(self, eval_set):
+        # Same metrics as Seq2seq._evaluate
+        start_time = time.time()
+        decoder_eos_id = self.bleu_model.decoder_vocab_to_int['<EOS>']
+        max_order = self.hyparams.bleu_max_order
+        total_loss = 0.0
+        n_tokens = 0
+        bleu_stats = 0
+        for inputs, inputs_lens, targets, targets_lens in eval_set:
+            batch_loss = self.sess.run(self.cost, feed_dict={
+                self.inputs: inputs,
+                self.inputs_lens: inputs_lens,
+                self.targets: targets,
+                self.targets_lens: targets_lens,
+                self.keep_prob: 1.0,
+                })
+            predict_lists = self.predict(inputs, inputs_lens)
+            total_loss += batch_loss * np.sum(targets_lens)
+            n_tokens += np.sum(targets_lens)
+            bleu_stats = bleu_stats + self.bleu_model._bleu_stats(
+                    predict_lists, self.bleu_model._seq_lens(predict_lists, [decoder_eos_id]),
+                    targets, targets_lens - 1, max_order)
+        return {
+                'loss': float(total_loss / max(n_tokens, 1)),
+                'bleu': float(self.bleu_model._bleu_from_stats(bleu_stats, max_order, self.hyparams.bleu_smooth)),
+                'n_pairs': sum(len(batch[0]) for batch in eval_set),
+                'wall_time': time.time() - start_time,
+                }
+
+    def predict(self, inputs, inputs_lens):
+        # The greedy decoder runs for the max target length, which is set as lite does
+        return self.sess.run(self.prediction, feed_dict={
+            self.inputs: inputs,
+            self.inputs_lens: inputs_lens,
+            self.targets_lens: [2 * np.max(inputs_lens)] * len(inputs),
+            self.keep_prob: 1.0,
+            })
+
+
+def prepare_data(args, model):
+    '''
+    Parse dictionaries and sequences once for all systems, the validation split is fixed by the seed
+    @return: (train_encode_seqs, train_decode_seqs, valid_encode_seqs, valid_decode_seqs)
+    '''
+    model.encoder_int_to_vocab, model.encoder_vocab_to_int = model._parse_dict(args.enc)
+    model.decoder_int_to_vocab, model.decoder_vocab_to_int = model._parse_dict(args.dec)
+    encode_seqs, decode_seqs = [], []
+    for file_encode_seqs, file_decode_seqs in model._parse_seq(args.enc, args.dec, model.encoder_vocab_to_int, model.decoder_vocab_to_int):
+        encode_seqs.extend(file_encode_seqs)
+        decode_seqs.extend(file_decode_seqs)
+
+    order = np.random.RandomState(args.seed).permutation(len(encode_seqs))
+    n_valid = int(len(order) * model.hyparams.valid_portion)
+    valid_idxs, train_idxs = order[:n_valid], sorted(order[n_valid:])
+    return ([encode_seqs[i] for i in train_idxs], [decode_seqs[i] for i in train_idxs],
+            [encode_seqs[i] for i in valid_idxs], [decode_seqs[i] for i in valid_idxs])
+
+
+def bucketize(model, encode_seqs, decode_seqs):
+    '''
+    Order pairs as Seq2seq._parse_seq does with n_buckets
+    '''
+    lens = [max(len(enc), len(dec)) for enc, dec in zip(encode_seqs, decode_seqs)]
+    bucket_width = (max(map(len, encode_seqs)) + model.hyparams.n_buckets - 1) // model.hyparams.n_buckets
+    order = sorted(range(len(lens)), key=lambda i: lens[i] // bucket_width)
+    return [encode_seqs[i] for i in order], [decode_seqs[i] for i in order]
+
+
+def run_system(name, args, data, bleu_model):
+    '''
+    Train one system for the time budget, evaluating at intervals of training time
+    @return: dict, the measured curve and speed
+    '''
+    train_encode_seqs, train_decode_seqs, valid_encode_seqs, valid_decode_seqs = data
+    hyparams = bleu_model.hyparams
+    threads = (hyparams.intra_op_threads, hyparams.inter_op_threads)
+
+    if name == 'vanilla':
+        system = VanillaSystem(bleu_model, hyparams, threads)
+    else:
+        model = Seq2seq(beam_width=1 if name == 'lite_greedy' else None, **args.model_kwargs)
+        for attr in ('encoder_int_to_vocab', 'encoder_vocab_to_int', 'decoder_int_to_vocab', 'decoder_vocab_to_int'):
+            setattr(model, attr, getattr(bleu_model, attr))
+        model._build_graph()
+        system = LiteSystem(model)
+
+    if name in ('lite', 'lite_greedy') and hyparams.n_buckets > 1:
+        train_encode_seqs, train_decode_seqs = bucketize(bleu_model, train_encode_seqs, train_decode_seqs)
+
+    encode_pad_id = bleu_model.encoder_vocab_to_int['<PAD>']
+    decode_pad_id = bleu_model.decoder_vocab_to_int['<PAD>']
+    batches = bleu_model._padding_batch(train_encode_seqs, train_decode_seqs, hyparams.train_batch_size, encode_pad_id, decode_pad_id, forever=True)
+    eval_set = bleu_model._build_eval_set(valid_encode_seqs, valid_decode_seqs, hyparams.eval_batch_size)
+
+    curve = []
+    train_time = 0.0
+    n_steps = 0
+    n_examples = 0
+    next_eval = 0.0
+    print('Training {} for {} seconds'.format(name, args.budget))
+    while train_time < args.budget:
+        if train_time >= next_eval:
+            curve.append(dict(system.evaluate(eval_set), train_sec=train_time, step=n_steps))
+            print('{:>16} {:>8.1f}s step {:>6} loss {:.4f} bleu {:.4f}'.format(name, train_time, n_steps, curve[-1]['loss'], curve[-1]['bleu']))
+            next_eval += args.eval_interval
+        batch = next(batches)
+        start = time.time()
+        system.train_step(batch)
+        train_time += time.time() - start
+        n_steps += 1
+        n_examples += len(batch[0])
+    curve.append(dict(system.evaluate(eval_set), train_sec=train_time, step=n_steps))
+
+    # Single sentence latency and batched throughput on the validation set
+    latencies = []
+    for enc in valid_encode_seqs[:args.latency_samples]:
+        start = time.time()
+        system.predict(np.array([enc]), [len(enc)])
+        latencies.append(time.time() - start)
+    start = time.time()
+    for inputs, inputs_lens, _, _ in eval_set:
+        system.predict(inputs, inputs_lens)
+    batched_time = time.time() - start
+
+    return {
+            'curve': curve,
+            'final_bleu': curve[-1]['bleu'],
+            'best_bleu': max(point['bleu'] for point in curve),
+            'final_loss': curve[-1]['loss'],
+            'train_steps': n_steps,
+            'examples_per_sec': n_examples / train_time,
+            'latency_p50_ms': float(np.percentile(latencies, 50) * 1e3) if latencies else None,
+            'latency_p90_ms': float(np.percentile(latencies, 90) * 1e3) if latencies else None,
+            'batched_sentences_per_sec': len(valid_encode_seqs) / batched_time,
+            }
+
+
+def time_to_bleu(curve, bleu):
+    '''
+    Training seconds until the validation bleu first reaches {bleu}, None if never
+    '''
+    for point in curve:
+        if point['bleu'] >= bleu:
+            return point['train_sec']
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare vanilla seq2seq and lite-seq2seq under the same time budget')
+    parser.add_argument('--enc', nargs='*', help='Encoder files, a synthetic corpus is generated if not given')
+    parser.add_argument('--dec', nargs='*', help='Decoder files, a synthetic corpus is generated if not given')
+    parser.add_argument('--systems', nargs='*', default=list(SYSTEMS), choices=SYSTEMS, help='Systems to train, default to all')
+    parser.add_argument('--budget', type=float, default=300, help='Training seconds of each system, default to 300')
+    parser.add_argument('--eval_interval', type=float, default=30, help='Evaluate every {this} training seconds, default to 30')
+    parser.add_argument('--latency_samples', type=int, default=50, help='Sentences used to measure latency, default to 50')
+    parser.add_argument('--threads', type=int, nargs=2, default=[0, 0], metavar=('INTRA', 'INTER'), help='Intra and inter op threads of every system, default to 0 0, tensorflow decides')
+    parser.add_argument('--embedding_dim', type=int, default=128, help='Embedding size, default to 128')
+    parser.add_argument('--rnn_layer_size', type=int, default=256, help='Rnn layer size, default to 256')
+    parser.add_argument('--n_rnn_layers', type=int, default=2, help='Number of rnn layers, default to 2')
+    parser.add_argument('--batch_size', type=int, default=64, help='Training batch size, default to 64')
+    parser.add_argument('--n_pairs', type=int, default=20000, help='Pairs of the synthetic corpus, default to 20000')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus and the validation split, default to 0')
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    if not args.enc or not args.dec:
+        encode_path, decode_path = generate_corpus(os.path.join(work_dir, 'corpus'), n_pairs=args.n_pairs, seed=args.seed)
+        args.enc, args.dec = [encode_path], [decode_path]
+
+    args.model_kwargs = dict(
+            embedding_dim=args.embedding_dim,
+            rnn_layer_size=args.rnn_layer_size,
+            n_rnn_layers=args.n_rnn_layers,
+            train_batch_size=args.batch_size,
+            intra_op_threads=args.threads[0],
+            inter_op_threads=args.threads[1])
+
+    Seq2seq.set_model_dir(os.path.join(work_dir, 'models'))
+    bleu_model = Seq2seq(**args.model_kwargs)
+    data = prepare_data(args, bleu_model)
+
+    results = {}
+    for name in args.systems:
+        results[name] = run_system(name, args, data, bleu_model)
+
+    # How long each system needs to reach the final bleu of the baseline
+    if 'vanilla' in results:
+        for name, result in results.items():
+            result['sec_to_vanilla_bleu'] = time_to_bleu(result['curve'], results['vanilla']['final_bleu'])
+
+    print('| system | final bleu | best bleu | examples/sec | sec to vanilla bleu | latency p50 (ms) | batched sentences/sec |')
+    print('| ------ | ---------- | --------- | ------------ | ------------------- | ---------------- | --------------------- |')
+    for name, result in results.items():
+        print('| {} | {:.4f} | {:.4f} | {:.1f} | {} | {:.1f} | {:.1f} |'.format(
+            name, result['final_bleu'], result['best_bleu'], result['examples_per_sec'],
+            result.get('sec_to_vanilla_bleu'), result['latency_p50_ms'] or 0.0, result['batched_sentences_per_sec']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'settings': vars(args), 'results': results}, fp, indent=2)
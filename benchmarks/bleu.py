@@ -0,0 +1,119 @@
+'''
+Speed of the vectorized corpus bleu against the former per sentence Counter implementation.
+
+Random unpadded sentences are scored by both implementations, the scores must be identical.
+
+Usage:
+    python benchmarks/bleu.py
+    python benchmarks/bleu.py --n_sentences 50000 --vocab_size 30000
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from liteSeq2Seq import Seq2seq
+
+
+def counter_bleu(gen_lists, refer_lists, max_order=4, smooth=True):
+    '''
+    The former implementation, building a Counter of n-gram tuples for each sentence
+    '''
+    def get_ngrams(segment, max_order):
+        ngram_counts = Counter()
+        for order in range(1, max_order + 1):
+            for i in range(0, len(segment) - order + 1):
+                ngram = tuple(segment[i:i+order])
+                ngram_counts[ngram] += 1
+        return ngram_counts
+
+    matches_by_order = [0] * max_order
+    possible_matches_by_order = [0] * max_order
+    refer_length = 0
+    gen_length = 0
+
+    for (refer_list, gen_list) in zip(refer_lists, gen_lists):
+        refer_length += len(refer_list)
+        gen_length += len(gen_list)
+
+        overlap = get_ngrams(gen_list, max_order) & get_ngrams(refer_list, max_order)
+        for ngram in overlap:
+            matches_by_order[len(ngram)-1] += overlap[ngram]
+
+        for order in range(1, max_order+1):
+            possible_matches = len(gen_list) - order + 1
+            if possible_matches > 0:
+                possible_matches_by_order[order-1] += possible_matches
+
+    precisions = [0] * max_order
+    for i in range(0, max_order):
+        if smooth:
+            precisions[i] = ((matches_by_order[i] + 1.) / (possible_matches_by_order[i] + 1.))
+        else:
+            if possible_matches_by_order[i] > 0:
+                precisions[i] = (float(matches_by_order[i]) / possible_matches_by_order[i])
+            else:
+                precisions[i] = 0.0
+
+    if min(precisions) > 0:
+        p_log_sum = sum((1. / max_order) * np.log(p) for p in precisions)
+        geo_mean = np.exp(p_log_sum)
+    else:
+        geo_mean = 0.0
+
+    ratio = float(gen_length) / refer_length
+    bp = 1. if ratio > 1.0 else np.exp(1 - 1. / ratio)
+    return geo_mean * bp
+
+
+def synthetic_pairs(n_sentences, vocab_size, mean_len, rng):
+    '''
+    Generate references and hypotheses sharing part of their tokens, so that n-grams do match
+    @return: (list, list), generated lists and reference lists of token ids
+    '''
+    gen_lists = []
+    refer_lists = []
+    for _ in range(n_sentences):
+        refer = rng.randint(4, vocab_size, size=max(1, rng.poisson(mean_len))).tolist()
+        gen = [token if rng.rand() < 0.7 else int(rng.randint(4, vocab_size)) for token in refer]
+        gen = gen[:max(1, len(gen) + rng.randint(-2, 3))]
+        gen_lists.append(gen)
+        refer_lists.append(refer)
+    return gen_lists, refer_lists
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare vectorized bleu with the Counter implementation')
+    parser.add_argument('--n_sentences', type=int, default=50000, help='Number of sentence pairs, default to 50000')
+    parser.add_argument('--vocab_size', type=int, default=30000, help='Vocabulary size, default to 30000')
+    parser.add_argument('--mean_len', type=int, default=20, help='Mean sentence length, default to 20')
+    parser.add_argument('--max_order', type=int, default=4, help='The max order for n-gram, default to 4')
+    args = parser.parse_args()
+
+    Seq2seq.set_model_dir(tempfile.mkdtemp())
+    model = Seq2seq()
+
+    gen_lists, refer_lists = synthetic_pairs(args.n_sentences, args.vocab_size, args.mean_len, np.random.RandomState(0))
+
+    for smooth in (False, True):
+        start = time.time()
+        expected = counter_bleu(gen_lists, refer_lists, args.max_order, smooth)
+        counter_time = time.time() - start
+
+        start = time.time()
+        result = model._bleu(gen_lists, refer_lists, args.max_order, smooth)
+        vectorized_time = time.time() - start
+
+        assert result == expected, 'bleu mismatch: {} != {}'.format(result, expected)
+        print('smooth={}\tbleu: {:.6f}\tcounter: {:.3f}s\tvectorized: {:.3f}s\tspeedup: {:.1f}x'.format(
+            smooth, result, counter_time, vectorized_time, counter_time / vectorized_time))
@@ -0,0 +1,115 @@
+'''
+Throughput of the rnn cell backends selectable by hyperparameter cell_type.
+
+Every backend is built with the same hyperparameters and fed with the same random batches,
+the training and inference speed is printed as a markdown table.
+
+Usage:
+    python benchmarks/cell_throughput.py
+    python benchmarks/cell_throughput.py --rnn_layer_size 512 --seq_len 30 --steps 50
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from liteSeq2Seq import Seq2seq
+from liteSeq2Seq import CELL_TYPES
+from synthetic import synthetic_dictionary
+
+
+def measure(cell_type, args):
+    '''
+    Build the graph with given cell type and time training steps and inference
+    @cell_type: str, one of CELL_TYPES
+    @args: argparse.Namespace, benchmark settings
+    @return: dict, the measured speed
+    '''
+    model = Seq2seq(
+            embedding_dim=args.embedding_dim,
+            rnn_layer_size=args.rnn_layer_size,
+            n_rnn_layers=args.n_rnn_layers,
+            train_batch_size=args.batch_size,
+            cell_type=cell_type)
+    model.encoder_int_to_vocab, model.encoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model.decoder_int_to_vocab, model.decoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model._build_graph()
+
+    graph = model.graph
+    train_op, cost, _ = graph.get_collection('optimization')
+    prediction = graph.get_tensor_by_name('optimization/predictions:0')
+
+    rng = np.random.RandomState(0)
+    inputs = rng.randint(4, args.vocab_size + 4, size=(args.batch_size, args.seq_len))
+    targets = rng.randint(4, args.vocab_size + 4, size=(args.batch_size, args.seq_len))
+    train_feed = {
+            graph.get_tensor_by_name('inputs:0'): inputs,
+            graph.get_tensor_by_name('source_lens:0'): [args.seq_len] * args.batch_size,
+            graph.get_tensor_by_name('targets:0'): targets,
+            graph.get_tensor_by_name('target_lens:0'): [args.seq_len] * args.batch_size,
+            graph.get_tensor_by_name('dropout:0'): model.hyparams.keep_prob,
+            graph.get_tensor_by_name('optimization/learning_rate:0'): model.hyparams.learning_rate,
+            }
+    infer_feed = {
+            graph.get_tensor_by_name('inputs:0'): inputs[:model.hyparams.infer_batch_size],
+            graph.get_tensor_by_name('source_lens:0'): [args.seq_len] * model.hyparams.infer_batch_size,
+            graph.get_tensor_by_name('dropout:0'): 1.0,
+            }
+
+    # The first runs allocate memory and warm the kernels up
+    for _ in range(args.warmup):
+        model.sess.run([train_op, cost], feed_dict=train_feed)
+        model.sess.run(prediction, feed_dict=infer_feed)
+
+    start = time.time()
+    for _ in range(args.steps):
+        model.sess.run([train_op, cost], feed_dict=train_feed)
+    train_time = (time.time() - start) / args.steps
+
+    start = time.time()
+    for _ in range(args.steps):
+        model.sess.run(prediction, feed_dict=infer_feed)
+    infer_time = (time.time() - start) / args.steps
+
+    model.sess.close()
+
+    return {
+            'cell_type': cell_type,
+            'step_ms': train_time * 1e3,
+            'examples_per_sec': args.batch_size / train_time,
+            'tokens_per_sec': 2 * args.batch_size * args.seq_len / train_time,
+            'infer_ms': infer_time * 1e3,
+            }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the throughput of rnn cell backends')
+    parser.add_argument('--cell_types', nargs='*', default=list(CELL_TYPES), choices=CELL_TYPES, help='Backends to compare, default to all')
+    parser.add_argument('--embedding_dim', type=int, default=256, help='Embedding layer size, default to 256')
+    parser.add_argument('--rnn_layer_size', type=int, default=512, help='Single rnn layer size, default to 512')
+    parser.add_argument('--n_rnn_layers', type=int, default=2, help='Number of rnn layers, default to 2')
+    parser.add_argument('--vocab_size', type=int, default=8000, help='Number of words in both vocabularies, default to 8000')
+    parser.add_argument('--batch_size', type=int, default=32, help='Training batch size, default to 32')
+    parser.add_argument('--seq_len', type=int, default=20, help='Length of both input and target sequences, default to 20')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed steps before measuring, default to 3')
+    parser.add_argument('--steps', type=int, default=20, help='Timed steps for each backend, default to 20')
+    args = parser.parse_args()
+
+    Seq2seq.set_model_dir(tempfile.mkdtemp())
+
+    results = [measure(cell_type, args) for cell_type in args.cell_types]
+
+    print()
+    print('| cell_type | train step (ms) | examples/sec | tokens/sec | inference (ms) |')
+    print('| --------- | --------------- | ------------ | ---------- | -------------- |')
+    for result in results:
+        print('| {cell_type} | {step_ms:.1f} | {examples_per_sec:.1f} | {tokens_per_sec:.0f} | {infer_ms:.1f} |'.format(**result))
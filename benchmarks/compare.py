@@ -0,0 +1,49 @@
+'''
+Compare two JSON results of benchmarks/suite.py, e.g. of two commits or two presets.
+
+Usage:
+    python benchmarks/compare.py base.json new.json
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import argparse
+
+
+def flatten(results, prefix=''):
+    '''
+    Flatten nested dict into {'a/b/c': number}
+    '''
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '/'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two benchmark results')
+    parser.add_argument('base', help='JSON result used as base')
+    parser.add_argument('new', help='JSON result to compare with base')
+    args = parser.parse_args()
+
+    with open(args.base) as fp:
+        base = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+
+    print('base: {} {}'.format(base.get('commit'), base.get('preset')))
+    print('new:  {} {}'.format(new.get('commit'), new.get('preset')))
+
+    base_results = flatten(base['results'])
+    new_results = flatten(new['results'])
+    print('{:<48}{:>14}{:>14}{:>10}'.format('metric', 'base', 'new', 'new/base'))
+    for name in sorted(set(base_results) & set(new_results)):
+        ratio = new_results[name] / base_results[name] if base_results[name] else float('nan')
+        print('{:<48}{:>14.4g}{:>14.4g}{:>10.3f}'.format(name, base_results[name], new_results[name], ratio))
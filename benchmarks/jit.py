@@ -0,0 +1,124 @@
+'''
+Speed of training steps with and without XLA jit compilation, across bucket lengths.
+
+XLA compiles a cluster again for every new input shape, so the first step of each length
+includes the compile time, which is reported apart from the steady step time.
+Each jit setting runs in its own process, since XLA flags are read once per process.
+
+Usage:
+    python benchmarks/jit.py
+    python benchmarks/jit.py --lengths 10 20 40 80 --rnn_layer_size 512 --steps 20
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(args):
+    '''
+    Build the model with given jit setting and time training steps of each length
+    @args: argparse.Namespace, benchmark settings with a single jit setting
+    @return: list, a dict of compile time and steps/sec for each length
+    '''
+    from liteSeq2Seq import Seq2seq
+    from synthetic import synthetic_dictionary
+
+    Seq2seq.set_model_dir(tempfile.mkdtemp())
+    model = Seq2seq(
+            embedding_dim=args.embedding_dim,
+            rnn_layer_size=args.rnn_layer_size,
+            n_rnn_layers=args.n_rnn_layers,
+            train_batch_size=args.batch_size,
+            jit=bool(args.jit))
+    model.encoder_int_to_vocab, model.encoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model.decoder_int_to_vocab, model.decoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model._build_graph()
+
+    graph = model.graph
+    train_op, cost, _ = graph.get_collection('optimization')
+    rng = np.random.RandomState(0)
+
+    results = []
+    for length in args.lengths:
+        feed_dict = {
+                graph.get_tensor_by_name('inputs:0'): rng.randint(4, args.vocab_size + 4, size=(args.batch_size, length)),
+                graph.get_tensor_by_name('source_lens:0'): [length] * args.batch_size,
+                graph.get_tensor_by_name('targets:0'): rng.randint(4, args.vocab_size + 4, size=(args.batch_size, length)),
+                graph.get_tensor_by_name('target_lens:0'): [length] * args.batch_size,
+                graph.get_tensor_by_name('dropout:0'): model.hyparams.keep_prob,
+                graph.get_tensor_by_name('optimization/learning_rate:0'): model.hyparams.learning_rate,
+                }
+
+        start = time.time()
+        model.sess.run([train_op, cost], feed_dict=feed_dict)
+        first_step = time.time() - start
+
+        start = time.time()
+        for _ in range(args.steps):
+            model.sess.run([train_op, cost], feed_dict=feed_dict)
+        step_time = (time.time() - start) / args.steps
+
+        results.append({
+            'jit': bool(args.jit),
+            'jit_available': model._jit_available(),
+            'length': length,
+            'steps_per_sec': 1 / step_time,
+            'compile_sec': max(0.0, first_step - step_time),
+            })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Speed and compile time of training steps with and without XLA jit')
+    parser.add_argument('--lengths', type=int, nargs='*', default=[10, 20, 40, 80], help='Bucket lengths of both source and target, default to 10 20 40 80')
+    parser.add_argument('--embedding_dim', type=int, default=256, help='Embedding size, default to 256')
+    parser.add_argument('--rnn_layer_size', type=int, default=512, help='Rnn layer size, default to 512')
+    parser.add_argument('--n_rnn_layers', type=int, default=2, help='Number of rnn layers, default to 2')
+    parser.add_argument('--vocab_size', type=int, default=10000, help='Vocabulary size of each side, default to 10000')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size, default to 32')
+    parser.add_argument('--steps', type=int, default=10, help='Timed steps of each length, default to 10')
+    parser.add_argument('--jit', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    if args.jit is not None:
+        # Worker process of a single jit setting
+        print(json.dumps(measure(args)))
+        sys.exit(0)
+
+    # Benchmark on cpu only
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+
+    results = []
+    for jit in (0, 1):
+        command = [sys.executable, os.path.abspath(__file__), '--jit', str(jit), '--lengths'] + [str(length) for length in args.lengths] + [
+                '--embedding_dim', str(args.embedding_dim), '--rnn_layer_size', str(args.rnn_layer_size),
+                '--n_rnn_layers', str(args.n_rnn_layers), '--vocab_size', str(args.vocab_size),
+                '--batch_size', str(args.batch_size), '--steps', str(args.steps)]
+        process = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, env=env, check=True)
+        results.extend(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    if not results[-1]['jit_available']:
+        print('XLA is not available in this tensorflow build, both runs are without jit')
+
+    print('| jit | length | steps/sec | compile (s) |')
+    print('| --- | ------ | --------- | ----------- |')
+    for result in results:
+        print('| {} | {} | {:.2f} | {:.2f} |'.format(result['jit'], result['length'], result['steps_per_sec'], result['compile_sec']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
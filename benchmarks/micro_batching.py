@@ -0,0 +1,126 @@
+'''
+Load test of MicroBatcher against batch window.
+
+Concurrent clients call predict in closed loops, each sends its next request once the previous one is answered.
+Clients call model.predict directly first, which runs one session per request, then go through a MicroBatcher
+for each batch window. Latency percentiles, throughput and the mean size of flushed batches are reported.
+The model is untrained, decoding runs for {max_decode_len} steps, and the prediction cache is disabled.
+
+Usage:
+    python benchmarks/micro_batching.py
+    python benchmarks/micro_batching.py --clients 64 --windows 1 5 20 --duration 20 --output micro_batching.json
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from liteSeq2Seq import Seq2seq
+from liteSeq2Seq import MicroBatcher
+from synthetic import synthetic_dictionary
+from synthetic import sample_lengths
+from synthetic import sample_words
+from suite import latency_summary
+
+
+def load_test(predict, sentences, n_clients, duration):
+    '''
+    Run closed loop clients for {duration} seconds
+    @predict: callable, takes a sentence and returns the answer
+    @sentences: list, sentences sent by clients in turn
+    @n_clients: int, number of client threads
+    @duration: float, seconds to run
+    @return: dict, latency summary and requests per second
+    '''
+    latencies = [[] for _ in range(n_clients)]
+    stop_at = time.time() + duration
+
+    def client(client_i):
+        request_i = client_i
+        while time.time() < stop_at:
+            start = time.time()
+            predict(sentences[request_i % len(sentences)])
+            latencies[client_i].append(time.time() - start)
+            request_i += n_clients
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(n_clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.time() - start
+
+    latencies = [latency for client_latencies in latencies for latency in client_latencies]
+    result = latency_summary(latencies)
+    result['requests_per_sec'] = len(latencies) / wall_time
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and throughput of MicroBatcher against batch window')
+    parser.add_argument('--clients', type=int, default=32, help='Number of concurrent clients, default to 32')
+    parser.add_argument('--windows', type=float, nargs='*', default=[1, 2, 5, 10, 20], help='Batch windows(max_wait_ms) to test, default to 1 2 5 10 20')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='Max batch size of MicroBatcher, default to 32')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of each run, default to 10')
+    parser.add_argument('--embedding_dim', type=int, default=64, help='Embedding size, default to 64')
+    parser.add_argument('--rnn_layer_size', type=int, default=128, help='Rnn layer size, default to 128')
+    parser.add_argument('--n_rnn_layers', type=int, default=1, help='Number of rnn layers, default to 1')
+    parser.add_argument('--vocab_size', type=int, default=5000, help='Vocabulary size of each side, default to 5000')
+    parser.add_argument('--mean_len', type=int, default=10, help='Mean length of requests, default to 10')
+    parser.add_argument('--max_decode_len', type=int, default=20, help='Decoding steps of each request, default to 20')
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    Seq2seq.set_model_dir(tempfile.mkdtemp())
+    model = Seq2seq(
+            embedding_dim=args.embedding_dim,
+            rnn_layer_size=args.rnn_layer_size,
+            n_rnn_layers=args.n_rnn_layers,
+            max_decode_len=args.max_decode_len,
+            cache_size=0)
+    model.encoder_int_to_vocab, model.encoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model.decoder_int_to_vocab, model.decoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model._build_graph()
+
+    rng = np.random.RandomState(0)
+    lens = sample_lengths(1000, 'poisson', args.mean_len, 4 * args.mean_len, rng)
+    words = sample_words(int(lens.sum()), args.vocab_size, 1.1, rng)
+    sentences = [' '.join('w{}'.format(i) for i in sentence) for sentence in np.split(words, np.cumsum(lens)[:-1])]
+    model.predict_batch(sentences[:args.max_batch_size])
+
+    results = []
+    result = load_test(model.predict, sentences, args.clients, args.duration)
+    result.update({'window_ms': None, 'mean_batch_size': 1.0})
+    results.append(result)
+    print(result, flush=True)
+
+    for window in args.windows:
+        batcher = MicroBatcher(model, max_batch_size=args.max_batch_size, max_wait_ms=window)
+        result = load_test(batcher.predict, sentences, args.clients, args.duration)
+        batcher.close()
+        result.update({'window_ms': window, 'mean_batch_size': batcher.n_requests / max(batcher.n_batches, 1)})
+        results.append(result)
+        print(result, flush=True)
+
+    print('| window (ms) | requests/sec | mean batch | p50 (ms) | p99 (ms) |')
+    print('| ----------- | ------------ | ---------- | -------- | -------- |')
+    for result in results:
+        print('| {} | {:.1f} | {:.1f} | {:.1f} | {:.1f} |'.format(
+            'direct' if result['window_ms'] is None else result['window_ms'],
+            result['requests_per_sec'], result['mean_batch_size'], result['p50_ms'], result['p99_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
@@ -0,0 +1,178 @@
+'''
+Answers, startup time, latency and throughput of NumpySeq2seq against Seq2seq on a trained or exported model.
+
+Both engines predict a held-out set with the same decoding options, and the share of identical answers is reported with
+the first differences. A trained model is also exported as float32 and int8, and both exports are checked the same way,
+so the checkpoint reader, weights.npz and its dequantization are all covered. Greedy decoding and beam search are checked.
+Inputs left empty by processing, like '...', are checked to get empty answers from both engines, alone and in a batch.
+The script exits with status 1 if any share is below --min_same or an empty input fails, so it serves as the parity check of NumpySeq2seq.
+Without --model, a tiny model is trained on a synthetic corpus first.
+Startup is timed in a fresh process for each engine: import, load and the first predict.
+
+Usage:
+    python benchmarks/numpy_inference.py
+    python benchmarks/numpy_inference.py --model ./models/model_id --enc test_enc
+    python benchmarks/numpy_inference.py --model ./exported/model_id --enc test_enc --beam_widths 1 4 --output numpy_inference.json
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+from liteSeq2Seq import Seq2seq
+from liteSeq2Seq import NumpySeq2seq
+from suite import latency_summary
+from suite import timed
+from startup import train
+
+# Nothing is left of them after TextProcessor.process_str
+EMPTY_INPUTS = ['', '...', '( only parens )']
+
+STARTUP_SCRIPT = '''
+import time, json
+start = time.time()
+from liteSeq2Seq import {engine}
+import_sec = time.time() - start
+model = {engine}(cache_size=0)
+model.load({model!r})
+load_sec = time.time() - start - import_sec
+model.predict({sentence!r})
+print(json.dumps({{'import_sec': import_sec, 'load_sec': load_sec, 'total_sec': time.time() - start}}))
+'''
+
+
+def startup(engine, model_path, sentence):
+    '''
+    Time import, load and the first predict in a fresh process
+    @engine: str, Seq2seq or NumpySeq2seq
+    @model_path: str, path of the model
+    @sentence: str, the sentence to predict
+    @return: dict, seconds of each stage
+    '''
+    script = STARTUP_SCRIPT.format(engine=engine, model=os.path.abspath(model_path), sentence=sentence)
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT_DIR)
+    return json.loads(output.decode().strip().split('\n')[-1])
+
+
+def measure(model, sources, beam_width, args):
+    '''
+    Predict the held-out set
+    @model: Seq2seq or NumpySeq2seq, the loaded model
+    @sources: list, source sentences
+    @beam_width: int, beam width of the predictions
+    @args: argparse.Namespace, benchmark settings
+    @return: (list, dict), the answers, and latency and throughput
+    '''
+    for source in sources[:3]:
+        model.predict(source, beam_width=beam_width)
+    latency = latency_summary([timed(model.predict, source, beam_width=beam_width)[1] for source in sources[:args.latency_samples]])
+    predictions, predict_sec = timed(model.predict_batch, sources, beam_width=beam_width)
+    return predictions, {'latency': latency, 'sentences_per_sec': len(sources) / predict_sec}
+
+
+def parity(model_path, sources, args):
+    '''
+    Answers of both engines on one model for each beam width
+    @model_path: str, path of a trained or exported model
+    @sources: list, source sentences
+    @args: argparse.Namespace, benchmark settings
+    @return: dict, whether empty inputs got empty answers, and for each beam width the share of same answers with latency and throughput of both engines
+    '''
+    models = {}
+    for engine in (Seq2seq, NumpySeq2seq):
+        models[engine.__name__] = engine(cache_size=0, infer_batch_size=args.infer_batch_size)
+        models[engine.__name__].load(model_path)
+
+    results = {'empty_inputs': True, 'beam_widths': {}}
+    for name, model in models.items():
+        answers = [model.predict(source) for source in EMPTY_INPUTS] + model.predict_batch(EMPTY_INPUTS + sources[:1])[:-1]
+        if any(answers):
+            results['empty_inputs'] = False
+            print('{} {}: empty inputs got answers {}'.format(model_path, name, answers))
+
+    for beam_width in args.beam_widths or sorted(set([1, models['Seq2seq'].max_beam_width])):
+        result = {}
+        answers = {}
+        for name, model in models.items():
+            answers[name], result[name] = measure(model, sources, beam_width, args)
+
+        differences = [(source, tf_answer, np_answer) for source, tf_answer, np_answer in zip(sources, answers['Seq2seq'], answers['NumpySeq2seq']) if tf_answer != np_answer]
+        result['same_answers'] = 1 - len(differences) / len(sources)
+        results['beam_widths'][beam_width] = result
+        print('{} beam_width {}: same answers {:.2%} of {} sentences'.format(model_path, beam_width, result['same_answers'], len(sources)), flush=True)
+        for source, tf_answer, np_answer in differences[:5]:
+            print('> {}\n  Seq2seq:      {}\n  NumpySeq2seq: {}'.format(source, tf_answer, np_answer))
+
+    models['Seq2seq'].sess.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NumpySeq2seq against Seq2seq on a trained or exported model')
+    parser.add_argument('--model', help='Path of the trained or exported model, default to train a tiny one')
+    parser.add_argument('--enc', help='Held-out source file, default to the synthetic corpus of the tiny model')
+    parser.add_argument('--n_sentences', type=int, default=1000, help='Sentences of the held-out set to use, default to 1000')
+    parser.add_argument('--latency_samples', type=int, default=100, help='Sentences predicted one by one for latency, default to 100')
+    parser.add_argument('--infer_batch_size', type=int, default=32, help='Batch size of batched throughput, default to 32')
+    parser.add_argument('--beam_widths', type=int, nargs='*', help='Beam widths to check, default to 1 and the trained one')
+    parser.add_argument('--steps', type=int, default=500, help='Training steps of the tiny model, default to 500')
+    parser.add_argument('--min_same', type=float, default=0.99, help='Least share of same answers to pass, default to 0.99')
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    if args.model and not args.enc:
+        parser.error('--enc is required with --model')
+
+    work_dir = tempfile.mkdtemp()
+    if args.model:
+        model_path = os.path.abspath(args.model)
+    else:
+        _, model_path = train(work_dir, 2000, args.steps)
+
+    with open(args.enc or os.path.join(work_dir, 'enc')) as fp:
+        sources = [line.strip() for line in fp][:args.n_sentences]
+
+    model_paths = {'model': model_path}
+    if not os.path.isfile(os.path.join(model_path, 'frozen_graph.pb')):
+        model = Seq2seq()
+        model.load(model_path)
+        model_paths['float32 export'] = model.export(os.path.join(work_dir, 'float32'))
+        model_paths['int8 export'] = model.export(os.path.join(work_dir, 'int8'), quantize=True)
+        model.sess.close()
+
+    results = {'startup': {name: startup(name, model_path, sources[0]) for name in ('Seq2seq', 'NumpySeq2seq')}}
+    results.update({name: parity(path, sources, args) for name, path in model_paths.items()})
+
+    print('| model | beam width | same answers | engine | p50 (ms) | p99 (ms) | sentences/sec |')
+    print('| ----- | ---------- | ------------ | ------ | -------- | -------- | ------------- |')
+    for name in model_paths:
+        for beam_width, result in results[name]['beam_widths'].items():
+            for engine in ('Seq2seq', 'NumpySeq2seq'):
+                print('| {} | {} | {:.2%} | {} | {:.1f} | {:.1f} | {:.1f} |'.format(
+                    name, beam_width, result['same_answers'], engine,
+                    result[engine]['latency']['p50_ms'], result[engine]['latency']['p99_ms'], result[engine]['sentences_per_sec']))
+
+    print('| engine | import (s) | load (s) | first answer (s) |')
+    print('| ------ | ---------- | -------- | ---------------- |')
+    for engine, result in results['startup'].items():
+        print('| {} | {:.3f} | {:.3f} | {:.3f} |'.format(engine, result['import_sec'], result['load_sec'], result['total_sec']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    failed = [(name, beam_width) for name in model_paths for beam_width, result in results[name]['beam_widths'].items()
+            if result['same_answers'] < args.min_same]
+    failed += [(name, 'empty_inputs') for name in model_paths if not results[name]['empty_inputs']]
+    if failed:
+        print('Failed on {}, --min_same is {}'.format(failed, args.min_same))
+        sys.exit(1)
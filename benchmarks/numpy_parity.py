@@ -0,0 +1,304 @@
+'''
+Parity check of NumpySeq2seq against tensorflow sessions on tiny checkpoints, which runs without tf.contrib.
+
+For each cell type, a tiny untrained model is built with tf.compat.v1 layers under the variable names of Seq2seq,
+trained one step so that the checkpoint also holds optimizer slots, and saved. NumpySeq2seq loads the checkpoint, then:
+- the weights read by its checkpoint parser are compared bit by bit with the variables of the session
+- the outputs and final states of its encoder are compared with the bidirectional rnn run by the session
+- its answers from predict_batch are compared with greedy decoding and beam search whose every decoder step,
+  the attention wrapped cell and the output projection, is run by the session. The search follows
+  GreedyEmbeddingHelper and BeamSearchDecoder without length penalty, as the graph of Seq2seq decodes
+The script exits with status 1 if any check fails. benchmarks/numpy_inference.py compares whole models instead,
+but needs the tf.contrib decoders of Seq2seq. With tensorflow 2, set TF_USE_LEGACY_KERAS=1 for the tf.compat.v1 cells.
+
+Usage:
+    python benchmarks/numpy_parity.py
+    python benchmarks/numpy_parity.py --cell_types gru --n_sentences 100 --output numpy_parity.json
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import pickle
+import argparse
+import tempfile
+
+import numpy as np
+import tensorflow
+tf = tensorflow.compat.v1
+tf.disable_eager_execution()
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from liteSeq2Seq import Seq2seq
+from liteSeq2Seq import NumpySeq2seq
+
+EMBEDDING_DIM = 6
+RNN_LAYER_SIZE = 8
+N_RNN_LAYERS = 2
+ENCODER_WORDS = ['<PAD>', '<UNK>', '<GO>'] + ['e{}'.format(i) for i in range(27)]
+DECODER_WORDS = ['<PAD>', '<UNK>', '<GO>', '<EOS>'] + ['d{}'.format(i) for i in range(21)]
+GO_ID = 2
+EOS_ID = 3
+# Untrained answers rarely end, a larger <EOS> column of the output kernel ends about half of them, at various lengths
+EOS_SCALE = 8.0
+# Max difference of float32 outputs of the two engines
+TOLERANCE = 1e-5
+
+
+class SessionModel:
+    def __init__(self, cell_type, model_dir, seed):
+        '''
+        Build a tiny model with the variable names of Seq2seq and save its checkpoint and dictionary in model_dir.
+        The session then runs the encoder of a batch and single decoder steps.
+        @cell_type: str, lstm or gru
+        @model_dir: str, the directory of the trained model
+        @seed: int, seed of the initial weights
+        '''
+        self.cell_type = cell_type
+        units = RNN_LAYER_SIZE // 2
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.set_random_seed(seed)
+            initializer = tf.random_uniform_initializer(-1, 1)
+            self.inputs = tf.placeholder(tf.int32, [None, None])
+            self.inputs_lens = tf.placeholder(tf.int32, [None])
+
+            with tf.variable_scope('encoder', initializer=initializer):
+                with tf.variable_scope('EmbedSequence'):
+                    embeddings = tf.get_variable('embeddings', [len(ENCODER_WORDS), EMBEDDING_DIM])
+                layer_output = tf.nn.embedding_lookup(embeddings, self.inputs)
+                self.encoder_state = []
+                with tf.variable_scope('stack_bidirectional_rnn'):
+                    for i in range(N_RNN_LAYERS):
+                        with tf.variable_scope('cell_{}'.format(i)):
+                            outputs, states = tf.nn.bidirectional_dynamic_rnn(
+                                    self._cell(units), self._cell(units), layer_output, sequence_length=self.inputs_lens, dtype=tf.float32)
+                        layer_output = tf.concat(outputs, -1)
+                        self.encoder_state += [tf.concat([forward, backward], -1) for forward, backward in zip(*[
+                                state if cell_type == 'lstm' else (state,) for state in states])]
+            self.encoder_output = layer_output
+
+            with tf.variable_scope('decoder_cell', initializer=initializer):
+                decoder_embedding = tf.get_variable('decoder_embed_weight', [len(DECODER_WORDS), EMBEDDING_DIM])
+            with tf.variable_scope('decoder', initializer=initializer):
+                memory_kernel = tf.get_variable('memory_layer/kernel', [RNN_LAYER_SIZE, RNN_LAYER_SIZE])
+
+            # One decoder step of a batch of rows, each with its own copy of the memory
+            self.step_ids = tf.placeholder(tf.int32, [None])
+            self.step_attention = tf.placeholder(tf.float32, [None, RNN_LAYER_SIZE])
+            self.step_state = [tuple(tf.placeholder(tf.float32, [None, RNN_LAYER_SIZE]) for _ in range(2 if cell_type == 'lstm' else 1))
+                    for _ in range(N_RNN_LAYERS)]
+            self.memory = tf.placeholder(tf.float32, [None, None, RNN_LAYER_SIZE])
+            self.memory_mask = tf.placeholder(tf.bool, [None, None])
+            with tf.variable_scope('decoder/decoder/attention_wrapper', initializer=initializer):
+                cell = tf.nn.rnn_cell.MultiRNNCell([self._cell(RNN_LAYER_SIZE) for _ in range(N_RNN_LAYERS)])
+                state = tuple(tf.nn.rnn_cell.LSTMStateTuple(*layer_state) if cell_type == 'lstm' else layer_state[0]
+                        for layer_state in self.step_state)
+                cell_output, next_state = cell(tf.concat([tf.nn.embedding_lookup(decoder_embedding, self.step_ids), self.step_attention], -1), state)
+                attention_kernel = tf.get_variable('attention_layer/kernel', [2 * RNN_LAYER_SIZE, RNN_LAYER_SIZE])
+            with tf.variable_scope('decoder/decoder', initializer=tf.random_uniform_initializer(-3, 3)):
+                output_kernel = tf.get_variable('decoder_output_embedding/kernel', [RNN_LAYER_SIZE, len(DECODER_WORDS)])
+
+            # Luong attention of tf.contrib.seq2seq, padded steps are masked out of scores
+            keys = tf.tensordot(self.memory, memory_kernel, 1)
+            scores = tf.where(self.memory_mask, tf.reduce_sum(keys * cell_output[:, None, :], -1), tf.fill(tf.shape(self.memory_mask), -np.inf))
+            context = tf.reduce_sum(tf.nn.softmax(scores)[:, :, None] * self.memory, 1)
+            self.next_attention = tf.matmul(tf.concat([cell_output, context], -1), attention_kernel)
+            self.log_probs = tf.nn.log_softmax(tf.matmul(self.next_attention, output_kernel))
+            self.next_state = [layer_state if cell_type == 'lstm' else (layer_state,) for layer_state in next_state]
+
+            variables = tf.trainable_variables()
+            optimize = tf.train.AdamOptimizer(0.1).minimize(sum(tf.reduce_sum(variable) for variable in variables),
+                    global_step=tf.train.get_or_create_global_step())
+            self.sess = tf.Session()
+            self.sess.run(tf.global_variables_initializer())
+            self.sess.run(output_kernel[:, EOS_ID].assign(EOS_SCALE * output_kernel[:, EOS_ID]))
+            self.sess.run(optimize)
+            tf.train.Saver().save(self.sess, os.path.join(model_dir, 'checkpoint.ckpt'), global_step=1)
+            self.weights = dict(zip([variable.op.name for variable in variables], self.sess.run(variables)))
+
+        # Dictionary and hyperparameters as training saves them
+        encoder_int_to_vocab, decoder_int_to_vocab = dict(enumerate(ENCODER_WORDS)), dict(enumerate(DECODER_WORDS))
+        with open(os.path.join(model_dir, 'dictionary'), 'wb') as fp:
+            pickle.dump((encoder_int_to_vocab, {word: i for i, word in encoder_int_to_vocab.items()},
+                decoder_int_to_vocab, {word: i for i, word in decoder_int_to_vocab.items()}), fp)
+        with open(os.path.join(model_dir, 'hparams'), 'wb') as fp:
+            pickle.dump(Seq2seq.hyparams._replace(embedding_dim=EMBEDDING_DIM, rnn_layer_size=RNN_LAYER_SIZE, n_rnn_layers=N_RNN_LAYERS,
+                cell_type=cell_type, beam_width=4, cache_size=0), fp)
+
+
+    def _cell(self, units):
+        return tf.nn.rnn_cell.LSTMCell(units) if self.cell_type == 'lstm' else tf.nn.rnn_cell.GRUCell(units)
+
+
+    def encode(self, batch_inputs, inputs_lens):
+        '''
+        @batch_inputs: np.array, int array of shape [batch, time], padded input ids
+        @inputs_lens: np.array, true lengths of inputs
+        @return: (np.array, list), encoder output and final state of each layer, lstm states are c and h in turn
+        '''
+        return self.sess.run((self.encoder_output, self.encoder_state), {self.inputs: batch_inputs, self.inputs_lens: inputs_lens})
+
+
+    def step(self, ids, attention, state, memory):
+        '''
+        @ids: np.array, previous token of each row
+        @attention: np.array, [rows, rnn_layer_size], attention of the previous step
+        @state: list, state of each decoder layer, a tuple of arrays of rows
+        @memory: np.array, [rows, time, rnn_layer_size], encoder output of the sentence of each row
+        @return: (np.array, np.array, list), log probabilities, attention and state of the step
+        '''
+        feed_dict = {self.step_ids: ids, self.step_attention: attention, self.memory: memory,
+                self.memory_mask: np.ones(memory.shape[:2], dtype=bool)}
+        for placeholders, layer_state in zip(self.step_state, state):
+            feed_dict.update(zip(placeholders, layer_state))
+        return self.sess.run((self.log_probs, self.next_attention, self.next_state), feed_dict)
+
+
+def initial_state(encoder_state, sentence_i, rows):
+    '''
+    Decoder state of a sentence repeated for its rows, the encoder state of each layer as Seq2seq passes it
+    '''
+    per_layer = 2 if len(encoder_state) == 2 * N_RNN_LAYERS else 1
+    return [tuple(np.repeat(encoder_state[i * per_layer + j][sentence_i: sentence_i+1], rows, 0) for j in range(per_layer))
+            for i in range(N_RNN_LAYERS)]
+
+
+def greedy_decode(model, memory, state, maximum_iterations):
+    '''
+    GreedyEmbeddingHelper of one sentence, every step run by the session
+    @return: list, answer ids before <EOS>
+    '''
+    ids, attention, answer = np.array([GO_ID]), np.zeros((1, RNN_LAYER_SIZE), np.float32), []
+    for _ in range(maximum_iterations):
+        log_probs, attention, state = model.step(ids, attention, state, memory[None])
+        ids = log_probs.argmax(-1)
+        if ids[0] == EOS_ID:
+            break
+        answer.append(int(ids[0]))
+    return answer
+
+
+def beam_search_decode(model, memory, encoder_state, sentence_i, beam_width, maximum_iterations):
+    '''
+    BeamSearchDecoder of one sentence without length penalty, every step run by the session.
+    Finished beams only extend with <EOS> at no cost, and candidates are ranked by score, ties by beam then by id as top_k.
+    Decoding stops once the best finished beam scores at least the best live one, since live scores only go down
+    @return: list, answer ids of the best beam before <EOS>
+    '''
+    # (score, ids, finished) of each beam, with their attention and state as rows
+    beams = [(0.0, [], False)]
+    attention = np.zeros((1, RNN_LAYER_SIZE), np.float32)
+    state = initial_state(encoder_state, sentence_i, 1)
+    for _ in range(maximum_iterations):
+        ids = np.array([beam[1][-1] if beam[1] else GO_ID for beam in beams])
+        log_probs, next_attention, next_state = model.step(ids, attention, state, np.repeat(memory[None], len(beams), 0))
+        candidates = []
+        for beam_i, (score, beam_ids, finished) in enumerate(beams):
+            if finished:
+                candidates.append((score, beam_ids + [EOS_ID], True, beam_i))
+                continue
+            for word_id, log_prob in enumerate(log_probs[beam_i]):
+                candidates.append((score + log_prob, beam_ids + [word_id], word_id == EOS_ID, beam_i))
+        candidates = sorted(candidates, key=lambda candidate: -candidate[0])[:beam_width]
+
+        beams = [candidate[:3] for candidate in candidates]
+        parents = [candidate[3] for candidate in candidates]
+        attention = next_attention[parents]
+        state = [tuple(part[parents] for part in layer_state) for layer_state in next_state]
+
+        best_finished = max([score for score, _, finished in beams if finished], default=-np.inf)
+        best_live = max([score for score, _, finished in beams if not finished], default=-np.inf)
+        if best_finished >= best_live:
+            break
+    best_ids = beams[0][1]
+    return best_ids[:best_ids.index(EOS_ID)] if EOS_ID in best_ids else best_ids
+
+
+def check(cell_type, sentences, args, seed):
+    '''
+    Run every check on a tiny model of a cell type
+    @cell_type: str, lstm or gru
+    @sentences: list, source sentences
+    @args: argparse.Namespace, check settings
+    @seed: int, seed of the initial weights
+    @return: dict, result of each check, true if it passed, and the max differences of the encoder
+    '''
+    model_dir = tempfile.mkdtemp()
+    model = SessionModel(cell_type, model_dir, seed)
+    numpy_model = NumpySeq2seq(cache_size=0, infer_batch_size=args.infer_batch_size)
+    numpy_model.load(model_dir)
+
+    results = {'checkpoint_reader': sorted(model.weights) == sorted(name for name in numpy_model.weights if name in model.weights)
+            and all(np.array_equal(value, numpy_model.weights[name]) for name, value in model.weights.items())}
+
+    encoder_vocab_to_int = {word: i for i, word in enumerate(ENCODER_WORDS)}
+    inputs = [[encoder_vocab_to_int[word] for word in sentence.split()] for sentence in sentences]
+    inputs_lens = np.array([len(input_ids) for input_ids in inputs])
+    batch_inputs = np.zeros((len(inputs), inputs_lens.max()), dtype=np.int32)
+    for i, input_ids in enumerate(inputs):
+        batch_inputs[i, :len(input_ids)] = input_ids
+    mask = np.arange(batch_inputs.shape[1])[None, :] < inputs_lens[:, None]
+
+    encoder_output, encoder_state = model.encode(batch_inputs, inputs_lens)
+    numpy_output, numpy_state = numpy_model._encode(batch_inputs, inputs_lens, mask)
+    results['encoder_output_diff'] = float(np.abs((numpy_output - encoder_output) * mask[:, :, None]).max())
+    results['encoder_state_diff'] = float(max(np.abs(numpy_part - part).max()
+        for numpy_part, part in zip([part for layer_state in numpy_state for part in layer_state], encoder_state)))
+    results['encoder'] = max(results['encoder_output_diff'], results['encoder_state_diff']) < TOLERANCE
+
+    for beam_width in args.beam_widths:
+        answers = []
+        for i, input_ids in enumerate(inputs):
+            memory = encoder_output[i, :len(input_ids)]
+            if beam_width == 1:
+                answer = greedy_decode(model, memory, initial_state(encoder_state, i, 1), args.max_decode_len)
+            else:
+                answer = beam_search_decode(model, memory, encoder_state, i, beam_width, args.max_decode_len)
+            answers.append(' '.join(DECODER_WORDS[word_id] for word_id in answer))
+        numpy_answers = numpy_model.predict_batch(sentences, beam_width=beam_width, max_decode_len=args.max_decode_len)
+
+        differences = [(sentence, answer, numpy_answer) for sentence, answer, numpy_answer in zip(sentences, answers, numpy_answers) if answer != numpy_answer]
+        results['beam_width {}'.format(beam_width)] = not differences
+        for sentence, answer, numpy_answer in differences[:5]:
+            print('> {}\n  session:      {}\n  NumpySeq2seq: {}'.format(sentence, answer, numpy_answer))
+
+    model.sess.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parity check of NumpySeq2seq against tensorflow sessions on tiny checkpoints')
+    parser.add_argument('--cell_types', nargs='*', default=['lstm', 'gru'], help='Cell types to check, default to lstm and gru')
+    parser.add_argument('--n_sentences', type=int, default=100, help='Random source sentences to decode, default to 100')
+    parser.add_argument('--beam_widths', type=int, nargs='*', default=[1, 2, 4], help='Beam widths to check, built widths of beam_width 4, default to 1 2 4')
+    parser.add_argument('--max_decode_len', type=int, default=12, help='Max length of answers, default to 12')
+    parser.add_argument('--infer_batch_size', type=int, default=8, help='Batch size of NumpySeq2seq, default to 8')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of sentences and weights, default to 0')
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    Seq2seq.set_model_dir(tempfile.mkdtemp())
+    rng = np.random.RandomState(args.seed)
+    sentences = [' '.join(rng.choice(ENCODER_WORDS[3:], rng.randint(1, 8))) for _ in range(args.n_sentences)]
+
+    results = {cell_type: check(cell_type, sentences, args, args.seed) for cell_type in args.cell_types}
+
+    print('| cell | check | result |')
+    print('| ---- | ----- | ------ |')
+    for cell_type, result in results.items():
+        for name, value in result.items():
+            print('| {} | {} | {} |'.format(cell_type, name, value))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    failed = [(cell_type, name) for cell_type, result in results.items() for name, value in result.items() if value is False]
+    if failed:
+        print('Failed on {}'.format(failed))
+        sys.exit(1)
@@ -0,0 +1,132 @@
+'''
+Peak memory and speed of training steps across sequence lengths, for each memory_saving mode.
+
+Every (mode, length) runs in its own process, so the peak of one run never hides the next one.
+The peak resident memory of the process is always reported. On gpu, the peak bytes allocated
+by tensorflow on the device are reported too.
+
+Usage:
+    python benchmarks/peak_memory.py
+    python benchmarks/peak_memory.py --lengths 100 200 400 800 --batch_size 16 --modes none swap
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(args):
+    '''
+    Build the model with given memory saving mode and run training steps of given length
+    @args: argparse.Namespace, benchmark settings with a single mode and length
+    @return: dict, peak memory and step time
+    '''
+    from liteSeq2Seq import tf
+    from liteSeq2Seq import Seq2seq
+    from synthetic import synthetic_dictionary
+
+    Seq2seq.set_model_dir(tempfile.mkdtemp())
+    model = Seq2seq(
+            embedding_dim=args.embedding_dim,
+            rnn_layer_size=args.rnn_layer_size,
+            n_rnn_layers=args.n_rnn_layers,
+            train_batch_size=args.batch_size,
+            memory_saving=args.mode)
+    model.encoder_int_to_vocab, model.encoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model.decoder_int_to_vocab, model.decoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model._build_graph()
+
+    graph = model.graph
+    train_op, cost, _ = graph.get_collection('optimization')
+    with graph.as_default():
+        device_peak = tf.contrib.memory_stats.MaxBytesInUse() if tf.test.is_gpu_available() else None
+
+    rng = np.random.RandomState(0)
+    feed_dict = {
+            graph.get_tensor_by_name('inputs:0'): rng.randint(4, args.vocab_size + 4, size=(args.batch_size, args.length)),
+            graph.get_tensor_by_name('source_lens:0'): [args.length] * args.batch_size,
+            graph.get_tensor_by_name('targets:0'): rng.randint(4, args.vocab_size + 4, size=(args.batch_size, args.length)),
+            graph.get_tensor_by_name('target_lens:0'): [args.length] * args.batch_size,
+            graph.get_tensor_by_name('dropout:0'): model.hyparams.keep_prob,
+            graph.get_tensor_by_name('optimization/learning_rate:0'): model.hyparams.learning_rate,
+            }
+
+    # The first step allocates memory and runs grappler
+    model.sess.run([train_op, cost], feed_dict=feed_dict)
+    start = time.time()
+    for _ in range(args.steps):
+        model.sess.run([train_op, cost], feed_dict=feed_dict)
+    step_time = (time.time() - start) / args.steps
+
+    result = {
+            'mode': args.mode,
+            'length': args.length,
+            'step_sec': step_time,
+            # ru_maxrss is in kilobytes on linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            }
+    if device_peak is not None:
+        result['peak_device_mb'] = model.sess.run(device_peak) / 2**20
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory of training steps across sequence lengths for each memory_saving mode')
+    parser.add_argument('--modes', nargs='*', default=['none', 'swap', 'recompute', 'all'], help='Memory saving modes, default to all of them')
+    parser.add_argument('--lengths', type=int, nargs='*', default=[50, 100, 200, 400], help='Lengths of both source and target, default to 50 100 200 400')
+    parser.add_argument('--embedding_dim', type=int, default=256, help='Embedding size, default to 256')
+    parser.add_argument('--rnn_layer_size', type=int, default=512, help='Rnn layer size, default to 512')
+    parser.add_argument('--n_rnn_layers', type=int, default=2, help='Number of rnn layers, default to 2')
+    parser.add_argument('--vocab_size', type=int, default=10000, help='Vocabulary size of each side, default to 10000')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size, default to 32')
+    parser.add_argument('--steps', type=int, default=5, help='Timed steps, default to 5')
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    parser.add_argument('--length', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        # Worker process of a single run
+        print(json.dumps(measure(args)))
+        sys.exit(0)
+
+    results = []
+    for mode in args.modes:
+        for length in args.lengths:
+            command = [sys.executable, os.path.abspath(__file__), '--mode', mode, '--length', str(length),
+                    '--embedding_dim', str(args.embedding_dim), '--rnn_layer_size', str(args.rnn_layer_size),
+                    '--n_rnn_layers', str(args.n_rnn_layers), '--vocab_size', str(args.vocab_size),
+                    '--batch_size', str(args.batch_size), '--steps', str(args.steps)]
+            process = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+            if process.returncode != 0:
+                # Most likely out of memory
+                results.append({'mode': mode, 'length': length, 'error': 'exit code {}'.format(process.returncode)})
+            else:
+                results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+            print(results[-1], flush=True)
+
+    print('| mode | length | step (s) | peak rss (MB) | peak device (MB) |')
+    print('| ---- | ------ | -------- | ------------- | ---------------- |')
+    for result in results:
+        if 'error' in result:
+            print('| {mode} | {length} | {error} | | |'.format(**result))
+        else:
+            print('| {} | {} | {:.3f} | {:.0f} | {} |'.format(result['mode'], result['length'], result['step_sec'], result['peak_rss_mb'],
+                '{:.0f}'.format(result['peak_device_mb']) if 'peak_device_mb' in result else '-'))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
@@ -0,0 +1,115 @@
+'''
+Throughput and memory of PredictorPool against number of workers.
+
+An untrained model of synthetic vocabulary is exported once, then a pool of each size predicts the same sentences.
+Memory of the workers is read from /proc/<pid>/smaps_rollup (linux only) between calls: pss splits shared pages between
+the processes sharing them, so the pss sum of all workers is what they really use. The shared weight files are mapped only
+while a run lasts, so they are not in these numbers, while anything a worker keeps for itself, e.g. reordered weights of oneDNN matmuls, is.
+
+Usage:
+    python benchmarks/predictor_pool.py
+    python benchmarks/predictor_pool.py --workers 1 2 4 8 --infer_batch_size 1 --rnn_layer_size 512 --n_rnn_layers 2
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from liteSeq2Seq import PredictorPool
+from synthetic import synthetic_dictionary
+from synthetic import sample_lengths
+from synthetic import sample_words
+
+
+def export_model(args, export_dir):
+    '''
+    Build an untrained model and export it, run in its own process
+    '''
+    from liteSeq2Seq import Seq2seq
+
+    Seq2seq.set_model_dir(tempfile.mkdtemp())
+    model = Seq2seq(embedding_dim=args.embedding_dim, rnn_layer_size=args.rnn_layer_size, n_rnn_layers=args.n_rnn_layers)
+    model.encoder_int_to_vocab, model.encoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model.decoder_int_to_vocab, model.decoder_vocab_to_int = synthetic_dictionary(args.vocab_size)
+    model._build_graph()
+    model.export(export_dir)
+
+
+def memory_mb(pid):
+    '''
+    @pid: int, the process id
+    @return: (float, float), rss and pss of the process in MB
+    '''
+    values = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as fp:
+        for line in fp:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                values[key] = int(value.split()[0]) / 1024
+    return values['Rss'], values['Pss']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput and memory of PredictorPool against number of workers')
+    parser.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4], help='Pool sizes to test, default to 1 2 4')
+    parser.add_argument('--infer_batch_size', type=int, default=1, help='Inputs sent to a worker at once, default to 1')
+    parser.add_argument('--n_sentences', type=int, default=256, help='Sentences predicted by each pool, default to 256')
+    parser.add_argument('--embedding_dim', type=int, default=256, help='Embedding size, default to 256')
+    parser.add_argument('--rnn_layer_size', type=int, default=512, help='Rnn layer size, default to 512')
+    parser.add_argument('--n_rnn_layers', type=int, default=2, help='Number of rnn layers, default to 2')
+    parser.add_argument('--vocab_size', type=int, default=20000, help='Vocabulary size of each side, default to 20000')
+    parser.add_argument('--mean_len', type=int, default=10, help='Mean length of sentences, default to 10')
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    export_dir = os.path.join(tempfile.mkdtemp(), 'exported')
+    process = multiprocessing.get_context('spawn').Process(target=export_model, args=(args, export_dir))
+    process.start()
+    process.join()
+
+    rng = np.random.RandomState(0)
+    lens = sample_lengths(args.n_sentences, 'poisson', args.mean_len, 4 * args.mean_len, rng)
+    words = sample_words(int(lens.sum()), args.vocab_size, 1.1, rng)
+    sentences = [' '.join('w{}'.format(i) for i in sentence) for sentence in np.split(words, np.cumsum(lens)[:-1])]
+
+    results = []
+    for n_workers in args.workers:
+        with PredictorPool(export_dir, n_workers, infer_batch_size=args.infer_batch_size, cache_size=0) as pool:
+            with open(os.path.join(export_dir, 'shared', 'weights.json')) as fp:
+                weights_mb = sum(os.path.getsize(os.path.join(export_dir, 'shared', filename)) for filename in json.load(fp).values()) / 2**20
+            # Warm up every worker
+            pool.predict_batch(sentences[:n_workers * args.infer_batch_size])
+
+            start = time.time()
+            pool.predict_batch(sentences)
+            sec = time.time() - start
+
+            memories = [memory_mb(worker.pid) for worker in pool.workers]
+            results.append({
+                'workers': n_workers,
+                'sentences_per_sec': len(sentences) / sec,
+                'weights_mb': weights_mb,
+                'worker_rss_mb': float(np.mean([rss for rss, _ in memories])),
+                'total_pss_mb': sum(pss for _, pss in memories),
+                })
+        print(results[-1], flush=True)
+
+    print('| workers | sentences/sec | weights (MB) | rss per worker (MB) | pss of all workers (MB) |')
+    print('| ------- | ------------- | ------------ | ------------------- | ----------------------- |')
+    for result in results:
+        print('| {workers} | {sentences_per_sec:.1f} | {weights_mb:.0f} | {worker_rss_mb:.0f} | {total_pss_mb:.0f} |'.format(**result))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
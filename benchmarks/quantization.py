@@ -0,0 +1,98 @@
+'''
+Size, latency and bleu of int8 quantized export against float32 export of a trained model.
+
+The model is exported twice, with and without quantize, then each export is loaded and predicts a held-out set:
+single sentence latency, batched throughput and corpus bleu against the references. Deltas are relative to float32.
+int8 weights are turned back into float32 at load, so only the size is expected to shrink, and latency should match float32.
+
+Usage:
+    python benchmarks/quantization.py --model ./models/model_id --enc test_enc --dec test_dec
+    python benchmarks/quantization.py --model ./models/model_id --enc test_enc --dec test_dec --n_sentences 2000 --output quantization.json
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from liteSeq2Seq import Seq2seq
+from liteSeq2Seq import TextProcessor
+from suite import latency_summary
+from suite import timed
+
+
+def measure(export_dir, sources, references, args):
+    '''
+    Load an export and predict the held-out set
+    @export_dir: str, the export directory
+    @sources: list, source sentences
+    @references: list, processed reference sentences
+    @args: argparse.Namespace, benchmark settings
+    @return: dict, size, load time, latency, throughput and bleu
+    '''
+    model = Seq2seq(cache_size=0, infer_batch_size=args.infer_batch_size)
+    _, load_sec = timed(model.load, export_dir)
+
+    for source in sources[:3]:
+        model.predict(source)
+    latency = latency_summary([timed(model.predict, source)[1] for source in sources[:args.latency_samples]])
+    predictions, predict_sec = timed(model.predict_batch, sources)
+
+    unk_id = model.decoder_vocab_to_int['<UNK>']
+    to_ids = lambda line: [model.decoder_vocab_to_int.get(word, unk_id) for word in line.split()]
+    bleu = model._bleu([to_ids(line) for line in predictions], [to_ids(line) for line in references])
+    model.sess.close()
+
+    return {
+            'size_mb': os.path.getsize(os.path.join(export_dir, 'frozen_graph.pb')) / 2**20,
+            'load_sec': load_sec,
+            'latency': latency,
+            'sentences_per_sec': len(sources) / predict_sec,
+            'bleu': float(bleu),
+            }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Size, latency and bleu of int8 quantized export against float32')
+    parser.add_argument('--model', required=True, help='Path of the trained model')
+    parser.add_argument('--enc', required=True, help='Held-out source file')
+    parser.add_argument('--dec', required=True, help='Held-out reference file')
+    parser.add_argument('--n_sentences', type=int, default=1000, help='Sentences of the held-out set to use, default to 1000')
+    parser.add_argument('--latency_samples', type=int, default=100, help='Sentences predicted one by one for latency, default to 100')
+    parser.add_argument('--infer_batch_size', type=int, default=32, help='Batch size of batched throughput, default to 32')
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    tp = TextProcessor()
+    with open(args.enc) as fp:
+        sources = [line.strip() for line in fp][:args.n_sentences]
+    with open(args.dec) as fp:
+        references = [tp.process_str(line.strip()) for line in fp][:args.n_sentences]
+
+    work_dir = tempfile.mkdtemp()
+    model = Seq2seq()
+    model.load(args.model)
+    model.export(os.path.join(work_dir, 'float32'))
+    model.export(os.path.join(work_dir, 'int8'), quantize=True)
+    model.sess.close()
+
+    results = {name: measure(os.path.join(work_dir, name), sources, references, args) for name in ('float32', 'int8')}
+    for name in ('float32', 'int8'):
+        print(name, results[name], flush=True)
+
+    print('| export | size (MB) | load (s) | p50 (ms) | p99 (ms) | sentences/sec | bleu | bleu delta |')
+    print('| ------ | --------- | -------- | -------- | -------- | ------------- | ---- | ---------- |')
+    for name, result in results.items():
+        print('| {} | {:.1f} | {:.2f} | {:.1f} | {:.1f} | {:.1f} | {:.4f} | {:+.4f} |'.format(
+            name, result['size_mb'], result['load_sec'], result['latency']['p50_ms'], result['latency']['p99_ms'],
+            result['sentences_per_sec'], result['bleu'], result['bleu'] - results['float32']['bleu']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
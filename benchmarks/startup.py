@@ -0,0 +1,158 @@
+'''
+Wall time of each command line mode in a fresh process, from start to exit.
+
+Imports are timed with and without tensorflow loaded: --help, TextProcessor and the data utilities should not pay for it.
+Unless --model is given, a tiny model is trained on a synthetic corpus first, and that training is timed too.
+The model is then used to predict with a session and with NumpySeq2seq, exported, and the export is used the same way.
+Serving is timed until /health of the first worker answers.
+
+Usage:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --model ./models/model_id --repeats 5 --output startup.json
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import tempfile
+import subprocess
+from urllib.request import urlopen
+from urllib.error import URLError
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(ROOT_DIR, 'liteSeq2Seq.py')
+sys.path.insert(0, ROOT_DIR)
+from synthetic import generate_corpus
+
+IMPORT_SCRIPT = '''
+import sys
+{statement}
+print('tensorflow' in sys.modules)
+'''
+
+# Small enough that training and loading are dominated by startup, not by the model
+TINY_HYPARAMS = ['--embedding_dim', '16', '--rnn_layer_size', '16', '--n_rnn_layers', '1', '--beam_width', '3',
+        '--train_batch_size', '16']
+
+
+def run(argv, cwd):
+    '''
+    Run a command to its end
+    @argv: list, the command
+    @cwd: str, the working directory
+    @return: (float, str), seconds and the standard output
+    '''
+    start = time.time()
+    output = subprocess.check_output(argv, cwd=cwd, stderr=subprocess.DEVNULL)
+    return time.time() - start, output.decode()
+
+
+def serve(model_path, cwd, timeout=300):
+    '''
+    Start serving and stop it once /health answers
+    @model_path: str, the model to serve
+    @cwd: str, the working directory
+    @timeout: float, seconds to wait for /health
+    @return: float, seconds until /health answered
+    '''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    start = time.time()
+    process = subprocess.Popen([sys.executable, CLI, '--model', model_path, '--serve', str(port), '--workers', '1'],
+            cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.time() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError('Serving exited with code {}'.format(process.returncode))
+            try:
+                urlopen('http://127.0.0.1:{}/health'.format(port), timeout=1).read()
+                return time.time() - start
+            except (URLError, ConnectionError, socket.timeout):
+                time.sleep(0.05)
+        raise RuntimeError('/health did not answer in {} seconds'.format(timeout))
+    finally:
+        # The server stops its workers on interrupt
+        process.send_signal(signal.SIGINT)
+        process.wait()
+
+
+def train(work_dir, n_pairs, steps):
+    '''
+    Train a tiny model on a synthetic corpus with the command line
+    @work_dir: str, the working directory, the corpus is written in it and the model is saved in its models directory
+    @n_pairs: int, sentence pairs of the corpus
+    @steps: int, training steps
+    @return: (float, str), seconds and the path of the model
+    '''
+    encode_path, decode_path = generate_corpus(work_dir, n_pairs=n_pairs, vocab_size=200, mean_len=8, max_len=20)
+    sec, _ = run([sys.executable, CLI, '--enc', encode_path, '--dec', decode_path, '--id', 'tiny', '--max_global_step', str(steps)] + TINY_HYPARAMS, work_dir)
+    return sec, os.path.join(work_dir, 'models', 'tiny')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Wall time of each command line mode in a fresh process')
+    parser.add_argument('--model', help='Path of a trained model, default to train a tiny one')
+    parser.add_argument('--input', default='s1 s2 s3', help='Sentence to predict, default to "s1 s2 s3"')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs of each mode, the median is reported, default to 3')
+    parser.add_argument('--n_pairs', type=int, default=500, help='Sentence pairs of the synthetic corpus, default to 500')
+    parser.add_argument('--steps', type=int, default=20, help='Training steps of the tiny model, default to 20')
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    results = {}
+
+    imports = [
+            ('import TextProcessor', 'from liteSeq2Seq import TextProcessor'),
+            ('import liteSeq2Seq', 'import liteSeq2Seq'),
+            ('import tensorflow', 'import tensorflow'),
+            ]
+    for name, statement in imports:
+        runs = [run([sys.executable, '-c', IMPORT_SCRIPT.format(statement=statement)], ROOT_DIR) for _ in range(args.repeats)]
+        results[name] = {'sec': float(np.median([sec for sec, _ in runs])), 'tensorflow': runs[0][1].split()[-1] == 'True'}
+        print(name, results[name], flush=True)
+
+    if args.model:
+        model_path = os.path.abspath(args.model)
+    else:
+        sec, model_path = train(work_dir, args.n_pairs, args.steps)
+        results['train {} steps'.format(args.steps)] = {'sec': sec}
+    export_path = os.path.join(work_dir, 'exported')
+
+    modes = [
+            ('--help', [CLI, '--help']),
+            ('--input', [CLI, '--model', model_path, '--input', args.input]),
+            ('--input --numpy', [CLI, '--model', model_path, '--input', args.input, '--numpy']),
+            ('--export', [CLI, '--model', model_path, '--export', export_path]),
+            ('exported --input', [CLI, '--model', export_path, '--input', args.input]),
+            ('exported --input --numpy', [CLI, '--model', export_path, '--input', args.input, '--numpy']),
+            ]
+    for name, argv in modes:
+        results[name] = {'sec': float(np.median([run([sys.executable] + argv, work_dir)[0] for _ in range(args.repeats)]))}
+        print(name, results[name], flush=True)
+
+    for name, path in (('--serve', model_path), ('exported --serve', export_path)):
+        results[name] = {'sec': float(np.median([serve(path, work_dir) for _ in range(args.repeats)]))}
+        print(name, results[name], flush=True)
+
+    print('| mode | seconds | tensorflow loaded |')
+    print('| ---- | ------- | ----------------- |')
+    for name, result in results.items():
+        loaded = {True: 'yes', False: 'no'}.get(result.get('tensorflow'), '')
+        print('| {} | {:.2f} | {} |'.format(name, result['sec'], loaded))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
@@ -0,0 +1,200 @@
+'''
+Reproducible benchmark suite on synthetic corpora.
+
+A synthetic parallel corpus is generated with given vocabulary size and length distribution, then each stage is timed:
+TextProcessor.process, _parse_dict, _parse_seq, _padding_batch, graph building, training steps,
+single predict latency and predict_batch throughput. Results are printed and saved as JSON,
+use benchmarks/compare.py to compare two results, e.g. of two commits or two presets.
+Tensorflow is forced on cpu, so results of different machines are comparable only roughly.
+
+Usage:
+    python benchmarks/suite.py --preset tiny --output tiny.json
+    python benchmarks/suite.py --preset small --vocab_size 20000 --length_dist lognormal --mean_len 30 --output small.json
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+# Benchmark on cpu only
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+import liteSeq2Seq
+from liteSeq2Seq import Seq2seq
+from liteSeq2Seq import TextProcessor
+from synthetic import generate_corpus
+
+
+# Hyperparameter presets, 'default' uses the default hyperparameters of Seq2seq
+PRESETS = {
+        'tiny': dict(embedding_dim=64, rnn_layer_size=128, n_rnn_layers=1),
+        'small': dict(embedding_dim=256, rnn_layer_size=512, n_rnn_layers=2),
+        'default': dict(),
+        }
+
+
+def git_commit():
+    '''
+    Commit of the working tree, None if not available
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency_summary(latencies):
+    '''
+    Summarize latencies in seconds as milliseconds
+    '''
+    latencies = np.array(latencies) * 1e3
+    return {
+            'mean_ms': float(np.mean(latencies)),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p90_ms': float(np.percentile(latencies, 90)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            }
+
+
+def timed(fn, *args, **kwargs):
+    '''
+    Call fn and return (result, seconds)
+    '''
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+def run_suite(args):
+    work_dir = tempfile.mkdtemp()
+    results = {}
+
+    # Corpus
+    (encode_path, decode_path), results['generate_corpus_sec'] = timed(
+            generate_corpus, os.path.join(work_dir, 'corpus'), n_pairs=args.n_pairs, vocab_size=args.vocab_size,
+            length_dist=args.length_dist, mean_len=args.mean_len, max_len=args.max_len, seed=args.seed)
+
+    # Text processing
+    tp = TextProcessor()
+    _, process_time = timed(lambda: [tp.read(path).process(inplace=False) for path in (encode_path, decode_path)])
+    results['text_process'] = {'sec': process_time, 'lines_per_sec': 2 * args.n_pairs / process_time}
+
+    Seq2seq.set_model_dir(os.path.join(work_dir, 'models'))
+    model = Seq2seq(train_batch_size=args.batch_size, **PRESETS[args.preset])
+
+    # Dictionary and sequences
+    (model.encoder_int_to_vocab, model.encoder_vocab_to_int), encode_dict_time = timed(model._parse_dict, encode_path)
+    (model.decoder_int_to_vocab, model.decoder_vocab_to_int), decode_dict_time = timed(model._parse_dict, decode_path)
+    results['parse_dict'] = {'sec': encode_dict_time + decode_dict_time, 'lines_per_sec': 2 * args.n_pairs / (encode_dict_time + decode_dict_time)}
+
+    seqs_gen = model._parse_seq(encode_path, decode_path, model.encoder_vocab_to_int, model.decoder_vocab_to_int, n_buckets=model.hyparams.n_buckets)
+    (encode_seqs, decode_seqs), parse_seq_time = timed(next, seqs_gen)
+    results['parse_seq'] = {'sec': parse_seq_time, 'pairs_per_sec': args.n_pairs / parse_seq_time, 'n_pairs_kept': len(encode_seqs)}
+
+    encode_pad_id = model.encoder_vocab_to_int['<PAD>']
+    decode_pad_id = model.decoder_vocab_to_int['<PAD>']
+    batches, padding_time = timed(lambda: list(model._padding_batch(encode_seqs, decode_seqs, args.batch_size, encode_pad_id, decode_pad_id)))
+    n_real_tokens = sum(map(len, encode_seqs)) + sum(map(len, decode_seqs))
+    n_padded_tokens = sum(inputs.size + targets.size for inputs, _, targets, _ in batches)
+    results['padding_batch'] = {
+            'sec': padding_time,
+            'batches_per_sec': len(batches) / padding_time,
+            'padding_ratio': 1.0 - n_real_tokens / n_padded_tokens,
+            }
+
+    # Training
+    _, results['build_graph_sec'] = timed(model._build_graph)
+    graph = model.graph
+    train_op, cost, _ = graph.get_collection('optimization')
+    feeds = [graph.get_tensor_by_name(name) for name in ('inputs:0', 'source_lens:0', 'targets:0', 'target_lens:0')]
+    keep_prob = graph.get_tensor_by_name('dropout:0')
+    lr = graph.get_tensor_by_name('optimization/learning_rate:0')
+
+    # Batches are shuffled, so that timed steps cover all lengths rather than the shortest buckets
+    order = np.random.RandomState(args.seed).permutation(len(batches))
+    step_batches = [batches[order[i % len(batches)]] for i in range(args.warmup + args.train_steps)]
+    step_times = []
+    n_tokens = 0
+    for step_i, batch in enumerate(step_batches):
+        feed_dict = dict(zip(feeds, batch))
+        feed_dict.update({keep_prob: model.hyparams.keep_prob, lr: model.hyparams.learning_rate})
+        _, step_time = timed(model.sess.run, [train_op, cost], feed_dict=feed_dict)
+        if step_i >= args.warmup:
+            step_times.append(step_time)
+            n_tokens += batch[0].size + batch[2].size
+    results['train'] = {
+            'steps_per_sec': len(step_times) / sum(step_times),
+            'examples_per_sec': len(step_times) * args.batch_size / sum(step_times),
+            'padded_tokens_per_sec': n_tokens / sum(step_times),
+            'step': latency_summary(step_times),
+            }
+
+    # Inference, the model is untrained, so output lengths are close to the max iterations
+    with open(encode_path, 'r') as fp:
+        lines = [line.strip() for line in fp.readlines()[:args.predict_samples]]
+    for line in lines[:args.warmup]:
+        model.predict(line)
+    results['predict'] = latency_summary([timed(model.predict, line)[1] for line in lines])
+
+    results['batched_predict'] = {}
+    for batch_size in args.predict_batch_sizes:
+        model.hyparams = model.hyparams._replace(infer_batch_size=batch_size)
+        _, predict_time = timed(model.predict_batch, lines)
+        results['batched_predict'][str(batch_size)] = {'sec': predict_time, 'sentences_per_sec': len(lines) / predict_time}
+
+    model.sess.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of lite-seq2seq on a synthetic corpus')
+    parser.add_argument('--preset', default='tiny', choices=sorted(PRESETS), help='Hyperparameter preset, default to tiny')
+    parser.add_argument('--n_pairs', type=int, default=20000, help='Number of sentence pairs, default to 20000')
+    parser.add_argument('--vocab_size', type=int, default=5000, help='Vocabulary size of each side, default to 5000')
+    parser.add_argument('--length_dist', default='poisson', choices=['fixed', 'uniform', 'poisson', 'lognormal'], help='Distribution of sentence lengths, default to poisson')
+    parser.add_argument('--mean_len', type=int, default=15, help='Mean sentence length, default to 15')
+    parser.add_argument('--max_len', type=int, default=60, help='Max sentence length, default to 60')
+    parser.add_argument('--batch_size', type=int, default=32, help='Training batch size, default to 32')
+    parser.add_argument('--train_steps', type=int, default=50, help='Timed training steps, default to 50')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed steps and predictions before measuring, default to 3')
+    parser.add_argument('--predict_samples', type=int, default=64, help='Sentences used for inference timing, default to 64')
+    parser.add_argument('--predict_batch_sizes', type=int, nargs='*', default=[1, 8, 32], help='Batch sizes of batched inference, default to 1 8 32')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the corpus, default to 0')
+    parser.add_argument('--output', help='Path to save the JSON result')
+    args = parser.parse_args()
+
+    results = run_suite(args)
+
+    report = {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'machine': {
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'tensorflow': liteSeq2Seq.tf.__version__,
+                'numpy': np.__version__,
+                'cpu_count': multiprocessing.cpu_count(),
+                },
+            'preset': args.preset,
+            'settings': vars(args),
+            'results': results,
+            }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
@@ -0,0 +1,106 @@
+'''
+Synthetic parallel corpora and dictionaries for benchmarks.
+
+Words are drawn from a zipf distribution over the vocabulary, like words of natural language,
+so that vocab_remain_rate behaves as on real data. Target sentences are noisy copies of
+source sentences, thus a model can actually learn something from them.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+
+SPECIAL_TOKENS = ['<PAD>', '<UNK>', '<GO>', '<EOS>']
+
+
+def synthetic_dictionary(vocab_size):
+    '''
+    Build a dictionary of {vocab_size} fake words plus the special tokens
+    @vocab_size: int, number of words
+    @return: (dict, dict), int_to_vocab and vocab_to_int
+    '''
+    vocabs = SPECIAL_TOKENS + ['w{}'.format(i) for i in range(vocab_size)]
+    return {i:word for i, word in enumerate(vocabs)}, {word:i for i, word in enumerate(vocabs)}
+
+
+def sample_lengths(n, length_dist, mean_len, max_len, rng):
+    '''
+    Sample sentence lengths
+    @n: int, number of lengths
+    @length_dist: str, 'fixed', 'uniform', 'poisson' or 'lognormal'(long tail, like chat and summarization data)
+    @mean_len: int, mean length
+    @max_len: int, lengths are clipped into [1, max_len]
+    @rng: np.random.RandomState
+    @return: np.array, int array of lengths
+    '''
+    if length_dist == 'fixed':
+        lens = np.full(n, mean_len)
+    elif length_dist == 'uniform':
+        lens = rng.randint(1, 2 * mean_len, size=n)
+    elif length_dist == 'poisson':
+        lens = rng.poisson(mean_len, size=n)
+    elif length_dist == 'lognormal':
+        sigma = 0.6
+        lens = np.round(rng.lognormal(np.log(mean_len) - sigma ** 2 / 2, sigma, size=n))
+    else:
+        raise ValueError('Unknown length distribution {}'.format(length_dist))
+    return np.clip(lens, 1, max_len).astype(np.int64)
+
+
+def sample_words(n, vocab_size, zipf_a, rng):
+    '''
+    Sample word ids in [0, vocab_size) from a zipf distribution
+    '''
+    ranks = np.arange(1, vocab_size + 1, dtype=np.float64)
+    probs = ranks ** -zipf_a
+    return rng.choice(vocab_size, size=n, p=probs / probs.sum())
+
+
+def generate_corpus(directory, n_pairs=10000, vocab_size=5000, length_dist='poisson', mean_len=15, max_len=60,
+        zipf_a=1.1, noise=0.2, seed=0):
+    '''
+    Write a synthetic parallel corpus of two files, one sentence each line
+    @directory: str, the directory to write enc and dec files in
+    @n_pairs: int, number of sentence pairs
+    @vocab_size: int, number of distinct words of each side
+    @length_dist: str, distribution of source sentence lengths, see sample_lengths
+    @mean_len: int, mean length of source sentences
+    @max_len: int, max length of sentences
+    @zipf_a: float, exponent of zipf distribution of words
+    @noise: float, probability to replace a word of target sentence and to drop or add a word at its end
+    @seed: int, random seed, the same arguments always give the same corpus
+    @return: (str, str), paths of encode file and decode file
+    '''
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    encode_lens = sample_lengths(n_pairs, length_dist, mean_len, max_len, rng)
+    encode_words = sample_words(int(encode_lens.sum()), vocab_size, zipf_a, rng)
+
+    encode_path = os.path.join(directory, 'enc')
+    decode_path = os.path.join(directory, 'dec')
+    with open(encode_path, 'w') as encode_fp, open(decode_path, 'w') as decode_fp:
+        start = 0
+        for encode_len in encode_lens:
+            source = encode_words[start: start+encode_len]
+            start += encode_len
+
+            # Target is a shifted copy with a few replaced words, lengths differ slightly
+            target = (source + 1) % vocab_size
+            replaced = rng.rand(len(target)) < noise
+            target[replaced] = sample_words(int(replaced.sum()), vocab_size, zipf_a, rng)
+            if rng.rand() < noise and len(target) > 1:
+                target = target[:-1]
+            elif rng.rand() < noise and len(target) < max_len:
+                target = np.append(target, sample_words(1, vocab_size, zipf_a, rng))
+
+            encode_fp.write(' '.join(['s{}'.format(i) for i in source]) + '\n')
+            decode_fp.write(' '.join(['t{}'.format(i) for i in target]) + '\n')
+
+    return encode_path, decode_path
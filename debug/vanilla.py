@@ -141,13 +141,6 @@ def text_to_ids(source_text, target_text, source_vocab_to_int, target_vocab_to_i
 
 
 
-source_path = 'data/test_en_fr/small_vocab_en'
-target_path = 'data/test_en_fr/small_vocab_fr'
-source_text = load_data(source_path)
-target_text = load_data(target_path)
-preprocess_and_save_data(source_path, target_path, text_to_ids)
-(source_int_text, target_int_text), (source_vocab_to_int, target_vocab_to_int), _ = load_preprocess()
-
 
 def model_inputs():
     """
@@ -322,52 +315,66 @@ def seq2seq_model(input_data, target_data, keep_prob, batch_size,
                    batch_size, keep_prob, dec_embedding_size)
 
 
-save_path = 'checkpoints/dev'
-(source_int_text, target_int_text), (source_vocab_to_int, target_vocab_to_int), _ = load_preprocess()
-max_target_sentence_length = max([len(sentence) for sentence in source_int_text])
 
-train_graph = tf.Graph()
-with train_graph.as_default():
-    input_data, targets, lr, keep_prob, target_sequence_length, max_target_sequence_length, source_sequence_length = model_inputs()
+def build_graph(source_vocab_size, target_vocab_to_int, batch_size=None,
+                rnn_size=rnn_size, num_layers=num_layers,
+                encoding_embedding_size=encoding_embedding_size, decoding_embedding_size=decoding_embedding_size):
+    """
+    Build the training and inference graph of the vanilla seq2seq
+    :param source_vocab_size: Source vocabulary size
+    :param target_vocab_to_int: Dictionary to go from the target words to an id
+    :param batch_size: Batch Size, None to take it from the input at run time
+    :param rnn_size: RNN Size
+    :param num_layers: Number of layers
+    :param encoding_embedding_size: Encoder embedding size
+    :param decoding_embedding_size: Decoder embedding size
+    :return: Tuple (graph, (input, targets, learning rate, keep probability, target sequence length,
+    source sequence length, inference predictions, cost, train op))
+    """
+    train_graph = tf.Graph()
+    with train_graph.as_default():
+        input_data, targets, lr, keep_prob, target_sequence_length, max_target_sequence_length, source_sequence_length = model_inputs()
 
-    #sequence_length = tf.placeholder_with_default(max_target_sentence_length, None, name='sequence_length')
-    input_shape = tf.shape(input_data)
+        #sequence_length = tf.placeholder_with_default(max_target_sentence_length, None, name='sequence_length')
+        input_shape = tf.shape(input_data)
 
-    train_logits, inference_logits = seq2seq_model(tf.reverse(input_data, [-1]),
-                                                   targets,
-                                                   keep_prob,
-                                                   batch_size,
-                                                   source_sequence_length,
-                                                   target_sequence_length,
-                                                   max_target_sequence_length,
-                                                   len(source_vocab_to_int),
-                                                   len(target_vocab_to_int),
-                                                   encoding_embedding_size,
-                                                   decoding_embedding_size,
-                                                   rnn_size,
-                                                   num_layers,
-                                                   target_vocab_to_int)
+        train_logits, inference_logits = seq2seq_model(tf.reverse(input_data, [-1]),
+                                                       targets,
+                                                       keep_prob,
+                                                       batch_size if batch_size is not None else tf.shape(input_data)[0],
+                                                       source_sequence_length,
+                                                       target_sequence_length,
+                                                       max_target_sequence_length,
+                                                       source_vocab_size,
+                                                       len(target_vocab_to_int),
+                                                       encoding_embedding_size,
+                                                       decoding_embedding_size,
+                                                       rnn_size,
+                                                       num_layers,
+                                                       target_vocab_to_int)
 
 
-    training_logits = tf.identity(train_logits.rnn_output, name='logits')
-    inference_logits = tf.identity(inference_logits.sample_id, name='predictions')
+        training_logits = tf.identity(train_logits.rnn_output, name='logits')
+        inference_logits = tf.identity(inference_logits.sample_id, name='predictions')
 
-    masks = tf.sequence_mask(target_sequence_length, max_target_sequence_length, dtype=tf.float32, name='masks')
+        masks = tf.sequence_mask(target_sequence_length, max_target_sequence_length, dtype=tf.float32, name='masks')
 
-    with tf.name_scope("optimization"):
-        # Loss function
-        cost = tf.contrib.seq2seq.sequence_loss(
-            training_logits,
-            targets,
-            masks)
+        with tf.name_scope("optimization"):
+            # Loss function
+            cost = tf.contrib.seq2seq.sequence_loss(
+                training_logits,
+                targets,
+                masks)
 
-        # Optimizer
-        optimizer = tf.train.AdamOptimizer(lr)
+            # Optimizer
+            optimizer = tf.train.AdamOptimizer(lr)
 
-        # Gradient Clipping
-        gradients = optimizer.compute_gradients(cost)
-        capped_gradients = [(tf.clip_by_value(grad, -1., 1.), var) for grad, var in gradients if grad is not None]
-        train_op = optimizer.apply_gradients(capped_gradients)
+            # Gradient Clipping
+            gradients = optimizer.compute_gradients(cost)
+            capped_gradients = [(tf.clip_by_value(grad, -1., 1.), var) for grad, var in gradients if grad is not None]
+            train_op = optimizer.apply_gradients(capped_gradients)
+
+    return train_graph, (input_data, targets, lr, keep_prob, target_sequence_length, source_sequence_length, inference_logits, cost, train_op)
 
 
 def pad_sentence_batch(sentence_batch, pad_int):
@@ -419,74 +426,6 @@ def get_accuracy(target, logits):
 
     return np.mean(np.equal(target, logits))
 
-# Split data to training and validation sets
-train_source = source_int_text[batch_size:]
-train_target = target_int_text[batch_size:]
-valid_source = source_int_text[:batch_size]
-valid_target = target_int_text[:batch_size]
-(valid_sources_batch, valid_targets_batch, valid_sources_lengths, valid_targets_lengths ) = next(get_batches(valid_source,
-                                                                                                             valid_target,
-                                                                                                             batch_size,
-                                                                                                             source_vocab_to_int['<PAD>'],
-                                                                                                             target_vocab_to_int['<PAD>']))                                                                                                  
-with tf.Session(graph=train_graph) as sess:
-    sess.run(tf.global_variables_initializer())
-
-    for epoch_i in range(epochs):
-        for batch_i, (source_batch, target_batch, sources_lengths, targets_lengths) in enumerate(
-                get_batches(train_source, train_target, batch_size,
-                            source_vocab_to_int['<PAD>'],
-                            target_vocab_to_int['<PAD>'])):
-#             print(source_batch)
-#             print(target_batch)
-#             print(sources_lengths)
-#             print(targets_lengths)
-
-            _, loss = sess.run(
-                [train_op, cost],
-                {input_data: source_batch,
-                 targets: target_batch,
-                 lr: learning_rate,
-                 target_sequence_length: targets_lengths,
-                 source_sequence_length: sources_lengths,
-                 keep_prob: keep_probability})
-
-
-            if batch_i % display_step == 0 and batch_i > 0:
-
-
-                batch_train_logits = sess.run(
-                    inference_logits,
-                    {input_data: source_batch,
-                     source_sequence_length: sources_lengths,
-                     target_sequence_length: targets_lengths,
-                     keep_prob: 1.0})
-
-
-                batch_valid_logits = sess.run(
-                    inference_logits,
-                    {input_data: valid_sources_batch,
-                     source_sequence_length: valid_sources_lengths,
-                     target_sequence_length: valid_targets_lengths,
-                     keep_prob: 1.0})
-
-                train_acc = get_accuracy(target_batch, batch_train_logits)
-
-                valid_acc = get_accuracy(valid_targets_batch, batch_valid_logits)
-
-                print('Epoch {:>3} Batch {:>4}/{} - Train Accuracy: {:>6.4f}, Validation Accuracy: {:>6.4f}, Loss: {:>6.4f}'
-                      .format(epoch_i, batch_i, len(source_int_text) // batch_size, train_acc, valid_acc, loss))
-
-    # Save Model
-    saver = tf.train.Saver()
-    saver.save(sess, save_path)
-    print('Model Trained and Saved')
-
-# Save parameters for checkpoint
-save_params(save_path)
-
-_, (source_vocab_to_int, target_vocab_to_int), (source_int_to_vocab, target_int_to_vocab) = load_preprocess()
-load_path = load_params()
 
 def sentence_to_seq(sentence, vocab_to_int):
     """
@@ -501,33 +440,115 @@ def sentence_to_seq(sentence, vocab_to_int):
     return word_list
 
 
-translate_sentence = 'he saw a old yellow truck .'
+if __name__ == '__main__':
+    source_path = 'data/test_en_fr/small_vocab_en'
+    target_path = 'data/test_en_fr/small_vocab_fr'
+    source_text = load_data(source_path)
+    target_text = load_data(target_path)
+    preprocess_and_save_data(source_path, target_path, text_to_ids)
+    (source_int_text, target_int_text), (source_vocab_to_int, target_vocab_to_int), _ = load_preprocess()
+
+    save_path = 'checkpoints/dev'
+    max_target_sentence_length = max([len(sentence) for sentence in source_int_text])
+
+    train_graph, (input_data, targets, lr, keep_prob, target_sequence_length, source_sequence_length, inference_logits, cost, train_op) = \
+            build_graph(len(source_vocab_to_int), target_vocab_to_int, batch_size)
+
+    # Split data to training and validation sets
+    train_source = source_int_text[batch_size:]
+    train_target = target_int_text[batch_size:]
+    valid_source = source_int_text[:batch_size]
+    valid_target = target_int_text[:batch_size]
+    (valid_sources_batch, valid_targets_batch, valid_sources_lengths, valid_targets_lengths ) = next(get_batches(valid_source,
+                                                                                                                 valid_target,
+                                                                                                                 batch_size,
+                                                                                                                 source_vocab_to_int['<PAD>'],
+                                                                                                                 target_vocab_to_int['<PAD>']))                                                                                                  
+    with tf.Session(graph=train_graph) as sess:
+        sess.run(tf.global_variables_initializer())
+
+        for epoch_i in range(epochs):
+            for batch_i, (source_batch, target_batch, sources_lengths, targets_lengths) in enumerate(
+                    get_batches(train_source, train_target, batch_size,
+                                source_vocab_to_int['<PAD>'],
+                                target_vocab_to_int['<PAD>'])):
+    #             print(source_batch)
+    #             print(target_batch)
+    #             print(sources_lengths)
+    #             print(targets_lengths)
+
+                _, loss = sess.run(
+                    [train_op, cost],
+                    {input_data: source_batch,
+                     targets: target_batch,
+                     lr: learning_rate,
+                     target_sequence_length: targets_lengths,
+                     source_sequence_length: sources_lengths,
+                     keep_prob: keep_probability})
+
+
+                if batch_i % display_step == 0 and batch_i > 0:
+
+
+                    batch_train_logits = sess.run(
+                        inference_logits,
+                        {input_data: source_batch,
+                         source_sequence_length: sources_lengths,
+                         target_sequence_length: targets_lengths,
+                         keep_prob: 1.0})
+
+
+                    batch_valid_logits = sess.run(
+                        inference_logits,
+                        {input_data: valid_sources_batch,
+                         source_sequence_length: valid_sources_lengths,
+                         target_sequence_length: valid_targets_lengths,
+                         keep_prob: 1.0})
+
+                    train_acc = get_accuracy(target_batch, batch_train_logits)
+
+                    valid_acc = get_accuracy(valid_targets_batch, batch_valid_logits)
+
+                    print('Epoch {:>3} Batch {:>4}/{} - Train Accuracy: {:>6.4f}, Validation Accuracy: {:>6.4f}, Loss: {:>6.4f}'
+                          .format(epoch_i, batch_i, len(source_int_text) // batch_size, train_acc, valid_acc, loss))
+
+        # Save Model
+        saver = tf.train.Saver()
+        saver.save(sess, save_path)
+        print('Model Trained and Saved')
+
+    # Save parameters for checkpoint
+    save_params(save_path)
+
+    _, (source_vocab_to_int, target_vocab_to_int), (source_int_to_vocab, target_int_to_vocab) = load_preprocess()
+    load_path = load_params()
 
+    translate_sentence = 'he saw a old yellow truck .'
 
-translate_sentence = sentence_to_seq(translate_sentence, source_vocab_to_int)
 
-loaded_graph = tf.Graph()
-with tf.Session(graph=loaded_graph) as sess:
-    # Load saved model
-    loader = tf.train.import_meta_graph(load_path + '.meta')
-    loader.restore(sess, load_path)
+    translate_sentence = sentence_to_seq(translate_sentence, source_vocab_to_int)
 
-    input_data = loaded_graph.get_tensor_by_name('input:0')
-    logits = loaded_graph.get_tensor_by_name('predictions:0')
-    target_sequence_length = loaded_graph.get_tensor_by_name('target_sequence_length:0')
-    source_sequence_length = loaded_graph.get_tensor_by_name('source_sequence_length:0')
-    keep_prob = loaded_graph.get_tensor_by_name('keep_prob:0')
+    loaded_graph = tf.Graph()
+    with tf.Session(graph=loaded_graph) as sess:
+        # Load saved model
+        loader = tf.train.import_meta_graph(load_path + '.meta')
+        loader.restore(sess, load_path)
 
-    translate_logits = sess.run(logits, {input_data: [translate_sentence]*batch_size,
-                                         target_sequence_length: [len(translate_sentence)*2]*batch_size,
-                                         source_sequence_length: [len(translate_sentence)]*batch_size,
-                                         keep_prob: 1.0})[0]
+        input_data = loaded_graph.get_tensor_by_name('input:0')
+        logits = loaded_graph.get_tensor_by_name('predictions:0')
+        target_sequence_length = loaded_graph.get_tensor_by_name('target_sequence_length:0')
+        source_sequence_length = loaded_graph.get_tensor_by_name('source_sequence_length:0')
+        keep_prob = loaded_graph.get_tensor_by_name('keep_prob:0')
 
-print('Input')
-print('  Word Ids:      {}'.format([i for i in translate_sentence]))
-print('  English Words: {}'.format([source_int_to_vocab[i] for i in translate_sentence]))
+        translate_logits = sess.run(logits, {input_data: [translate_sentence]*batch_size,
+                                             target_sequence_length: [len(translate_sentence)*2]*batch_size,
+                                             source_sequence_length: [len(translate_sentence)]*batch_size,
+                                             keep_prob: 1.0})[0]
 
-print('\nPrediction')
-print('  Word Ids:      {}'.format([i for i in translate_logits]))
-print('  French Words: {}'.format(" ".join([target_int_to_vocab[i] for i in translate_logits])))
+    print('Input')
+    print('  Word Ids:      {}'.format([i for i in translate_sentence]))
+    print('  English Words: {}'.format([source_int_to_vocab[i] for i in translate_sentence]))
 
+    print('\nPrediction')
+    print('  Word Ids:      {}'.format([i for i in translate_logits]))
+    print('  French Words: {}'.format(" ".join([target_int_to_vocab[i] for i in translate_logits])))
@@ -26,25 +26,26 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import tensorflow as tf
 import numpy as np
 import _pickle as pkl
 import os
 import re
 import math
+import time
+import json
+import glob
+import queue
+import threading
+import multiprocessing
 from collections import Counter
 from collections import namedtuple
+from collections import OrderedDict
 from random import random
 from multiprocessing import Pool
 from multiprocessing import Process
 from itertools import chain
-
-# GatherTree ops don't load automatically. Adding import to force library to load
-# Fixed the KeyError: GatherTree
-from tensorflow.contrib.seq2seq.python.ops import beam_search_ops
-
-# Suppress warning log
-tf.logging.set_verbosity(tf.logging.FATAL)
+from contextlib import contextmanager
+from concurrent.futures import Future
 
 DEBUG = 1
 if DEBUG:
@@ -76,8 +77,43 @@ Hyparams = namedtuple('Hyparams', [
     'show_every',
     'summary_every',
     'save_every',
+    'cell_type',
+    'keep_checkpoints',
+    'keep_best_checkpoint',
+    'eval_every',
+    'eval_batch_size',
+    'trace_steps',
+    'intra_op_threads',
+    'inter_op_threads',
+    'curriculum_steps',
+    'tie_embeddings',
+    'share_vocab',
+    'output_rank',
+    'memory_saving',
+    'jit',
+    'calibration_steps',
+    'max_memory_mb',
+    'max_epoch_hours',
+    'cache_size',
+    'cache_on_disk',
+    'max_decode_len',
+    'decode_timeout_ms',
     ])
 
+# Hyperparameters pickled by older versions lack the fields appended later,
+# missing fields are filled with None and then merged with the defaults.
+Hyparams.__new__.__defaults__ = (None,) * len(Hyparams._fields)
+
+# Supported rnn cell backends, see Seq2seq._rnn_cell
+CELL_TYPES = ('lstm', 'block', 'fused', 'gru')
+
+# Memory saving modes for long sequences, see Seq2seq._session_config
+MEMORY_SAVING_MODES = ('none', 'swap', 'recompute', 'all')
+
+# Float32 weights with fewer elements are not quantized by export, and int8 weights are named {weight}/int8_weights
+QUANTIZE_MIN_SIZE = 1024
+QUANTIZED_SUFFIX = '/int8_weights'
+
 class Seq2seq:
     model_path = './models'
 
@@ -91,7 +127,7 @@ class Seq2seq:
         keep_prob=0.8,
         valid_portion=0.05,
         train_batch_size=32,
-        infer_batch_size=1,
+        infer_batch_size=32,
         max_gradient_norm=5.0,
         epoch=10,
         max_global_step=float('inf'),
@@ -108,7 +144,28 @@ class Seq2seq:
         report_every=50,
         show_every=200,
         summary_every=50,
-        save_every=500
+        save_every=500,
+        cell_type='lstm',
+        keep_checkpoints=3,
+        keep_best_checkpoint=True,
+        eval_every=1000,
+        eval_batch_size=128,
+        trace_steps='',
+        intra_op_threads=0,
+        inter_op_threads=0,
+        curriculum_steps=0,
+        tie_embeddings=False,
+        share_vocab=False,
+        output_rank=0,
+        memory_saving='none',
+        jit=False,
+        calibration_steps=10,
+        max_memory_mb=0,
+        max_epoch_hours=0,
+        cache_size=1024,
+        cache_on_disk=False,
+        max_decode_len=0,
+        decode_timeout_ms=0,
         )
 
 
@@ -149,17 +206,38 @@ class Seq2seq:
             show_every=None,
             summary_every=None,
             save_every=None,
+            cell_type=None,
+            keep_checkpoints=None,
+            keep_best_checkpoint=None,
+            eval_every=None,
+            eval_batch_size=None,
+            trace_steps=None,
+            intra_op_threads=None,
+            inter_op_threads=None,
+            curriculum_steps=None,
+            tie_embeddings=None,
+            share_vocab=None,
+            output_rank=None,
+            memory_saving=None,
+            jit=None,
+            calibration_steps=None,
+            max_memory_mb=None,
+            max_epoch_hours=None,
+            cache_size=None,
+            cache_on_disk=None,
+            max_decode_len=None,
+            decode_timeout_ms=None,
             ):
         '''
         Create a seq2seq instance
         @embedding_dim  :int, Embedding layer size
         @rnn_layer_size :int, Single lstm layer size, EVEN NUMBER ONLY, set for both encoder and decoder
         @n_rnn_layers :int, Number of layers of lstm network, set for both encoder and decoder
-        @beam_width :int, Width of beam search
+        @beam_width :int, Width of beam search, the max width predictions can choose after training. 1 for greedy decoding
         @keep_prob :float, Keep probability for each rnn node
         @valid_portion :float, Portion seperated for validtion
         @train_batch_size :int, Batch size while training
-        @infer_batch_size :int, Batch size while infering
+        @infer_batch_size :int, Max number of distinct inputs in a batch of predict_batch
         @max_gradient_norm :float, Clip value for global gradients
         @epoch :int, Number of training epoch
         @max_global_step :int, Maximum training steps, default to infinity, which means training for {epoch} times
@@ -177,6 +255,27 @@ class Seq2seq:
         @show_every :int, Print example of transformation for every {this} steps
         @summary_every :int, Save summery info for tensorboard for every {this} steps
         @save_every :int, Save checkpoint for every {this} steps
+        @cell_type :str, Rnn cell backend of both encoder and decoder, one of 'lstm', 'block', 'fused' or 'gru'
+        @keep_checkpoints :int, Keep the last {this} checkpoints
+        @keep_best_checkpoint :bool, Also keep the checkpoint with the lowest validation loss
+        @eval_every :int, Evaluate loss and bleu on the whole validation set for every {this} steps, 0 to disable
+        @eval_batch_size :int, Batch size while evaluating the whole validation set
+        @trace_steps :str, Steps to trace with full timeline, e.g. '1000-1005' or '10,20', empty to disable. Counts training steps in training and calls in predict
+        @intra_op_threads :int, Threads used within an op, 0 lets tensorflow decide
+        @inter_op_threads :int, Threads used to run independent ops in parallel, 0 lets tensorflow decide
+        @curriculum_steps :int, Grow the max length of training batches from short to full over {this} steps, 0 to disable
+        @tie_embeddings :bool, Use the decoder embedding as the output projection, the decoder output is projected to {embedding_dim} first if sizes differ
+        @share_vocab :bool, Use one vocabulary and one embedding for both encoder and decoder
+        @output_rank :int, Factorize the output projection through a bottleneck of {this} size, 0 to disable
+        @memory_saving :str, Memory saving mode for long sequences, one of 'none', 'swap', 'recompute' or 'all'
+        @jit :bool, Compile the graph with XLA auto clustering, ignored if XLA is not available
+        @calibration_steps :int, Time {this} training steps before training to estimate the epoch time, 0 to disable
+        @max_memory_mb :float, Reject the model if its weights and Adam slots need more than {this} MB, 0 for no limit
+        @max_epoch_hours :float, Reject the model if one epoch is estimated to take more than {this} hours, 0 for no limit
+        @cache_size :int, Number of predictions kept in memory, least recently used ones are evicted, 0 to disable the cache
+        @cache_on_disk :bool, Also keep predictions in prediction_cache.sqlite of the model directory
+        @max_decode_len :int, Max length of predictions, 0 for twice the length of the longest input, can be changed per predict_batch call
+        @decode_timeout_ms :float, Latency budget of a prediction run in milliseconds, decoding stops at it with the best answers so far, 0 for no limit, can be changed per predict_batch call
         @return: None
         '''
                 
@@ -206,6 +305,27 @@ class Seq2seq:
             show_every,
             summary_every,
             save_every,
+            cell_type,
+            keep_checkpoints,
+            keep_best_checkpoint,
+            eval_every,
+            eval_batch_size,
+            trace_steps,
+            intra_op_threads,
+            inter_op_threads,
+            curriculum_steps,
+            tie_embeddings,
+            share_vocab,
+            output_rank,
+            memory_saving,
+            jit,
+            calibration_steps,
+            max_memory_mb,
+            max_epoch_hours,
+            cache_size,
+            cache_on_disk,
+            max_decode_len,
+            decode_timeout_ms,
         )
 
         # Specify save path of models
@@ -218,19 +338,40 @@ class Seq2seq:
         self.model_ckpt_path = os.path.join(self.model_ckpt_dir, 'checkpoint.ckpt')
         
         self.tp = TextProcessor()
+
+        # Number of predict calls, counted as steps for trace_steps
+        self.n_predicts = 0
+
+        # Whether the loaded model is an exported inference graph
+        self.frozen = False
+
+        # Created on first prediction, since it belongs to the loaded model
+        self.prediction_cache = None
+        # Weights on disk of the loaded model, set by load. Models built in this process have none and are not cached
+        self.checkpoint_signature = ''
         
         self.hyparams = self._merge(self.hyparams, self.init_hyparams)
 
+        if self.hyparams.cell_type not in CELL_TYPES:
+            raise ValueError('cell_type should be one of {}, got {}'.format(CELL_TYPES, self.hyparams.cell_type))
+
+        if self.hyparams.memory_saving not in MEMORY_SAVING_MODES:
+            raise ValueError('memory_saving should be one of {}, got {}'.format(MEMORY_SAVING_MODES, self.hyparams.memory_saving))
+
+        if self.hyparams.tie_embeddings and self.hyparams.output_rank not in (0, self.hyparams.embedding_dim):
+            raise ValueError('output_rank of tied embeddings should be 0 or embedding_dim {}, got {}'.format(self.hyparams.embedding_dim, self.hyparams.output_rank))
+
 
     def _merge(self, base_hyp, new_hyp):
         '''
         Merge two namedtuple into one. 
         E.g. base_hyp.x = 4 and new_hyp.x = 2, after merging, return hyp.x = 2
         However, if base_hyp.x = 4 and new_hyp.x = None, after merging, return hyp.x = 4
+        Falsy values such as 0 or False still overwrite, only None is ignored
         @base_hyp: namedtuple, basic hyperparameters
         @new_hyp: namedtyple, updating hyperparameters 
         '''
-        return Hyparams(*[n_v or o_v for o_v, n_v in zip(base_hyp, new_hyp)])
+        return Hyparams(*[o_v if n_v is None else n_v for o_v, n_v in zip(base_hyp, new_hyp)])
             
 
     def set_id(self, new_id):
@@ -272,51 +413,100 @@ class Seq2seq:
         return self.model_ckpt_dir
 
 
-    def _get_ngrams(self, segment, max_order):
+    def _seq_lens(self, seqs, stop_ids):
         '''
-        Calculate the ngrams for bleu score
-        @segment: list, list of words for one sentence
-        @max_order: int, 1-gram, 2-gram ... max_order-gram will be calculated
-        @return: dict, key: tuple of words, value: number of occurrence of the word tuple.
+        Length of each padded sequence, counted until the first stop token, e.g. <EOS> or <PAD>
+        @seqs: np.array, int array of shape [batch, time]
+        @stop_ids: list, ids of tokens that end a sequence
+        @return: np.array, int array of shape [batch]
         '''
-        ngram_counts = Counter()
-        for order in range(1, max_order + 1):
-            for i in range(0, len(segment) - order + 1):
-                ngram = tuple(segment[i:i+order])
-                ngram_counts[ngram] += 1
-        return ngram_counts
+        seqs = np.asarray(seqs)
+        if seqs.shape[1] == 0:
+            # argmax fails on empty rows, e.g. nothing is decoded for empty inputs
+            return np.zeros(len(seqs), dtype=np.int64)
+        stopped = np.isin(seqs, stop_ids)
+        return np.where(stopped.any(axis=1), stopped.argmax(axis=1), seqs.shape[1])
 
 
-    def _bleu(self, gen_lists, refer_lists, max_order=4, smooth=True):
+    def _ngram_keys(self, seqs, lens, order, base):
         '''
-        Calculate the bleu score given a list of generated sentence and a list of given sentence for reference.
-        @gen_lists: list, each item in list is a list of word token. [[token0, token1, ..], [tokenX, tokenY, ..], ..]
-        @refer_lists: list, each item in list is a list of reference word token, like gen_lists
+        Hash every n-gram of given order into an integer key
+        Keys are exact when base**order fits into int64, which holds for vocabularies up to 55k words with order 4.
+        Otherwise ids are mixed with a multiplicative hash, where a collision is practically impossible.
+        @seqs: np.array, int array of shape [batch, time]
+        @lens: np.array, true length of each sequence, n-grams beyond it are dropped
+        @order: int, the order of n-grams
+        @base: int, larger than any token id
+        @return: (np.array, np.array), sentence index and key of every n-gram
+        '''
+        n_seqs, width = seqs.shape
+        n_pos = width - order + 1
+        if n_pos <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        if base ** order < 2 ** 63:
+            keys = np.zeros((n_seqs, n_pos), dtype=np.int64)
+            for k in range(order):
+                keys = keys * base + seqs[:, k:k+n_pos]
+        else:
+            # Overflow of uint64 wraps around silently
+            keys = np.zeros((n_seqs, n_pos), dtype=np.uint64)
+            for k in range(order):
+                keys = keys * np.uint64(0x9E3779B97F4A7C15) + seqs[:, k:k+n_pos].astype(np.uint64) + np.uint64(1)
+            keys = keys.view(np.int64)
+
+        valid = np.arange(n_pos)[None, :] + order <= lens[:, None]
+        sent_idxs = np.broadcast_to(np.arange(n_seqs)[:, None], keys.shape)[valid]
+        return sent_idxs, keys[valid]
+
+
+    def _bleu_stats(self, gen_seqs, gen_lens, refer_seqs, refer_lens, max_order=4):
+        '''
+        Count clipped n-gram matches of a batch, vectorized across the batch
+        @gen_seqs: np.array, int array of generated sequences of shape [batch, time], anything beyond gen_lens is ignored
+        @gen_lens: np.array, true lengths of generated sequences
+        @refer_seqs: np.array, int array of reference sequences of shape [batch, time], anything beyond refer_lens is ignored
+        @refer_lens: np.array, true lengths of reference sequences
         @max_order: int, the max order for n-gram
-        @smooth: bool, if False, bleu score might be 0.0 more often.
-        @return: float, the bleu score of the gen_lists
+        @return: np.array, [matches of each order.., possible matches of each order.., gen_length, refer_length]
         '''
-        matches_by_order = [0] * max_order
-        possible_matches_by_order = [0] * max_order
-        refer_length = 0
-        gen_length = 0
+        gen_seqs = np.asarray(gen_seqs, dtype=np.int64)
+        refer_seqs = np.asarray(refer_seqs, dtype=np.int64)
+        gen_lens = np.asarray(gen_lens, dtype=np.int64)
+        refer_lens = np.asarray(refer_lens, dtype=np.int64)
+        base = int(max(gen_seqs.max(initial=0), refer_seqs.max(initial=0))) + 1
+
+        matches_by_order = np.zeros(max_order, dtype=np.int64)
+        possible_matches_by_order = np.zeros(max_order, dtype=np.int64)
+        for order in range(1, max_order + 1):
+            gen_sent, gen_keys = self._ngram_keys(gen_seqs, gen_lens, order, base)
+            refer_sent, refer_keys = self._ngram_keys(refer_seqs, refer_lens, order, base)
 
-        # In my case, generated string only has 1 reference string
-        for (refer_list, gen_list) in zip(refer_lists, gen_lists):
-            refer_length += len(refer_list)
-            gen_length += len(gen_list)
+            # Replace keys by their dense rank, so that (sentence, key) packs into a single int64
+            uniq_keys, ranks = np.unique(np.concatenate([gen_keys, refer_keys]), return_inverse=True)
+            packed = np.concatenate([gen_sent, refer_sent]) * len(uniq_keys) + ranks.reshape(-1)
+            gen_ngrams, gen_counts = np.unique(packed[:len(gen_keys)], return_counts=True)
+            refer_ngrams, refer_counts = np.unique(packed[len(gen_keys):], return_counts=True)
+
+            # Clip the count of each generated n-gram by its count in the reference
+            _, gen_idxs, refer_idxs = np.intersect1d(gen_ngrams, refer_ngrams, assume_unique=True, return_indices=True)
+            matches_by_order[order-1] = np.minimum(gen_counts[gen_idxs], refer_counts[refer_idxs]).sum()
+            possible_matches_by_order[order-1] = np.maximum(gen_lens - order + 1, 0).sum()
 
-            refer_ngram_counts = self._get_ngrams(refer_list, max_order)
-            gen_ngram_counts = self._get_ngrams(gen_list, max_order)
-            overlap = gen_ngram_counts & refer_ngram_counts
+        return np.concatenate([matches_by_order, possible_matches_by_order, [gen_lens.sum(), refer_lens.sum()]])
 
-            for ngram in overlap:
-                matches_by_order[len(ngram)-1] += overlap[ngram]
 
-            for order in range(1, max_order+1):
-                possible_matches = len(gen_list) - order + 1
-                if possible_matches > 0:
-                    possible_matches_by_order[order-1] += possible_matches
+    def _bleu_from_stats(self, stats, max_order=4, smooth=True):
+        '''
+        Calculate the bleu score from statistics of _bleu_stats, which can be summed over batches
+        @stats: np.array, statistics from _bleu_stats
+        @max_order: int, the max order for n-gram
+        @smooth: bool, if False, bleu score might be 0.0 more often.
+        @return: float, the bleu score
+        '''
+        matches_by_order = stats[:max_order]
+        possible_matches_by_order = stats[max_order:2*max_order]
+        gen_length, refer_length = stats[2*max_order:]
 
         precisions = [0] * max_order
         for i in range(0, max_order):
@@ -336,6 +526,9 @@ class Seq2seq:
         else:
             geo_mean = 0.0
 
+        if gen_length == 0 or refer_length == 0:
+            return 0.0
+
         ratio = float(gen_length) / refer_length
 
         if ratio > 1.0:
@@ -348,16 +541,125 @@ class Seq2seq:
         return bleu
 
 
+    def _bleu(self, gen_lists, refer_lists, max_order=4, smooth=True):
+        '''
+        Calculate the bleu score given a list of generated sentence and a list of given sentence for reference.
+        @gen_lists: list, each item in list is a list of word token. [[token0, token1, ..], [tokenX, tokenY, ..], ..]
+        @refer_lists: list, each item in list is a list of reference word token, like gen_lists
+        @max_order: int, the max order for n-gram
+        @smooth: bool, if False, bleu score might be 0.0 more often.
+        @return: float, the bleu score of the gen_lists
+        '''
+        # In my case, generated string only has 1 reference string
+        padded = []
+        for lists in (gen_lists, refer_lists):
+            lens = np.array([len(line) for line in lists], dtype=np.int64)
+            seqs = np.zeros((len(lists), max(lens.max(initial=0), 1)), dtype=np.int64)
+            for i, line in enumerate(lists):
+                seqs[i, :len(line)] = line
+            padded.extend([seqs, lens])
+
+        return self._bleu_from_stats(self._bleu_stats(*padded, max_order=max_order), max_order, smooth)
+
+
     def _rnn_cell(self, rnn_size, keep_prob):
         '''
-        Generate lstm cell with dropout wrapper
+        Generate rnn cell with dropout wrapper, the backend is chosen by hyperparameter cell_type
+        'lstm': tf.nn.rnn_cell.LSTMCell, many small ops per timestep
+        'block': LSTMBlockCell, the whole lstm step runs in a single kernel
+        'fused': same as 'block' for step-by-step decoding, the encoder uses LSTMBlockFusedCell instead, see _encoder
+        'gru': GRUCell, cheaper recurrence with 3 gates instead of 4
         @rnn_size: int, the size of single layer
         @keep_prob: float, the keep probability for each rnn node
         @return: rnn_cell with dropout wrapper
         '''
-        lstm_cell = tf.nn.rnn_cell.LSTMCell(rnn_size)
-                #initializer=tf.random_uniform_initializer(-0.1, 0.1))
-        return tf.contrib.rnn.DropoutWrapper(lstm_cell, input_keep_prob=keep_prob, output_keep_prob=1.0)
+        if self.hyparams.cell_type == 'lstm':
+            rnn_cell = tf.nn.rnn_cell.LSTMCell(rnn_size)
+                    #initializer=tf.random_uniform_initializer(-0.1, 0.1))
+        elif self.hyparams.cell_type in ('block', 'fused'):
+            rnn_cell = tf.contrib.rnn.LSTMBlockCell(rnn_size)
+        elif self.hyparams.cell_type == 'gru':
+            rnn_cell = tf.nn.rnn_cell.GRUCell(rnn_size)
+        else:
+            raise ValueError('Unknown cell_type {}'.format(self.hyparams.cell_type))
+        return tf.contrib.rnn.DropoutWrapper(rnn_cell, input_keep_prob=keep_prob, output_keep_prob=1.0)
+
+
+    def _encoder(self, encoder_wordvec, encoder_input_seq_lengths, keep_prob):
+        '''
+        Stacked bi-directional rnn encoder
+        Forward and backward final states of every layer are concatenated, so that they fit the decoder cell of size rnn_layer_size
+        @encoder_wordvec: tensor, embedded encoder input of shape [batch, time, embedding_dim]
+        @encoder_input_seq_lengths: tensor, lengths of encoder input sequences
+        @keep_prob: tensor, the keep probability for each rnn node
+        @return: (tensor, tuple), encoder output of shape [batch, time, rnn_layer_size] and final state for each layer
+        '''
+        half_layer_size = self.hyparams.rnn_layer_size // 2
+
+        if self.hyparams.cell_type == 'fused':
+            # LSTMBlockFusedCell runs the whole sequence in one kernel, but it is time major and not a RNNCell,
+            # so the layers are stacked by hand. Scopes follow stack_bidirectional_dynamic_rnn
+            layer_input = tf.transpose(encoder_wordvec, [1, 0, 2])
+            forward_final_state = []
+            backward_final_state = []
+            with tf.variable_scope('stack_bidirectional_rnn'):
+                for i in range(self.hyparams.n_rnn_layers):
+                    with tf.variable_scope('cell_{}'.format(i)), tf.variable_scope('bidirectional_rnn'):
+                        with tf.variable_scope('fw'):
+                            forward_cell = tf.contrib.rnn.LSTMBlockFusedCell(half_layer_size)
+                            forward_output, forward_state = forward_cell(
+                                    tf.nn.dropout(layer_input, keep_prob),
+                                    dtype=tf.float32, sequence_length=encoder_input_seq_lengths)
+                        with tf.variable_scope('bw'):
+                            backward_cell = tf.contrib.rnn.TimeReversedFusedRNN(tf.contrib.rnn.LSTMBlockFusedCell(half_layer_size))
+                            backward_output, backward_state = backward_cell(
+                                    tf.nn.dropout(layer_input, keep_prob),
+                                    dtype=tf.float32, sequence_length=encoder_input_seq_lengths)
+                    layer_input = tf.concat([forward_output, backward_output], -1)
+                    forward_final_state.append(forward_state)
+                    backward_final_state.append(backward_state)
+            encoder_output = tf.transpose(layer_input, [1, 0, 2])
+
+        else:
+            rnn_cell_list_forward = [self._rnn_cell(half_layer_size, keep_prob) for _ in range(self.hyparams.n_rnn_layers)]
+            rnn_cell_list_backward = [self._rnn_cell(half_layer_size, keep_prob) for _ in range(self.hyparams.n_rnn_layers)]
+
+            # Same as tf.contrib.rnn.stack_bidirectional_dynamic_rnn, which cannot swap memory
+            layer_input = encoder_wordvec
+            forward_final_state = []
+            backward_final_state = []
+            with tf.variable_scope('stack_bidirectional_rnn'):
+                for i, (forward_cell, backward_cell) in enumerate(zip(rnn_cell_list_forward, rnn_cell_list_backward)):
+                    with tf.variable_scope('cell_{}'.format(i)):
+                        (forward_output, backward_output), (forward_state, backward_state) = tf.nn.bidirectional_dynamic_rnn(
+                                forward_cell, backward_cell, layer_input,
+                                sequence_length=encoder_input_seq_lengths, time_major=False,
+                                dtype=tf.float32, swap_memory=self._swap_memory()
+                                )
+                    layer_input = tf.concat([forward_output, backward_output], -1)
+                    forward_final_state.append(forward_state)
+                    backward_final_state.append(backward_state)
+            encoder_output = layer_input
+
+        # maybe the encoder_final_state can be updated
+        # Use tensorboard to check it
+        encoder_final_state = []
+        for forward_cell_state, backward_cell_state in zip(forward_final_state, backward_final_state):
+            if self.hyparams.cell_type == 'gru':
+                # Gru state is a single tensor
+                encoder_final_state.append(tf.concat([forward_cell_state, backward_cell_state], -1))
+            else:
+                concated_state = tf.concat([forward_cell_state.c, backward_cell_state.c], -1)
+                concated_output = tf.concat([forward_cell_state.h, backward_cell_state.h], -1)
+                encoder_final_state.append(tf.nn.rnn_cell.LSTMStateTuple(concated_state, concated_output))
+        encoder_final_state = tuple(encoder_final_state)
+
+        if DEBUG:
+            tf.summary.histogram('encoder_output', encoder_output)
+            tf.summary.histogram('encoder_forward_state', forward_final_state)
+            tf.summary.histogram('encoder_backward_state', backward_final_state)
+
+        return encoder_output, encoder_final_state
 
     def _padding_batch(self, inputs, targets, batch_size, input_padding_val=0, target_padding_val=0, forever=False):
         '''
@@ -392,6 +694,40 @@ class Seq2seq:
             if not forever:
                 break
 
+
+    def _curriculum_batch(self, inputs, targets, batch_size, input_padding_val=0, target_padding_val=0, start_step=0, seed=0):
+        '''
+        Generate padding batches of a curriculum by length for one round.
+        Batches are formed in the given order, which is bucketed by _parse_seq, then ranked by their max length.
+        At global step t only the shortest sqrt(t/{curriculum_steps}) part of batches is eligible, at least 1%,
+        and a batch is drawn at random among the eligible ones which are not used in this round yet, if all of them are used, among all eligible ones.
+        The draws only depend on seed and start_step, so skipping the first n batches replays exactly the same round.
+        @inputs: list, each item of the list is a list of word tokens for encoding
+        @targets: list, each item of the list is a list of word tokens for decoding
+        @batch_size: int, the batch size
+        @input_padding_val: int, the token number of padding for encoding sequences
+        @target_padding_val: int, the token number of padding for decoding sequences
+        @start_step: int, the global step before the first batch of this round
+        @seed: int or list, random seed of this round
+        @return: generator, same as _padding_batch
+        '''
+        n_batch = len(targets) // batch_size
+        batch_lens = [max(map(len, inputs[i*batch_size: (i+1)*batch_size] + targets[i*batch_size: (i+1)*batch_size])) for i in range(n_batch)]
+        len_order = np.argsort(batch_lens, kind='mergesort')
+        used = np.zeros(n_batch, dtype=bool)
+        rng = np.random.RandomState(seed)
+
+        for step in range(start_step + 1, start_step + n_batch + 1):
+            competence = min(1.0, np.sqrt(0.0001 + step / self.hyparams.curriculum_steps))
+            eligible = len_order[:max(1, int(np.ceil(competence * n_batch)))]
+            unused = eligible[~used[eligible]]
+            candidates = unused if len(unused) else eligible
+            batch_i = candidates[rng.randint(len(candidates))]
+            used[batch_i] = True
+
+            start_i = batch_i * batch_size
+            yield next(self._padding_batch(inputs[start_i: start_i+batch_size], targets[start_i: start_i+batch_size], batch_size, input_padding_val, target_padding_val))
+
     
     def _parse_dict(self, file_paths):
         '''
@@ -532,6 +868,231 @@ class Seq2seq:
 
             yield (parsed_encode_lines, parsed_decode_lines)
 
+    def _build_eval_set(self, encode_seqs, decode_seqs, batch_size):
+        '''
+        Pad the evaluation set once into cached batches for _evaluate.
+        Pairs are sorted by length to reduce padding, and true lengths of sequences are kept.
+        @encode_seqs: list, each item of the list is a list of word tokens for encoding
+        @decode_seqs: list, each item of the list is a list of word tokens for decoding
+        @batch_size: int, the batch size, the last batch may be smaller
+        @return: list, each item is a tuple (inputs, inputs_lens, targets, targets_lens) of one batch
+        '''
+        encode_pad_id = self.encoder_vocab_to_int['<PAD>']
+        decode_pad_id = self.decoder_vocab_to_int['<PAD>']
+        decode_eos_id = self.decoder_vocab_to_int['<EOS>']
+
+        order = sorted(range(len(encode_seqs)), key=lambda i: (len(encode_seqs[i]), len(decode_seqs[i])))
+
+        eval_set = []
+        for start_i in range(0, len(order), batch_size):
+            batch_idxs = order[start_i: start_i+batch_size]
+            batch_inputs = [encode_seqs[i] for i in batch_idxs]
+            batch_targets = [decode_seqs[i] + [decode_eos_id] for i in batch_idxs]
+
+            inputs_lens = np.array([len(line) for line in batch_inputs], dtype=np.int32)
+            targets_lens = np.array([len(line) for line in batch_targets], dtype=np.int32)
+
+            inputs = np.full((len(batch_idxs), np.max(inputs_lens)), encode_pad_id, dtype=np.int32)
+            targets = np.full((len(batch_idxs), np.max(targets_lens)), decode_pad_id, dtype=np.int32)
+            for j, (input_line, target_line) in enumerate(zip(batch_inputs, batch_targets)):
+                inputs[j, :len(input_line)] = input_line
+                targets[j, :len(target_line)] = target_line
+
+            eval_set.append((inputs, inputs_lens, targets, targets_lens))
+
+        return eval_set
+
+
+    def _evaluate(self, eval_set):
+        '''
+        Evaluate corpus level loss and bleu score on cached batches built by _build_eval_set
+        The loss is teacher forced and weighted by the number of target tokens of each batch,
+        the bleu score is computed on the beam search predictions.
+        @eval_set: list, cached batches from _build_eval_set
+        @return: dict, keys are loss, bleu, n_pairs and wall_time(seconds)
+        '''
+        start_time = time.time()
+        decoder_eos_id = self.decoder_vocab_to_int['<EOS>']
+
+        with self.graph.as_default():
+            encoder_input = self.graph.get_tensor_by_name('inputs:0')
+            encoder_input_seq_lengths = self.graph.get_tensor_by_name('source_lens:0')
+            decoder_target = self.graph.get_tensor_by_name('targets:0')
+            decoder_target_seq_lengths = self.graph.get_tensor_by_name('target_lens:0')
+            keep_prob = self.graph.get_tensor_by_name('dropout:0')
+            prediction = self.graph.get_tensor_by_name('optimization/predictions:0')
+            cost = tf.get_collection("optimization")[1]
+
+        total_loss = 0.0
+        n_tokens = 0
+        n_pairs = 0
+        bleu_stats = 0
+        for inputs, inputs_lens, targets, targets_lens in eval_set:
+            batch_loss, predict_lists = self.sess.run([cost, prediction], feed_dict={
+                encoder_input:inputs,
+                encoder_input_seq_lengths:inputs_lens,
+                decoder_target:targets,
+                decoder_target_seq_lengths:targets_lens,
+                keep_prob: 1.0
+                })
+
+            total_loss += batch_loss * np.sum(targets_lens)
+            n_tokens += np.sum(targets_lens)
+
+            # Targets end with <EOS>, which is not part of the reference
+            bleu_stats = bleu_stats + self._bleu_stats(
+                    predict_lists, self._seq_lens(predict_lists, [decoder_eos_id]),
+                    targets, targets_lens - 1, self.hyparams.bleu_max_order)
+            n_pairs += len(inputs)
+
+        return {
+                'loss': float(total_loss / max(n_tokens, 1)),
+                'bleu': float(self._bleu_from_stats(bleu_stats, self.hyparams.bleu_max_order, self.hyparams.bleu_smooth)) if n_pairs else 0.0,
+                'n_pairs': n_pairs,
+                'wall_time': time.time() - start_time
+                }
+
+
+    def evaluate(self, encode_file_paths, decode_file_paths):
+        '''
+        Evaluate corpus level loss and bleu score on a whole dataset. Make sure you load the model before using this method.
+        @encode_file_paths: str or list/tuple, the path or a list of paths of the encoder file(s)
+        @decode_file_paths: str or list/tuple, the path or a list of paths of the decoder file(s)
+        @return: dict, keys are loss, bleu, n_pairs and wall_time(seconds)
+        '''
+        if not hasattr(self, 'sess'):
+            self.load(self.model_ckpt_dir)
+
+        if self.frozen:
+            raise ValueError('{} is an exported model, which can not be evaluated'.format(self.model_ckpt_dir))
+
+        encode_seqs = []
+        decode_seqs = []
+        for file_encode_seqs, file_decode_seqs in self._parse_seq(encode_file_paths, decode_file_paths, self.encoder_vocab_to_int, self.decoder_vocab_to_int):
+            encode_seqs.extend(file_encode_seqs)
+            decode_seqs.extend(file_decode_seqs)
+
+        return self._evaluate(self._build_eval_set(encode_seqs, decode_seqs, self.hyparams.eval_batch_size))
+
+
+    def _cost_section(self, var_name):
+        '''
+        Model section of a variable for the cost estimate
+        @var_name: str, name of the variable
+        @return: str, one of embedding, encoder, attention, decoder and output
+        '''
+        if 'EmbedSequence' in var_name or 'decoder_embed_weight' in var_name:
+            return 'embedding'
+        if 'decoder_output_embedding' in var_name:
+            return 'output'
+        if 'memory_layer' in var_name or 'attention_layer' in var_name:
+            return 'attention'
+        if var_name.startswith('encoder/'):
+            return 'encoder'
+        return 'decoder'
+
+
+    def _estimate_cost(self, mean_source_len, mean_target_len):
+        '''
+        Estimate parameters, memory and flops of the built graph.
+        Every 2-D kernel does one matmul per timestep, which is 2 flops per element, per source token for the encoder
+        and the attention memory layer, per target token for the others. Attention scores and context take 4 * source length * rnn_layer_size per target token.
+        Training takes about 3 times the forward flops, forward plus backward.
+        @mean_source_len: float, mean length of source sequences
+        @mean_target_len: float, mean length of target sequences, <EOS> included
+        @return: dict, params and flops_per_pair by section, memory in MB and flops per target token
+        '''
+        params = {section: 0 for section in ('embedding', 'encoder', 'attention', 'decoder', 'output')}
+        flops = {section: 0.0 for section in ('encoder', 'attention', 'decoder', 'output')}
+        with self.graph.as_default():
+            for var in tf.trainable_variables():
+                section = self._cost_section(var.op.name)
+                size = int(np.prod(var.get_shape().as_list()))
+                params[section] += size
+                if section == 'embedding' or len(var.get_shape()) != 2:
+                    continue
+                n_steps = mean_source_len if section == 'encoder' or 'memory_layer' in var.op.name else mean_target_len
+                flops[section] += 2 * size * n_steps
+
+        flops['attention'] += 4 * mean_source_len * self.hyparams.rnn_layer_size * mean_target_len
+        if self.hyparams.tie_embeddings:
+            # The tied embedding is the kernel of output projection
+            flops['output'] += 2 * len(self.decoder_int_to_vocab) * self.hyparams.embedding_dim * mean_target_len
+
+        n_params = sum(params.values())
+        forward_flops = sum(flops.values())
+        return {
+                'params': params,
+                'params_total': n_params,
+                # float32 weights, plus the first and second moments of Adam
+                'memory_mb': {'weights': n_params * 4 / 2**20, 'adam': 2 * n_params * 4 / 2**20, 'total': 3 * n_params * 4 / 2**20},
+                'mean_source_len': mean_source_len,
+                'mean_target_len': mean_target_len,
+                'flops_per_pair': flops,
+                'forward_flops_per_target_token': forward_flops / mean_target_len,
+                'train_flops_per_pair': 3 * forward_flops,
+                }
+
+
+    def _calibrate(self, encode_seqs, decode_seqs, n_steps):
+        '''
+        Time training steps on batches spread over all lengths, without changing the model.
+        The learning rate is 0, so weights stay the same, and the optimizer slots and the global step are restored afterwards.
+        @encode_seqs: list, training sequences for encoding, in the order of training
+        @decode_seqs: list, training sequences for decoding
+        @n_steps: int, number of timed steps
+        @return: dict, mean step time and the estimated epoch time in seconds
+        '''
+        batch_size = self.hyparams.train_batch_size
+        n_batch = len(encode_seqs) // batch_size
+        batch_idxs = np.unique(np.linspace(0, n_batch - 1, min(n_steps, n_batch)).astype(int))
+        encode_pad_id = self.encoder_vocab_to_int['<PAD>']
+        decode_pad_id = self.decoder_vocab_to_int['<PAD>']
+
+        with self.graph.as_default():
+            train_op, cost, _ = tf.get_collection('optimization')
+            trainable = set(tf.trainable_variables())
+            state_vars = [var for var in tf.global_variables() if var not in trainable]
+            state_values = self.sess.run(state_vars)
+
+            step_times = []
+            # The first step warms up, then every picked batch is timed
+            for batch_i in np.concatenate([batch_idxs[:1], batch_idxs]):
+                start_i = batch_i * batch_size
+                inputs, inputs_lens, targets, targets_lens = next(self._padding_batch(
+                    encode_seqs[start_i: start_i+batch_size], decode_seqs[start_i: start_i+batch_size], batch_size, encode_pad_id, decode_pad_id))
+                start_time = time.time()
+                self.sess.run([train_op, cost], feed_dict={
+                    self.graph.get_tensor_by_name('inputs:0'): inputs,
+                    self.graph.get_tensor_by_name('source_lens:0'): inputs_lens,
+                    self.graph.get_tensor_by_name('targets:0'): targets,
+                    self.graph.get_tensor_by_name('target_lens:0'): targets_lens,
+                    self.graph.get_tensor_by_name('dropout:0'): self.hyparams.keep_prob,
+                    self.graph.get_tensor_by_name('optimization/learning_rate:0'): 0.0
+                    })
+                step_times.append(time.time() - start_time)
+
+            for var, value in zip(state_vars, state_values):
+                var.load(value, self.sess)
+
+        step_sec = float(np.mean(step_times[1:]))
+        return {'calibration_steps': len(batch_idxs), 'step_sec': step_sec, 'n_batch': n_batch, 'epoch_sec': step_sec * n_batch}
+
+
+    def _check_cost(self, cost_estimate):
+        '''
+        Reject the model if the estimate exceeds hyperparameters max_memory_mb or max_epoch_hours
+        @cost_estimate: dict, from _estimate_cost, optionally updated by _calibrate
+        @return: None
+        '''
+        if self.hyparams.max_memory_mb and cost_estimate['memory_mb']['total'] > self.hyparams.max_memory_mb:
+            raise ValueError('Weights and Adam slots need {:.0f} MB, more than max_memory_mb {}'.format(
+                cost_estimate['memory_mb']['total'], self.hyparams.max_memory_mb))
+        if self.hyparams.max_epoch_hours and cost_estimate.get('epoch_sec', 0) > self.hyparams.max_epoch_hours * 3600:
+            raise ValueError('One epoch is estimated to take {:.1f} hours, more than max_epoch_hours {}'.format(
+                cost_estimate['epoch_sec'] / 3600, self.hyparams.max_epoch_hours))
+
+
     def lr_schedule(self, lr, start_p, every_step, decay_rate):
         '''
         A learning rate scheduler for flexible learning rate decaying
@@ -570,287 +1131,434 @@ class Seq2seq:
             process.apply(self._unwrap_self_train, [*params])
 
 
-    def _train(self, encode_file_paths, decode_file_paths, load_model_path=None):
+    def _session_config(self):
         '''
-        Main training method. After training your model instance will be saved.
-        @encode_file_paths: str or list/tuple, the path or a list of paths of the encoder training file(s)
-        @decode_file_paths: str or list/tuple, the path or a list of paths of the decoder training file(s)
-        @load_model_path: str, the path of existed model directory
+        Session config with the thread settings of hyperparameters intra_op_threads and inter_op_threads.
+        With memory_saving 'recompute', grappler recomputes cheap activations in the backward pass instead of keeping them,
+        with 'all', it also swaps tensors to host memory. Swapping of rnn loops is set in the graph, see _swap_memory.
+        With jit, XLA clusters the small ops of the training and inference graphs and compiles them, once for each new shape
+        @return: tf.ConfigProto
+        '''
+        from tensorflow.core.protobuf import rewriter_config_pb2
+
+        config = tf.ConfigProto(
+                intra_op_parallelism_threads=self.hyparams.intra_op_threads or 0,
+                inter_op_parallelism_threads=self.hyparams.inter_op_threads or 0)
+        if self.hyparams.memory_saving == 'recompute':
+            config.graph_options.rewrite_options.memory_optimization = rewriter_config_pb2.RewriterConfig.RECOMPUTATION_HEURISTICS
+        elif self.hyparams.memory_saving == 'all':
+            config.graph_options.rewrite_options.memory_optimization = rewriter_config_pb2.RewriterConfig.HEURISTICS
+
+        if self.hyparams.jit:
+            if self._jit_available():
+                # Auto clustering on cpu is only enabled by the flag
+                xla_flags = os.environ.get('TF_XLA_FLAGS', '')
+                if '--tf_xla_cpu_global_jit' not in xla_flags:
+                    os.environ['TF_XLA_FLAGS'] = (xla_flags + ' --tf_xla_cpu_global_jit').strip()
+                config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+            else:
+                print('XLA is not available in this tensorflow build, the graph is not compiled')
+        return config
+
+
+    @staticmethod
+    def _jit_available():
+        '''
+        Whether tensorflow is built with XLA, which registers the XlaLaunch op
+        @return: bool
+        '''
+        try:
+            from tensorflow.python.framework import op_def_registry
+            return 'XlaLaunch' in op_def_registry.get_registered_ops()
+        except (ImportError, AttributeError):
+            return False
+
+
+    def _swap_memory(self):
+        '''
+        Whether the training rnn loops swap their activations to host memory, by hyperparameter memory_saving.
+        Activations of every timestep are kept for the backward pass, thus memory grows with batch size times sequence length.
+        Swapping moves them to host memory during the forward pass and back for the backward pass, slower but bounded by host memory
+        @return: bool
+        '''
+        return self.hyparams.memory_saving in ('swap', 'all')
+
+
+    def _beam_widths(self):
+        '''
+        Beam widths built into the graph: greedy decoding, powers of 2 and the trained beam_width.
+        Decoders of all widths share the trained variables, thus each one only adds its ops to the graph
+        @return: list, sorted beam widths, 1 for greedy decoding
+        '''
+        widths = [1]
+        while widths[-1] * 2 < self.max_beam_width:
+            widths.append(widths[-1] * 2)
+        if self.max_beam_width > 1:
+            widths.append(self.max_beam_width)
+        return widths
+
+
+    def _runtime_beam_width(self, beam_width):
+        '''
+        The built beam width to run for a requested width, the narrowest one not narrower than the request
+        @beam_width: int, the requested width, None for hyperparameter beam_width
+        @return: int
+        '''
+        beam_width = beam_width or self.hyparams.beam_width
+        if not 1 <= beam_width <= self.max_beam_width:
+            raise ValueError('beam_width should be between 1 and {} as trained, got {}'.format(self.max_beam_width, beam_width))
+        return min(width for width in self._beam_widths() if width >= beam_width)
+
+
+    def _build_graph(self):
+        '''
+        Build the training and inference graph, create session and initialize variables.
+        Dictionaries should be parsed before building the graph.
         @return: None
         '''
-        if not load_model_path:
-            # Train model from start
-            print('Train new model')
+        _import_tf()
+        # create placeholder
+        ## why the shape is [None, None]? explain
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            encoder_input = tf.placeholder(tf.int32, shape=[None, None], name='inputs')
+            decoder_target = tf.placeholder(tf.int32, shape=[None, None], name='targets')
+            # Batch size is taken from the fed inputs, so that one graph serves training, evaluation and inference batches
+            batch_size = tf.shape(encoder_input)[0]
+            decoder_input = tf.concat(
+                    [tf.fill([batch_size,1], self.decoder_vocab_to_int['<GO>']), 
+                    decoder_target[:, :-1]],
+                    1)
+            keep_prob = tf.placeholder(tf.float32, name='dropout')
             
-            # Create dictionary
-            self.encoder_int_to_vocab, self.encoder_vocab_to_int = self._parse_dict(encode_file_paths)
-            self.decoder_int_to_vocab, self.decoder_vocab_to_int = self._parse_dict(decode_file_paths)
-
-            multi_file_training = True if len(encode_file_paths) > 1 else False 
+            ## why does it need sequence length placeholder? explain
+            encoder_input_seq_lengths = tf.placeholder(tf.int32, shape=[None,], name='source_lens')
+            decoder_target_seq_lengths = tf.placeholder(tf.int32, shape=[None,], name='target_lens')
 
-            # create placeholder
-            ## why the shape is [None, None]? explain
-            self.graph = tf.Graph()
-            with self.graph.as_default():
-                encoder_input = tf.placeholder(tf.int32, shape=[None, None], name='inputs')
-                decoder_target = tf.placeholder(tf.int32, shape=[None, None], name='targets')
-                decoder_input = tf.concat(
-                        [tf.fill([self.hyparams.train_batch_size,1], self.decoder_vocab_to_int['<GO>']), 
-                        tf.strided_slice(decoder_target, [0,0], [self.hyparams.train_batch_size,-1], [1,1])],
-                        1)
-                keep_prob = tf.placeholder(tf.float32, name='dropout')
-                
-                ## why does it need sequence length placeholder? explain
-                encoder_input_seq_lengths = tf.placeholder(tf.int32, shape=[None,], name='source_lens')
-                decoder_target_seq_lengths = tf.placeholder(tf.int32, shape=[None,], name='target_lens')
+            # Decoding options chosen per run, 1 means greedy decoding, and 0 max_decode_len means twice the longest input
+            beam_width = tf.placeholder_with_default(self.hyparams.beam_width, shape=[], name='beam_width')
+            max_decode_len = tf.placeholder_with_default(0, shape=[], name='max_decode_len')
+            decode_timeout_ms = tf.placeholder_with_default(0.0, shape=[], name='decode_timeout_ms')
+            self.max_beam_width = self.hyparams.beam_width
 
 
 
-                ###### ENCODER ######
-                with tf.variable_scope('encoder'):
-                    encoder_wordvec = tf.contrib.layers.embed_sequence(encoder_input, len(self.encoder_int_to_vocab), self.hyparams.embedding_dim,
+            ###### ENCODER ######
+            with tf.variable_scope('encoder'):
+                # Same variable as tf.contrib.layers.embed_sequence, kept as a tensor so the decoder can share it
+                with tf.variable_scope('EmbedSequence'):
+                    encoder_embedding_weights = tf.get_variable('embeddings', [len(self.encoder_int_to_vocab), self.hyparams.embedding_dim],
                             initializer=tf.initializers.random_uniform(-0.1,0.1))
-                    
-                    # reshape_encoder_input = tf.reshape(encoder_input, [])
-                    # encoder_embedding_weights = tf.Variable(tf.random_uniform([len(self.encoder_int_to_vocab), self.hyparams.embedding_dim], minval=-0.1, maxval=0.1), name='encoder_embed_weight')
-                    # encoder_embedding_bias = tf.Variable(tf.random_uniform([self.hyparams.embedding_dim], minval=-0.1, maxval=0.1), name='encoder_embed_bias')
-                    # encoder_wordvec = tf.nn.embedding_lookup(encoder_embedding_weights, encoder_input) #+ encoder_embedding_bias
-
-                    # # To use stacked uni-directional rnn encoder, open this
-                    # rnn_cell_list = [self._rnn_cell(self.hyparams.rnn_layer_size, keep_prob) for _ in range(self.hyparams.n_rnn_layers)]
-                    # encoder_rnn = tf.nn.rnn_cell.MultiRNNCell(rnn_cell_list)
-                    # encoder_output, encoder_final_state = tf.nn.dynamic_rnn(encoder_rnn, encoder_wordvec, sequence_length=encoder_input_seq_lengths, dtype=tf.float32)
-
-                    # # print(encoder_output.get_shape())
-                    # # print(encoder_final_state)
-
-
-                    # To use stacked bi-directional rnn encoder, open this
-                    # Explain for the state concat, explain
-                    rnn_cell_list_forward = [self._rnn_cell(self.hyparams.rnn_layer_size // 2, keep_prob) for _ in range(self.hyparams.n_rnn_layers)]
-                    rnn_cell_list_backward = [self._rnn_cell(self.hyparams.rnn_layer_size // 2, keep_prob) for _ in range(self.hyparams.n_rnn_layers)]
-
-                    encoder_output, forward_final_state, backward_final_state = tf.contrib.rnn.stack_bidirectional_dynamic_rnn(
-                            rnn_cell_list_forward, rnn_cell_list_backward, encoder_wordvec,
-                            sequence_length=encoder_input_seq_lengths, time_major=False,
-                            dtype=tf.float32
-                            )
-                    
+                encoder_wordvec = tf.nn.embedding_lookup(encoder_embedding_weights, encoder_input)
+                
+                # reshape_encoder_input = tf.reshape(encoder_input, [])
+                # encoder_embedding_weights = tf.Variable(tf.random_uniform([len(self.encoder_int_to_vocab), self.hyparams.embedding_dim], minval=-0.1, maxval=0.1), name='encoder_embed_weight')
+                # encoder_embedding_bias = tf.Variable(tf.random_uniform([self.hyparams.embedding_dim], minval=-0.1, maxval=0.1), name='encoder_embed_bias')
+                # encoder_wordvec = tf.nn.embedding_lookup(encoder_embedding_weights, encoder_input) #+ encoder_embedding_bias
+
+                # # To use stacked uni-directional rnn encoder, open this
+                # rnn_cell_list = [self._rnn_cell(self.hyparams.rnn_layer_size, keep_prob) for _ in range(self.hyparams.n_rnn_layers)]
+                # encoder_rnn = tf.nn.rnn_cell.MultiRNNCell(rnn_cell_list)
+                # encoder_output, encoder_final_state = tf.nn.dynamic_rnn(encoder_rnn, encoder_wordvec, sequence_length=encoder_input_seq_lengths, dtype=tf.float32)
 
-                    # maybe the encoder_final_state can be updated
-                    # Use tensorboard to check it
-                    encoder_final_state = []
-                    for forward_cell_state, backward_cell_state in zip(forward_final_state, backward_final_state):
-                        concated_state = tf.concat([forward_cell_state.c, backward_cell_state.c], -1)
-                        concated_output = tf.concat([forward_cell_state.h, backward_cell_state.h], -1)
-                        encoder_final_state.append(tf.nn.rnn_cell.LSTMStateTuple(concated_state, concated_output))
-                    encoder_final_state = tuple(encoder_final_state)
+                # # print(encoder_output.get_shape())
+                # # print(encoder_final_state)
 
-                    if DEBUG:
-                        tf.summary.histogram('encoder_output', encoder_output)
-                        tf.summary.histogram('encoder_forward_state', forward_final_state)
-                        tf.summary.histogram('encoder_backward_state', backward_final_state)
 
+                # To use stacked bi-directional rnn encoder, open this
+                # Explain for the state concat, explain
+                encoder_output, encoder_final_state = self._encoder(encoder_wordvec, encoder_input_seq_lengths, keep_prob)
 
 
 
-                ##### DECODER ######
 
-                with tf.variable_scope('decoder_cell'):
+            ##### DECODER ######
+
+            with tf.variable_scope('decoder_cell'):
+                if self.hyparams.share_vocab:
+                    decoder_embedding_weights = encoder_embedding_weights
+                else:
                     decoder_embedding_weights = tf.Variable(tf.random_uniform([len(self.decoder_int_to_vocab), self.hyparams.embedding_dim], minval=-0.1, maxval=0.1), name='decoder_embed_weight')
-                    # decoder_embedding_bias = tf.Variable(tf.random_uniform([self.hyparams.embedding_dim], minval=-0.1, maxval=0.1), name='decoder_embed_bias')
-                    decoder_wordvec = tf.nn.embedding_lookup(decoder_embedding_weights, decoder_input) #+ decoder_embedding_bias
-                    rnn_cell_list = [self._rnn_cell(self.hyparams.rnn_layer_size, keep_prob) for _ in range(self.hyparams.n_rnn_layers)]
-                    decoder_rnn = tf.nn.rnn_cell.MultiRNNCell(rnn_cell_list)
+                # decoder_embedding_bias = tf.Variable(tf.random_uniform([self.hyparams.embedding_dim], minval=-0.1, maxval=0.1), name='decoder_embed_bias')
+                decoder_wordvec = tf.nn.embedding_lookup(decoder_embedding_weights, decoder_input) #+ decoder_embedding_bias
+                rnn_cell_list = [self._rnn_cell(self.hyparams.rnn_layer_size, keep_prob) for _ in range(self.hyparams.n_rnn_layers)]
+                decoder_rnn = tf.nn.rnn_cell.MultiRNNCell(rnn_cell_list)
+                if self.hyparams.tie_embeddings or self.hyparams.output_rank:
+                    decoder_output_dense_layer = OutputProjection(
+                            len(self.decoder_int_to_vocab),
+                            rank=self.hyparams.output_rank or (self.hyparams.embedding_dim if self.hyparams.tie_embeddings and self.hyparams.embedding_dim != self.hyparams.rnn_layer_size else 0),
+                            tied_embedding=decoder_embedding_weights if self.hyparams.tie_embeddings else None,
+                            kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1),
+                            name='decoder_output_embedding')
+                else:
                     decoder_output_dense_layer = tf.layers.Dense(len(self.decoder_int_to_vocab), use_bias=False,
                             kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1), name='decoder_output_embedding')
 
-                with tf.variable_scope('decoder'):
-                    training_helper = tf.contrib.seq2seq.TrainingHelper(
-                            inputs=decoder_wordvec,
-                            sequence_length=decoder_target_seq_lengths,
-                            time_major=False)
-
-                    # Add attention mechanism
-                    attention_mechanism = tf.contrib.seq2seq.LuongAttention(
-                            self.hyparams.rnn_layer_size, encoder_output,
-                            memory_sequence_length=encoder_input_seq_lengths
-                            )
-
-                    # Wrapper Attention mechanism on plain rnn cell first
-                    training_decoder = tf.contrib.seq2seq.AttentionWrapper(
-                            decoder_rnn, attention_mechanism,
-                            attention_layer_size=self.hyparams.rnn_layer_size
-                            )
-
-                    # Make decoder and it's initial state with wrapped rnn cell
-                    training_decoder = tf.contrib.seq2seq.BasicDecoder(
-                            training_decoder,
-                            # decoder_rnn, # Used for vanilla case
-                            training_helper,
-                            training_decoder.zero_state(self.hyparams.train_batch_size,tf.float32).clone(cell_state=encoder_final_state),
-                            # encoder_final_state, # Used for vanilla case
-                            decoder_output_dense_layer
-                            )
-
-                    training_decoder_output = tf.contrib.seq2seq.dynamic_decode(
-                            training_decoder,
-                            impute_finished=True,
-                            maximum_iterations=tf.reduce_max(decoder_target_seq_lengths)
-                            )[0]
-
-                with tf.variable_scope('decoder', reuse=True):
-                    # Tiled start_token <GO>
-                    start_tokens = tf.tile(
-                            tf.constant([self.decoder_vocab_to_int['<GO>']], dtype=tf.int32),
-                            [self.hyparams.infer_batch_size],
-                            name='start_tokens')
-
-                    # # To use greedy decoder, open this
-                    # inference_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
-                     #     decoder_embedding_weights,
-                     #     start_tokens,
-                     #     self.decoder_vocab_to_int['<EOS>']
-                     #     )
-
-                    # inference_decoder = tf.contrib.seq2seq.BasicDecoder(
-                     #     inference_decoder,
-                     #     # decoder_rnn, # Used for vanilla case
-                     #     inference_helper,
-                     #     inference_decoder.zero_state(self.hyparams.train_batch_size,tf.float32).clone(cell_state=encoder_final_state),
-                     #     # encoder_final_state, # Used for vanilla case
-                     #     decoder_output_dense_layer
-                     #     )
-
-                    # To use beam search decoder, open this
-                    # Beam search tile
-                    tiled_encoder_output = tf.contrib.seq2seq.tile_batch(encoder_output, multiplier=self.hyparams.beam_width)
-                    tiled_encoder_input_seq_lengths = tf.contrib.seq2seq.tile_batch(encoder_input_seq_lengths, multiplier=self.hyparams.beam_width)
-                    # Explain the tile state, need explain, tile_batch can handle nested state
-                    tiled_encoder_final_state = tf.contrib.seq2seq.tile_batch(encoder_final_state, multiplier=self.hyparams.beam_width)
-
-                    attention_mechanism = tf.contrib.seq2seq.LuongAttention(
-                            self.hyparams.rnn_layer_size, tiled_encoder_output,
-                            memory_sequence_length=tiled_encoder_input_seq_lengths
-                            )
-
-                    inference_decoder = tf.contrib.seq2seq.AttentionWrapper(
-                            decoder_rnn, attention_mechanism,
-                            attention_layer_size=self.hyparams.rnn_layer_size
-                            )
-
-                    inference_decoder = tf.contrib.seq2seq.BeamSearchDecoder(
-                            inference_decoder,
-                            decoder_embedding_weights,
-                            start_tokens,
-                            self.decoder_vocab_to_int['<EOS>'],
-                            inference_decoder.zero_state(self.hyparams.infer_batch_size*self.hyparams.beam_width,tf.float32).clone(
-                                cell_state=tiled_encoder_final_state
-                                ),
-                            self.hyparams.beam_width,
-                            decoder_output_dense_layer,
-                            length_penalty_weight=0.0
-                            )
-
-                    inference_decoder_output = tf.contrib.seq2seq.dynamic_decode(
-                            inference_decoder,
-                            impute_finished=False,
-                            maximum_iterations=2*tf.reduce_max(encoder_input_seq_lengths)
-                            )[0]
-
-
-
-                ##### OPTIMIZATION #####
-                with tf.variable_scope('optimization'):
-
-                    # Get train_op
-                    training_logits = tf.identity(training_decoder_output.rnn_output, name='logits')
-                    inference_logits = tf.identity(inference_decoder_output.predicted_ids[:,:,0], name='predictions')
-                    # inference_logits = tf.identity(inference_decoder_output.rnn_output, name='predictions')
-                    decoder_output = tf.identity(training_decoder_output.sample_id, name='training_output')
-
-                    # Why mask, explain
-                    mask = tf.sequence_mask(decoder_target_seq_lengths, tf.reduce_max(decoder_target_seq_lengths), dtype=tf.float32, name='mask')
-                    
-                    global_step = tf.Variable(0, trainable=False)
-
-                    # Cost
-                    cost = tf.contrib.seq2seq.sequence_loss(
-                            training_logits,
-                            decoder_target,
-                            mask,
-                            name='cost'
-                            )
-
-                    # # Cost alternative
-                    # crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
-                    #         labels=decoder_target, logits=training_logits
-                    #         )
-                    # cost = (tf.reduce_sum(crossent * mask) / self.hyparams.train_batch_size)
-
-
-                    # lr = tf.train.exponential_decay(self.hyparams.learning_rate, global_step, DECAY_STEP, self.hyparams.decay_rate, True)
-                    lr = tf.placeholder(tf.float32, name='learning_rate')
-                    # optimizer = tf.train.GradientDescentOptimizer(lr)
-                    optimizer = tf.train.AdamOptimizer(lr)
-                    gradients = optimizer.compute_gradients(cost)
-                    capped_gradients = [(tf.clip_by_value(grad, -self.hyparams.max_gradient_norm, self.hyparams.max_gradient_norm), var) for grad, var in gradients if grad is not None]
-                    train_op = optimizer.apply_gradients(capped_gradients, global_step=global_step, name='train_op')
-
-                    # # Clip by global norm
-                    # trainable_params = tf.trainable_variables()
-                    # gradients = tf.gradients(cost, trainable_params)
-                    # capped_gradients,_ = tf.clip_by_global_norm(gradients, self.hyparams.max_gradient_norm)
-                    # optimizer = tf.train.AdamOptimizer(self.hyparams.learning_rate)
-                    # train_op = optimizer.apply_gradients(zip(capped_gradients, trainable_params), global_step=global_step, name='train_op')
-
-                if DEBUG:
-                    tf.summary.scalar('seq_loss', cost)
-                    # tf.summary.scalar('learning_rate', optimizer._lr)
-
-                    trainable_params = tf.trainable_variables()
-                    gradients = tf.gradients(cost, trainable_params)
-                    for param, gradient in zip(trainable_params, gradients):
-                        if gradient is not None:
-                            tf.summary.histogram(param.name, gradient)
-
-
-                # Save op to collection for further use
-                tf.add_to_collection("optimization", train_op)
-                tf.add_to_collection("optimization", cost)
-                tf.add_to_collection("optimization", global_step)
-
-                # Initialize the graph variables
-                self.sess = tf.Session()
-                self.sess.run(tf.global_variables_initializer())
-
-                # Save dictionary
-                if not os.path.isdir(self.model_ckpt_dir):
-                    os.mkdir(self.model_ckpt_dir)
-
-                with open(os.path.join(self.model_ckpt_dir, 'dictionary'), 'wb') as fp:
-                    dictionary = (self.encoder_int_to_vocab, self.encoder_vocab_to_int, self.decoder_int_to_vocab, self.decoder_vocab_to_int)
-                    pkl.dump(dictionary, fp)
-
-                with open(os.path.join(self.model_ckpt_dir, 'hparams'), 'wb') as fp:
-                    pkl.dump(self.hyparams, fp)
+            with tf.variable_scope('decoder') as decoder_scope:
+                training_helper = tf.contrib.seq2seq.TrainingHelper(
+                        inputs=decoder_wordvec,
+                        sequence_length=decoder_target_seq_lengths,
+                        time_major=False)
+
+                # Add attention mechanism
+                attention_mechanism = tf.contrib.seq2seq.LuongAttention(
+                        self.hyparams.rnn_layer_size, encoder_output,
+                        memory_sequence_length=encoder_input_seq_lengths
+                        )
+
+                # Wrapper Attention mechanism on plain rnn cell first
+                training_decoder = tf.contrib.seq2seq.AttentionWrapper(
+                        decoder_rnn, attention_mechanism,
+                        attention_layer_size=self.hyparams.rnn_layer_size
+                        )
+
+                # Make decoder and it's initial state with wrapped rnn cell
+                training_decoder = tf.contrib.seq2seq.BasicDecoder(
+                        training_decoder,
+                        # decoder_rnn, # Used for vanilla case
+                        training_helper,
+                        training_decoder.zero_state(batch_size,tf.float32).clone(cell_state=encoder_final_state),
+                        # encoder_final_state, # Used for vanilla case
+                        decoder_output_dense_layer
+                        )
+
+                training_decoder_output = tf.contrib.seq2seq.dynamic_decode(
+                        training_decoder,
+                        impute_finished=True,
+                        maximum_iterations=tf.reduce_max(decoder_target_seq_lengths),
+                        swap_memory=self._swap_memory()
+                        )[0]
+
+            trained_variables = [var.op.name for var in tf.trainable_variables()]
+            with tf.variable_scope('decoder', reuse=True):
+                # Tiled start_token <GO>
+                start_tokens = tf.tile(
+                        tf.constant([self.decoder_vocab_to_int['<GO>']], dtype=tf.int32),
+                        [batch_size],
+                        name='start_tokens')
+
+                maximum_iterations = tf.where(
+                        tf.greater(max_decode_len, 0),
+                        max_decode_len,
+                        2*tf.reduce_max(encoder_input_seq_lengths))
+
+                # The clock starts with the run, as the timestamp depends on nothing
+                decode_deadline = tf.where(
+                        tf.greater(decode_timeout_ms, 0),
+                        tf.timestamp() + tf.cast(decode_timeout_ms, tf.float64) / 1000,
+                        tf.constant(np.inf, dtype=tf.float64))
+
+                def greedy_decode():
+                    # Each branch re-enters the decoder scope, whose exit resets the counts of layer names,
+                    # thus its new attention layers resolve to the trained memory_layer and attention_layer, not memory_layer_1
+                    with tf.variable_scope(decoder_scope, reuse=True):
+                        attention_mechanism = tf.contrib.seq2seq.LuongAttention(
+                                self.hyparams.rnn_layer_size, encoder_output,
+                                memory_sequence_length=encoder_input_seq_lengths
+                                )
+
+                        inference_decoder = tf.contrib.seq2seq.AttentionWrapper(
+                                decoder_rnn, attention_mechanism,
+                                attention_layer_size=self.hyparams.rnn_layer_size
+                                )
+
+                        inference_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
+                                decoder_embedding_weights,
+                                start_tokens,
+                                self.decoder_vocab_to_int['<EOS>']
+                                )
+
+                        inference_decoder = DeadlineBasicDecoder(
+                                inference_decoder,
+                                inference_helper,
+                                inference_decoder.zero_state(batch_size,tf.float32).clone(cell_state=encoder_final_state),
+                                decoder_output_dense_layer,
+                                deadline=decode_deadline
+                                )
+
+                        inference_decoder_output = tf.contrib.seq2seq.dynamic_decode(
+                                inference_decoder,
+                                impute_finished=True,
+                                maximum_iterations=maximum_iterations
+                                )[0]
+                        return inference_decoder_output.sample_id
+
+                def beam_search_decode(width):
+                    with tf.variable_scope(decoder_scope, reuse=True):
+                        # Beam search tile
+                        tiled_encoder_output = tf.contrib.seq2seq.tile_batch(encoder_output, multiplier=width)
+                        tiled_encoder_input_seq_lengths = tf.contrib.seq2seq.tile_batch(encoder_input_seq_lengths, multiplier=width)
+                        # Explain the tile state, need explain, tile_batch can handle nested state
+                        tiled_encoder_final_state = tf.contrib.seq2seq.tile_batch(encoder_final_state, multiplier=width)
+
+                        attention_mechanism = tf.contrib.seq2seq.LuongAttention(
+                                self.hyparams.rnn_layer_size, tiled_encoder_output,
+                                memory_sequence_length=tiled_encoder_input_seq_lengths
+                                )
+
+                        inference_decoder = tf.contrib.seq2seq.AttentionWrapper(
+                                decoder_rnn, attention_mechanism,
+                                attention_layer_size=self.hyparams.rnn_layer_size
+                                )
+
+                        inference_decoder = DeadlineBeamSearchDecoder(
+                                inference_decoder,
+                                decoder_embedding_weights,
+                                start_tokens,
+                                self.decoder_vocab_to_int['<EOS>'],
+                                inference_decoder.zero_state(batch_size*width,tf.float32).clone(
+                                    cell_state=tiled_encoder_final_state
+                                    ),
+                                width,
+                                decoder_output_dense_layer,
+                                length_penalty_weight=0.0,
+                                deadline=decode_deadline
+                                )
+
+                        inference_decoder_output = tf.contrib.seq2seq.dynamic_decode(
+                                inference_decoder,
+                                impute_finished=False,
+                                maximum_iterations=maximum_iterations
+                                )[0]
+                        return inference_decoder_output.predicted_ids[:,:,0]
+
+                # BeamSearchDecoder needs a static width, so one decoder is built for each width of _beam_widths,
+                # and the one of the fed beam_width runs. The widest one is only built as the default branch
+                widths = self._beam_widths()
+                decoders = [greedy_decode if width == 1 else (lambda width=width: beam_search_decode(width)) for width in widths]
+                inference_predicted_ids = tf.case(
+                        [(tf.equal(beam_width, width), decoder) for width, decoder in zip(widths[:-1], decoders[:-1])],
+                        default=decoders[-1],
+                        exclusive=False)
+
+            # Decoders of every width should share the trained variables, a new one would never be trained
+            new_variables = [var.op.name for var in tf.trainable_variables() if var.op.name not in trained_variables]
+            if new_variables:
+                raise RuntimeError('Inference decoders created variables which are not trained: {}'.format(new_variables))
+
+
+
+            ##### OPTIMIZATION #####
+            with tf.variable_scope('optimization'):
+
+                # Get train_op
+                training_logits = tf.identity(training_decoder_output.rnn_output, name='logits')
+                inference_logits = tf.identity(inference_predicted_ids, name='predictions')
+                decoder_output = tf.identity(training_decoder_output.sample_id, name='training_output')
+
+                # Why mask, explain
+                mask = tf.sequence_mask(decoder_target_seq_lengths, tf.reduce_max(decoder_target_seq_lengths), dtype=tf.float32, name='mask')
+                
+                global_step = tf.Variable(0, trainable=False)
+
+                # Cost
+                cost = tf.contrib.seq2seq.sequence_loss(
+                        training_logits,
+                        decoder_target,
+                        mask,
+                        name='cost'
+                        )
+
+                # # Cost alternative
+                # crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                #         labels=decoder_target, logits=training_logits
+                #         )
+                # cost = (tf.reduce_sum(crossent * mask) / self.hyparams.train_batch_size)
+
+
+                # lr = tf.train.exponential_decay(self.hyparams.learning_rate, global_step, DECAY_STEP, self.hyparams.decay_rate, True)
+                lr = tf.placeholder(tf.float32, name='learning_rate')
+                # optimizer = tf.train.GradientDescentOptimizer(lr)
+                optimizer = tf.train.AdamOptimizer(lr)
+                gradients = optimizer.compute_gradients(cost)
+                capped_gradients = [(tf.clip_by_value(grad, -self.hyparams.max_gradient_norm, self.hyparams.max_gradient_norm), var) for grad, var in gradients if grad is not None]
+                train_op = optimizer.apply_gradients(capped_gradients, global_step=global_step, name='train_op')
+
+                # # Clip by global norm
+                # trainable_params = tf.trainable_variables()
+                # gradients = tf.gradients(cost, trainable_params)
+                # capped_gradients,_ = tf.clip_by_global_norm(gradients, self.hyparams.max_gradient_norm)
+                # optimizer = tf.train.AdamOptimizer(self.hyparams.learning_rate)
+                # train_op = optimizer.apply_gradients(zip(capped_gradients, trainable_params), global_step=global_step, name='train_op')
+
+            if DEBUG:
+                tf.summary.scalar('seq_loss', cost)
+                # tf.summary.scalar('learning_rate', optimizer._lr)
+
+                trainable_params = tf.trainable_variables()
+                gradients = tf.gradients(cost, trainable_params)
+                for param, gradient in zip(trainable_params, gradients):
+                    if gradient is not None:
+                        tf.summary.histogram(param.name, gradient)
+
+
+            # Save op to collection for further use
+            tf.add_to_collection("optimization", train_op)
+            tf.add_to_collection("optimization", cost)
+            tf.add_to_collection("optimization", global_step)
+
+            # Initialize the graph variables
+            self.sess = tf.Session(config=self._session_config())
+            self.sess.run(tf.global_variables_initializer())
+
+
+    def _train(self, encode_file_paths, decode_file_paths, load_model_path=None):
+        '''
+        Main training method. After training your model instance will be saved.
+        @encode_file_paths: str or list/tuple, the path or a list of paths of the encoder training file(s)
+        @decode_file_paths: str or list/tuple, the path or a list of paths of the decoder training file(s)
+        @load_model_path: str, the path of existed model directory
+        @return: None
+        '''
+        if not load_model_path:
+            # Train model from start
+            print('Train new model')
+            
+            # Create dictionary, a prepared one in the model directory is used if exists, e.g. shared by trials of a sweep
+            if os.path.isfile(os.path.join(self.model_ckpt_dir, 'dictionary')):
+                with open(os.path.join(self.model_ckpt_dir, 'dictionary'), 'rb') as fp:
+                    self.encoder_int_to_vocab, self.encoder_vocab_to_int, self.decoder_int_to_vocab, self.decoder_vocab_to_int = pkl.load(fp)
+            elif self.hyparams.share_vocab:
+                as_list = lambda paths: [paths] if isinstance(paths, str) else list(paths)
+                self.encoder_int_to_vocab, self.encoder_vocab_to_int = self._parse_dict(as_list(encode_file_paths) + as_list(decode_file_paths))
+                self.decoder_int_to_vocab, self.decoder_vocab_to_int = self.encoder_int_to_vocab, self.encoder_vocab_to_int
+            else:
+                self.encoder_int_to_vocab, self.encoder_vocab_to_int = self._parse_dict(encode_file_paths)
+                self.decoder_int_to_vocab, self.decoder_vocab_to_int = self._parse_dict(decode_file_paths)
+
+            multi_file_training = True if len(encode_file_paths) > 1 else False 
+
+            self._build_graph()
+
+            # Save dictionary
+            if not os.path.isdir(self.model_ckpt_dir):
+                os.mkdir(self.model_ckpt_dir)
+
+            with open(os.path.join(self.model_ckpt_dir, 'dictionary'), 'wb') as fp:
+                dictionary = (self.encoder_int_to_vocab, self.encoder_vocab_to_int, self.decoder_int_to_vocab, self.decoder_vocab_to_int)
+                pkl.dump(dictionary, fp)
+
+            with open(os.path.join(self.model_ckpt_dir, 'hparams'), 'wb') as fp:
+                pkl.dump(self.hyparams, fp)
 
         else:
             # Pre-trained model has loaded
             print('Load pre-trained model')
             self.load(load_model_path)
+            if self.frozen:
+                raise ValueError('{} is an exported model, which can not be trained'.format(load_model_path))
 
-            with self.graph.as_default():
-                encoder_input = self.graph.get_tensor_by_name('inputs:0')
-                encoder_input_seq_lengths = self.graph.get_tensor_by_name('source_lens:0')
-                decoder_target = self.graph.get_tensor_by_name('targets:0')
-                decoder_target_seq_lengths = self.graph.get_tensor_by_name('target_lens:0')
-                keep_prob = self.graph.get_tensor_by_name('dropout:0')
-                decoder_output = self.graph.get_tensor_by_name('optimization/training_output:0')
-                lr = self.graph.get_tensor_by_name('optimization/learning_rate:0')
-                train_op = tf.get_collection("optimization")[0]
-                cost = tf.get_collection("optimization")[1]
-                global_step = tf.get_collection("optimization")[2]
+        with self.graph.as_default():
+            encoder_input = self.graph.get_tensor_by_name('inputs:0')
+            encoder_input_seq_lengths = self.graph.get_tensor_by_name('source_lens:0')
+            decoder_target = self.graph.get_tensor_by_name('targets:0')
+            decoder_target_seq_lengths = self.graph.get_tensor_by_name('target_lens:0')
+            keep_prob = self.graph.get_tensor_by_name('dropout:0')
+            decoder_output = self.graph.get_tensor_by_name('optimization/training_output:0')
+            lr = self.graph.get_tensor_by_name('optimization/learning_rate:0')
+            train_op = tf.get_collection("optimization")[0]
+            cost = tf.get_collection("optimization")[1]
+            global_step = tf.get_collection("optimization")[2]
 
 
         encode_pad_id = self.encoder_vocab_to_int['<PAD>']
@@ -858,24 +1566,46 @@ class Seq2seq:
 
         # Train the model
         with self.graph.as_default():
-            # Create a saver
-            saver = tf.train.Saver(max_to_keep=1)
+            # The meta graph never changes while training, write it only once
+            if not os.path.isfile(self.model_ckpt_path + '.meta'):
+                tf.train.Saver().export_meta_graph(self.model_ckpt_path + '.meta')
+
+            # Checkpoints are written on a background thread
+            checkpoint_writer = CheckpointWriter(self.sess, tf.global_variables(), self.model_ckpt_path,
+                    self.hyparams.keep_checkpoints, self.hyparams.keep_best_checkpoint)
+            val_loss = None
+
+            # Padded validation sets of each file, evaluated every {eval_every} steps
+            eval_sets = {}
+            eval_loss = None
 
             # Learning rate generator
             lr_gen = self.lr_schedule(self.hyparams.learning_rate, self.hyparams.decay_start_at, self.hyparams.decay_every, self.hyparams.decay_rate)
 
+            summary_writer = tf.summary.FileWriter(os.path.join(self.model_ckpt_dir, 'tensorboard'))
             if DEBUG:
-                summary_writer = tf.summary.FileWriter(os.path.join(self.model_ckpt_dir, 'tensorboard'))
                 summary_writer.add_graph(self.sess.graph)
                 summary_ops = tf.summary.merge_all()
 
+            # Time of each phase and number of tokens between two reports
+            monitor = TrainingMonitor(['data', 'train', 'valid', 'eval', 'summary', 'save'])
+            tracer = Tracer(self.hyparams.trace_steps, os.path.join(self.model_ckpt_dir, 'timeline'))
+
             g_step = self.sess.run(global_step)
-            recover_step = g_step
 
-            # Recover running state
+            # Recover running state, a dict of epoch, file and batches trained in that file
+            # Older models only saved the epoch, then batches are skipped by the global step
+            recover_state = None
+            recover_step = 0
             if os.path.isfile(os.path.join(self.model_ckpt_dir, 'running_state')):
                 with open(os.path.join(self.model_ckpt_dir, 'running_state'), 'rb') as fp:
-                    (start_epoch) = pkl.load(fp)
+                    running_state = pkl.load(fp)
+                if isinstance(running_state, dict):
+                    start_epoch = running_state['epoch']
+                    recover_state = running_state
+                else:
+                    start_epoch = running_state
+                    recover_step = g_step
             else:
                 start_epoch = 1
 
@@ -886,8 +1616,9 @@ class Seq2seq:
                 for file_i, (encode_seqs, decode_seqs) in enumerate(seqs_gen):
 
                     # Validate set reserve
+                    # The split of each file is fixed among epochs, thus validation data is never trained on and is padded only once
                     n_valid_data = int(len(encode_seqs) * self.hyparams.valid_portion) // self.hyparams.train_batch_size * self.hyparams.train_batch_size
-                    valid_idx_set = set(np.random.choice(np.arange(len(encode_seqs)), n_valid_data, replace=False))
+                    valid_idx_set = set(np.random.RandomState(file_i).choice(np.arange(len(encode_seqs)), n_valid_data, replace=False))
                     
                     valid_encode_seqs = [seq for i, seq in enumerate(encode_seqs) if i in valid_idx_set]
                     valid_decode_seqs = [seq for i, seq in enumerate(decode_seqs) if i in valid_idx_set]
@@ -898,48 +1629,108 @@ class Seq2seq:
 
                     n_batch = len(train_encode_seqs) // self.hyparams.train_batch_size
 
-                    batch_generator = self._padding_batch(train_encode_seqs, train_decode_seqs, self.hyparams.train_batch_size, encode_pad_id, decode_pad_id)
-
-                    if recover_step > n_batch:
+                    # Estimate the cost before training a new model, with the statistics of the first file
+                    if g_step == 0 and file_i == 0 and recover_state is None:
+                        cost_estimate = self._estimate_cost(
+                                np.mean([len(seq) for seq in train_encode_seqs]),
+                                np.mean([len(seq) for seq in train_decode_seqs]) + 1)
+                        print('Parameters: {} ({}), weights + Adam: {:.1f} MB, forward flops per target token: {:.3g}'.format(
+                            cost_estimate['params_total'], ', '.join(['{} {}'.format(k, v) for k, v in cost_estimate['params'].items()]),
+                            cost_estimate['memory_mb']['total'], cost_estimate['forward_flops_per_target_token']))
+                        self._check_cost(cost_estimate)
+
+                        if self.hyparams.calibration_steps and n_batch:
+                            cost_estimate.update(self._calibrate(train_encode_seqs, train_decode_seqs, self.hyparams.calibration_steps))
+                            print('Step: {:.3f}s, epoch of file #{}: {:.1f} hours'.format(cost_estimate['step_sec'], file_i + 1, cost_estimate['epoch_sec'] / 3600))
+
+                        with open(os.path.join(self.model_ckpt_dir, 'cost_estimate.json'), 'w') as fp:
+                            json.dump(cost_estimate, fp, indent=2)
+                        self._check_cost(cost_estimate)
+
+                    # Number of batches of this file trained before recovering
+                    if recover_state is not None:
+                        if file_i < recover_state['file']:
+                            continue
+                        n_skip = recover_state['batch']
+                        recover_state = None
+                    elif recover_step > n_batch:
                         recover_step -= n_batch
                         continue
                     else:
-                        for _ in range(recover_step):
-                            _ = next(batch_generator)
-
+                        n_skip = recover_step
                         recover_step = 0
 
-                    for cur_batch_pack in batch_generator:
+                    if self.hyparams.curriculum_steps:
+                        batch_generator = self._curriculum_batch(train_encode_seqs, train_decode_seqs, self.hyparams.train_batch_size, encode_pad_id, decode_pad_id,
+                                start_step=g_step - n_skip, seed=[epoch_i, file_i])
+                    else:
+                        batch_generator = self._padding_batch(train_encode_seqs, train_decode_seqs, self.hyparams.train_batch_size, encode_pad_id, decode_pad_id)
+
+                    for _ in zip(range(n_skip), batch_generator):
+                        pass
+                    file_batch_i = n_skip
+
+                    for cur_batch_pack in monitor.timed_iter('data', batch_generator):
                         inputs, inputs_lens, targets, targets_lens = cur_batch_pack
+                        monitor.count(inputs, targets, encode_pad_id, decode_pad_id)
 
                         lr_val = next(lr_gen)
-                        _, train_loss, g_step = self.sess.run(
-                                [train_op, cost, global_step],
-                                feed_dict={
-                                    encoder_input:inputs,
-                                    encoder_input_seq_lengths:inputs_lens,
-                                    decoder_target:targets,
-                                    decoder_target_seq_lengths:targets_lens,
-                                    keep_prob: self.hyparams.keep_prob,
-                                    lr: lr_val
-                                    }
-                                )
+                        trace_kwargs = tracer.run_kwargs(g_step + 1)
+                        with monitor.phase('train'):
+                            _, train_loss, g_step = self.sess.run(
+                                    [train_op, cost, global_step],
+                                    feed_dict={
+                                        encoder_input:inputs,
+                                        encoder_input_seq_lengths:inputs_lens,
+                                        decoder_target:targets,
+                                        decoder_target_seq_lengths:targets_lens,
+                                        keep_prob: self.hyparams.keep_prob,
+                                        lr: lr_val
+                                        },
+                                    **trace_kwargs
+                                    )
+                        tracer.dump(g_step, trace_kwargs, 'train')
+                        file_batch_i += 1
                         print("\r{}/{} ".format(g_step % n_batch, n_batch), end='', flush=True)
 
                         if g_step % self.hyparams.report_every == 0:
-                            valid_batch_pack = next(valid_batch_generator)
-                            valid_inputs, valid_inputs_lens, valid_targets, valid_targets_lens = valid_batch_pack
-
-                            val_loss, prediction_lists = self.sess.run([cost, decoder_output], feed_dict={
-                                encoder_input:valid_inputs,
-                                encoder_input_seq_lengths:valid_inputs_lens,
-                                decoder_target:valid_targets,
-                                decoder_target_seq_lengths:valid_targets_lens,
-                                keep_prob: 1.0
-                                })
-
-                            bleu_score = self._bleu(prediction_lists, valid_targets, self.hyparams.bleu_max_order, self.hyparams.bleu_smooth)
-                            print("E:{}/{} F:{} B:{} - train loss: {}\tvalid loss: {}\tvalid bleu: {}\tlr: {}".format(epoch_i, self.hyparams.epoch, file_i, g_step, train_loss, val_loss, bleu_score, lr_val))
+                            with monitor.phase('valid'):
+                                valid_batch_pack = next(valid_batch_generator)
+                                valid_inputs, valid_inputs_lens, valid_targets, valid_targets_lens = valid_batch_pack
+
+                                val_loss, prediction_lists = self.sess.run([cost, decoder_output], feed_dict={
+                                    encoder_input:valid_inputs,
+                                    encoder_input_seq_lengths:valid_inputs_lens,
+                                    decoder_target:valid_targets,
+                                    decoder_target_seq_lengths:valid_targets_lens,
+                                    keep_prob: 1.0
+                                    })
+
+                                # Padding and <EOS> would inflate the matches
+                                stop_ids = [decode_pad_id, self.decoder_vocab_to_int['<EOS>']]
+                                bleu_score = self._bleu_from_stats(self._bleu_stats(
+                                    prediction_lists, self._seq_lens(prediction_lists, stop_ids),
+                                    valid_targets, self._seq_lens(valid_targets, stop_ids),
+                                    self.hyparams.bleu_max_order), self.hyparams.bleu_max_order, self.hyparams.bleu_smooth)
+                                print("E:{}/{} F:{} B:{} - train loss: {}\tvalid loss: {}\tvalid bleu: {}\tlr: {}".format(epoch_i, self.hyparams.epoch, file_i, g_step, train_loss, val_loss, bleu_score, lr_val))
+
+                        if self.hyparams.eval_every and g_step % self.hyparams.eval_every == 0 and valid_encode_seqs:
+                            with monitor.phase('eval'):
+                                if file_i not in eval_sets:
+                                    eval_sets[file_i] = self._build_eval_set(valid_encode_seqs, valid_decode_seqs, self.hyparams.eval_batch_size)
+                                eval_result = self._evaluate(eval_sets[file_i])
+                                eval_loss = eval_result['loss']
+                                print("E:{}/{} F:{} B:{} - eval loss: {}\teval bleu: {}\t{} pairs in {:.1f}s".format(
+                                    epoch_i, self.hyparams.epoch, file_i, g_step, eval_result['loss'], eval_result['bleu'], eval_result['n_pairs'], eval_result['wall_time']))
+
+                            with open(os.path.join(self.model_ckpt_dir, 'eval_log'), 'a') as fp:
+                                fp.write(json.dumps(dict(eval_result, global_step=int(g_step), epoch=epoch_i, file=file_i)) + '\n')
+
+                            summary_writer.add_summary(tf.Summary(value=[
+                                tf.Summary.Value(tag='eval/loss', simple_value=eval_result['loss']),
+                                tf.Summary.Value(tag='eval/bleu', simple_value=eval_result['bleu']),
+                                tf.Summary.Value(tag='eval/wall_time', simple_value=eval_result['wall_time']),
+                                ]), g_step)
 
                         if g_step % self.hyparams.show_every == 0:
                             # Vivid example
@@ -954,19 +1745,28 @@ class Seq2seq:
                             print('*********')
                         
                         if g_step % self.hyparams.save_every == 0:
-                            saver.save(self.sess, self.model_ckpt_path, write_meta_graph=True)
-                            with open(os.path.join(self.model_ckpt_dir, 'running_state'), 'wb') as fp:
-                                pkl.dump((epoch_i), fp)
+                            with monitor.phase('save'):
+                                checkpoint_writer.save(g_step, {'epoch': epoch_i, 'file': file_i, 'batch': file_batch_i}, eval_loss if self.hyparams.eval_every else val_loss)
 
                         if DEBUG and g_step % self.hyparams.summary_every == 0:
-                            summary_info = self.sess.run(summary_ops, feed_dict={
-                                encoder_input:inputs,
-                                encoder_input_seq_lengths:inputs_lens,
-                                decoder_target:targets,
-                                decoder_target_seq_lengths:targets_lens,
-                                keep_prob: self.hyparams.keep_prob
-                                })
-                            summary_writer.add_summary(summary_info, self.sess.run(global_step))
+                            with monitor.phase('summary'):
+                                summary_info = self.sess.run(summary_ops, feed_dict={
+                                    encoder_input:inputs,
+                                    encoder_input_seq_lengths:inputs_lens,
+                                    decoder_target:targets,
+                                    decoder_target_seq_lengths:targets_lens,
+                                    keep_prob: self.hyparams.keep_prob
+                                    })
+                                summary_writer.add_summary(summary_info, self.sess.run(global_step))
+
+                        if g_step % self.hyparams.report_every == 0:
+                            speed = monitor.report()
+                            print("E:{}/{} F:{} B:{} - {:.1f} examples/s\t{:.0f} real tokens/s\tpadding: {:.1%}\ttime share: {}".format(
+                                epoch_i, self.hyparams.epoch, file_i, g_step, speed['examples_per_sec'], speed['real_tokens_per_sec'], speed['padding_ratio'],
+                                ' '.join(['{} {:.1%}'.format(name, speed['share/' + name]) for name in monitor.phases + ['other']])))
+                            summary_writer.add_summary(tf.Summary(value=[
+                                tf.Summary.Value(tag='speed/' + name, simple_value=value) for name, value in speed.items()
+                                ]), g_step)
 
                         if g_step > self.hyparams.max_global_step:
                             break
@@ -975,50 +1775,208 @@ class Seq2seq:
                 if g_step > self.hyparams.max_global_step:
                     break
 
+            checkpoint_writer.close()
 
-    def predict(self, encode_str):
+
+    def predict(self, encode_str, beam_width=None, max_decode_len=None, timeout_ms=None, return_truncated=False):
         '''
         Predict the sequence transformation. Make sure you load the model before using this method.
         @encode_str: str, the input string that we give to model for transforming. 
-        @return: str, the answer string of the model
+        @beam_width: int, width of beam search for this call, 1 for greedy decoding, default to hyperparameter beam_width
+        @max_decode_len: int, max length of the answer for this call, default to hyperparameter max_decode_len
+        @timeout_ms: float, latency budget of this call, default to hyperparameter decode_timeout_ms
+        @return_truncated: bool, whether also return if the answer is truncated
+        @return: str, the answer string of the model. (str, bool) with return_truncated
         '''
-        if not hasattr(self, 'sess'):
+        results = self.predict_batch([encode_str], beam_width, max_decode_len, timeout_ms, return_truncated)
+        return (results[0][0], results[1][0]) if return_truncated else results[0]
+
+
+    def predict_batch(self, encode_strs, beam_width=None, max_decode_len=None, timeout_ms=None, return_truncated=False):
+        '''
+        Predict the sequence transformation of many strings at once. Make sure you load the model before using this method.
+        Answers found in the prediction cache are not predicted again, and repeated inputs are predicted once.
+        Other inputs are sorted by length and packed into batches of up to {infer_batch_size} distinct inputs, so that padding is minimal.
+        True lengths are fed, and each answer is cut at its first <EOS>.
+        Beam search decoders are built for widths 2, 4, 8.. and the trained beam_width, the narrowest one not narrower than beam_width runs.
+        @encode_strs: list, the input strings
+        @beam_width: int, width of beam search for this call, 1 for greedy decoding, default to hyperparameter beam_width
+        @max_decode_len: int, max length of answers for this call, 0 for twice the length of the longest input, default to hyperparameter max_decode_len
+        @timeout_ms: float, latency budget of this call shared by its batches, decoding stops at it with the best answers so far. 0 for no limit, default to hyperparameter decode_timeout_ms
+        @return_truncated: bool, whether also return if each answer is truncated, i.e. stopped by timeout_ms or max_decode_len before <EOS>
+        @return: list, the answer strings of the model, in the order of encode_strs. (list, list) of answers and truncated flags with return_truncated
+        '''
+        start_time = time.time()
+        if not self._is_loaded():
             self.load(self.model_ckpt_dir)
 
+        beam_width = self._runtime_beam_width(beam_width)
+        max_decode_len = self.hyparams.max_decode_len if max_decode_len is None else max_decode_len
+        timeout_ms = self.hyparams.decode_timeout_ms if timeout_ms is None else timeout_ms
+
         encoder_unk_id = self.encoder_vocab_to_int['<UNK>']
-        decoder_pad_id = self.decoder_vocab_to_int['<PAD>']
+        encoder_pad_id = self.encoder_vocab_to_int['<PAD>']
         decoder_eos_id = self.decoder_vocab_to_int['<EOS>']
 
-        # Parse encode_str
-        encode_str = self.tp.process_str(encode_str)
-        inputs = [[self.encoder_vocab_to_int.get(word, encoder_unk_id) for word in encode_str.split()]]
-        inputs_lens = [len(line) for line in inputs]
-
-        with self.graph.as_default():
-            encoder_input = self.graph.get_tensor_by_name('inputs:0')
-            encoder_input_seq_lengths = self.graph.get_tensor_by_name('source_lens:0')
-            decoder_target_seq_lengths = self.graph.get_tensor_by_name('target_lens:0')
-            keep_prob = self.graph.get_tensor_by_name('dropout:0')
-            prediction = self.graph.get_tensor_by_name('optimization/predictions:0')
+        # Parse encode_strs
+        inputs = [[self.encoder_vocab_to_int.get(word, encoder_unk_id) for word in self.tp.process_str(encode_str).split()] for encode_str in encode_strs]
+        predict_strs = [None] * len(inputs)
+        # Cached answers are never truncated
+        truncated = [False] * len(inputs)
+
+        cache = self._prediction_cache() if self.checkpoint_signature else None
+        if cache is not None:
+            cache.validate(self.checkpoint_signature)
+            settings = self._decoding_settings(beam_width, max_decode_len)
+            keys = [json.dumps([input_ids, settings]) for input_ids in inputs]
+            predict_strs = [cache.get(key) for key in keys]
+
+        # Indexes of encode_strs for each distinct input to predict
+        pending = {}
+        for i, input_ids in enumerate(inputs):
+            if not input_ids:
+                # Nothing is left after processing, e.g. punctuation only. The encoder can not attend to an empty input
+                predict_strs[i] = ''
+            elif predict_strs[i] is None:
+                pending.setdefault(tuple(input_ids), []).append(i)
+        distinct_inputs = sorted(pending, key=len)
+
+        tracer = Tracer(self.hyparams.trace_steps, os.path.join(self.model_ckpt_dir, 'timeline'))
+        for start_i in range(0, len(distinct_inputs), self.hyparams.infer_batch_size):
+            batch = distinct_inputs[start_i: start_i+self.hyparams.infer_batch_size]
+            inputs_lens = [len(input_ids) for input_ids in batch]
+            batch_inputs = np.full((len(batch), max(inputs_lens)), encoder_pad_id, dtype=np.int32)
+            for j, input_ids in enumerate(batch):
+                batch_inputs[j, :inputs_lens[j]] = input_ids
+
+            batch_timeout_ms = timeout_ms
+            if timeout_ms > 0:
+                # Batches share the budget, a batch past the deadline stops after its first step
+                batch_timeout_ms = max(timeout_ms - (time.time() - start_time) * 1000, 1e-3)
+            predict_lists = self._predict_ids(batch_inputs, inputs_lens, beam_width, max_decode_len, batch_timeout_ms, tracer)
+
+            predict_lens = self._seq_lens(predict_lists, [decoder_eos_id])
+            new_entries = []
+            for input_ids, predict_list, predict_len in zip(batch, predict_lists, predict_lens):
+                predict_str = ' '.join([self.decoder_int_to_vocab.get(n, '') for n in predict_list[:predict_len]])
+                is_truncated = bool(predict_len == len(predict_list))
+                for i in pending[input_ids]:
+                    predict_strs[i] = predict_str
+                    truncated[i] = is_truncated
+                # Truncated answers depend on timing, they are not cached
+                if cache is not None and not is_truncated:
+                    new_entries.append((keys[pending[input_ids][0]], predict_str))
+
+            if cache is not None:
+                cache.put(new_entries)
+
+        if return_truncated:
+            return predict_strs, truncated
+        return predict_strs
+
+
+    def _predict_ids(self, batch_inputs, inputs_lens, beam_width, max_decode_len, timeout_ms, tracer):
+        '''
+        Decode a padded batch with the session
+        @batch_inputs: np.array, int array of shape [batch, time], padded input ids
+        @inputs_lens: list, true lengths of inputs
+        @beam_width: int, the built beam width to run
+        @max_decode_len: int, max length of answers
+        @timeout_ms: float, latency budget of the batch, 0 for no limit
+        @tracer: Tracer, traces the runs of chosen predict steps, created once per predict_batch
+        @return: np.array, int array of shape [batch, decoded time], answer ids
+        '''
+        feed_dict = {
+                self.graph.get_tensor_by_name('inputs:0'): batch_inputs,
+                self.graph.get_tensor_by_name('source_lens:0'): inputs_lens}
+        feed_dict.update(self._decoding_feed_dict(beam_width, max_decode_len, timeout_ms))
+        if not self.frozen:
+            # Dropout is folded into constants in exported graphs
+            feed_dict[self.graph.get_tensor_by_name('dropout:0')] = 1.0
+
+        self.n_predicts += 1
+        trace_kwargs = tracer.run_kwargs(self.n_predicts)
+        predict_lists = self.sess.run(self.graph.get_tensor_by_name('optimization/predictions:0'), feed_dict=feed_dict, **trace_kwargs)
+        tracer.dump(self.n_predicts, trace_kwargs, 'predict')
+        return predict_lists
+
+
+    def _is_loaded(self):
+        '''
+        @return: bool, whether a model is built or loaded
+        '''
+        return hasattr(self, 'sess')
 
-            predict_list = self.sess.run(
-                    prediction, 
-                    feed_dict={
-                        encoder_input:inputs*self.hyparams.infer_batch_size,
-                        encoder_input_seq_lengths:inputs_lens*self.hyparams.infer_batch_size,
-                        keep_prob: 1.0
-                        }
-                    )
 
-        return ' '.join([self.decoder_int_to_vocab.get(i, '') for i in predict_list[0]])# if i!=decoder_pad_id and i!=decoder_eos_id])
-        # print(predict_list)
+    def _prediction_cache(self):
+        '''
+        The prediction cache of the loaded model, created on first use
+        @return: PredictionCache, None if the cache is disabled
+        '''
+        if self.prediction_cache is None and (self.hyparams.cache_size > 0 or self.hyparams.cache_on_disk):
+            db_path = os.path.join(self.model_ckpt_dir, 'prediction_cache.sqlite') if self.hyparams.cache_on_disk else None
+            self.prediction_cache = PredictionCache(self.hyparams.cache_size, db_path)
+        return self.prediction_cache
 
 
-    def load(self, path):
+    def _decoding_settings(self, beam_width, max_decode_len):
         '''
-        Load existed model. Error will be raised if not success.
-        @path: str, the path of existed model
-        @return: None
+        Settings that change the answer of the same input, part of the key of cached predictions
+        @beam_width: int, the beam width to run
+        @max_decode_len: int, max length of answers
+        @return: list, the decoding settings
+        '''
+        return [beam_width, max_decode_len]
+
+
+    def _decoding_feed_dict(self, beam_width, max_decode_len, timeout_ms):
+        '''
+        Feed the decoding options. Models built before an option existed only decode with its default.
+        @beam_width: int, the beam width to run
+        @max_decode_len: int, max length of answers
+        @timeout_ms: float, latency budget
+        @return: dict, feed_dict of the decoding options
+        '''
+        feed_dict = {}
+        for name, value, default in [
+                ('beam_width', beam_width, self.max_beam_width),
+                ('max_decode_len', max_decode_len, 0),
+                ('decode_timeout_ms', timeout_ms, 0)]:
+            try:
+                feed_dict[self.graph.get_tensor_by_name(name + ':0')] = value
+            except KeyError:
+                if value != default:
+                    raise ValueError('This model is built without decoding option {}, only a model retrained with this version can choose it'.format(name))
+        return feed_dict
+
+
+    def _checkpoint_signature(self, path):
+        '''
+        Identify the weights on disk the model is loaded from, cached predictions are dropped once it changes.
+        It is computed once by load, the checkpoint loaded is not necessarily the latest one when predicting.
+        @path: str, the checkpoint index or the exported file the weights are read from
+        @return: str, the path and modified time of the file
+        '''
+        if not os.path.isfile(path):
+            return ''
+        return '{}:{}'.format(path, os.path.getmtime(path))
+
+
+    def cache_stats(self):
+        '''
+        Hit and miss statistics of the prediction cache
+        @return: dict, keys are hits, disk_hits, misses, hit_rate and size, empty if the cache is disabled
+        '''
+        cache = self._prediction_cache()
+        return cache.stats() if cache is not None else {}
+
+
+    def load(self, path):
+        '''
+        Load existed model. Error will be raised if not success.
+        Both trained models and models written by export can be loaded, the latter can only predict.
+        @path: str, the path of existed model
+        @return: None
         '''
         if not os.path.isdir(path):
             raise ValueError('{} is not valid path, your model is probably untrained'.format(path))
@@ -1026,7 +1984,31 @@ class Seq2seq:
         self._id = os.path.basename(path)
         self.model_ckpt_dir = path
         self.model_ckpt_path = os.path.join(path, 'checkpoint.ckpt')
+        self.prediction_cache = None
+
+        if os.path.isfile(os.path.join(path, 'frozen_graph.pb')):
+            self._load_exported(path)
+            return
         
+        self._load_trained_vocab(path)
+
+        _import_tf()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.sess = tf.Session(config=self._session_config())
+            loader = tf.train.import_meta_graph(self.model_ckpt_path+'.meta')
+            checkpoint_path = tf.train.latest_checkpoint(path)
+            loader.restore(self.sess, checkpoint_path)
+        self.frozen = False
+        self.checkpoint_signature = self._checkpoint_signature(checkpoint_path + '.index')
+
+
+    def _load_trained_vocab(self, path):
+        '''
+        Load the dictionary and hyperparameters saved by training
+        @path: str, the path of existed model
+        @return: None
+        '''
         if not os.path.isfile(os.path.join(path, 'checkpoint')):
             raise ValueError('There is no checkpoint file in {}, your model has not finished training'.format(path))
 
@@ -1041,13 +2023,1691 @@ class Seq2seq:
 
         with open(os.path.join(path, 'hparams'), 'rb') as fp:
             loaded_hyparams = pkl.load(fp)
+            # Fields missing in hparams of older models fall back to the default values
+            loaded_hyparams = self._merge(Seq2seq.hyparams, loaded_hyparams)
+            # Steps traced while training are not traced again after loading
+            loaded_hyparams = loaded_hyparams._replace(trace_steps=Seq2seq.hyparams.trace_steps)
+            self.hyparams = self._merge(loaded_hyparams, self.init_hyparams)
+            # The graph is built with the trained width, beam_width given to the instance only chooses the width to run
+            self.max_beam_width = loaded_hyparams.beam_width
+
+
+    def _load_exported(self, path):
+        '''
+        Load the inference graph and vocabulary written by export
+        @path: str, the export directory
+        @return: None
+        '''
+        self._load_exported_vocab(path)
+
+        _import_tf()
+        graph_def = tf.GraphDef()
+        with open(os.path.join(path, 'frozen_graph.pb'), 'rb') as fp:
+            graph_def.ParseFromString(fp.read())
+        self._import_graph_def(graph_def)
+        self.checkpoint_signature = self._checkpoint_signature(os.path.join(path, 'frozen_graph.pb'))
+
+
+    def _load_exported_vocab(self, path):
+        '''
+        Load the vocabulary and hyperparameters written by export
+        @path: str, the export directory
+        @return: None
+        '''
+        for filename in ['vocab.json', 'hparams.json']:
+            if not os.path.isfile(os.path.join(path, filename)):
+                raise ValueError('There is no {} file in {}'.format(filename, path))
+
+        with open(os.path.join(path, 'vocab.json')) as fp:
+            vocab = json.load(fp)
+        self.encoder_int_to_vocab = dict(enumerate(vocab['encoder']))
+        self.encoder_vocab_to_int = {word: i for i, word in self.encoder_int_to_vocab.items()}
+        self.decoder_int_to_vocab = dict(enumerate(vocab['decoder']))
+        self.decoder_vocab_to_int = {word: i for i, word in self.decoder_int_to_vocab.items()}
+
+        with open(os.path.join(path, 'hparams.json')) as fp:
+            loaded_hyparams = Hyparams(**{k: v for k, v in json.load(fp).items() if k in Hyparams._fields})
+            loaded_hyparams = self._merge(Seq2seq.hyparams, loaded_hyparams)
+            loaded_hyparams = loaded_hyparams._replace(trace_steps=Seq2seq.hyparams.trace_steps)
             self.hyparams = self._merge(loaded_hyparams, self.init_hyparams)
+            self.max_beam_width = loaded_hyparams.beam_width
+
 
+    def _import_graph_def(self, graph_def):
+        '''
+        Create the session of an exported inference graph
+        @graph_def: tf.GraphDef, the exported graph
+        @return: None
+        '''
+        _import_tf()
+        graph_def = self._dequantize_graph_def(graph_def)
         self.graph = tf.Graph()
         with self.graph.as_default():
-            self.sess = tf.Session()
-            loader = tf.train.import_meta_graph(self.model_ckpt_path+'.meta')
-            loader.restore(self.sess, tf.train.latest_checkpoint(path))
+            tf.import_graph_def(graph_def, name='')
+            self.sess = tf.Session(config=self._session_config())
+        self.frozen = True
+
+
+    def export(self, export_dir, quantize=False):
+        '''
+        Export an inference only model, which is much smaller and faster to load than the trained model.
+        The graph is pruned to the encoder and the beam search decoder, variables are frozen into constants,
+        dropout is removed and graph optimizations are applied. Only the vocabularies used by predict are kept.
+        The exported model is loaded by load as usual, and it can only predict. Weights of variables are also written to weights.npz
+        for NumpySeq2seq.
+        @export_dir: str, the directory to write frozen_graph.pb, vocab.json, hparams.json and weights.npz
+        @quantize: bool, whether store weight matrices as int8 with per-channel scales, see _quantize_graph_def
+        @return: str, export_dir
+        '''
+        if not hasattr(self, 'sess'):
+            self.load(self.model_ckpt_dir)
+
+        if self.frozen:
+            raise ValueError('{} is already an exported model'.format(self.model_ckpt_dir))
+
+        output_names = ['optimization/predictions']
+
+        # Only nodes needed by the predictions are kept, which drops the training decoder,
+        # gradients, optimizer slots and summaries
+        graph_def = tf.graph_util.convert_variables_to_constants(self.sess, self.graph.as_graph_def(), output_names)
+
+        # Decoding options become placeholders without default, predict_batch always feeds them
+        node_names = set(node.name for node in graph_def.node)
+        input_names = [name for name in ['inputs', 'source_lens', 'beam_width', 'max_decode_len', 'decode_timeout_ms'] if name in node_names]
+
+        # Dropout is always off in inference, the placeholder is replaced by constant 1.0
+        for node in graph_def.node:
+            if node.name == 'dropout':
+                node.op = 'Const'
+                del node.attr['shape']
+                node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(1.0, tf.float32))
+
+        graph_def = self._optimize_graph_def(graph_def, input_names, output_names)
+        if quantize:
+            graph_def = self._quantize_graph_def(graph_def)
+
+        if not os.path.isdir(export_dir):
+            os.makedirs(export_dir)
+
+        with open(os.path.join(export_dir, 'frozen_graph.pb'), 'wb') as fp:
+            fp.write(graph_def.SerializeToString())
+
+        # Ids are contiguous, so a list of words indexed by id is enough
+        with open(os.path.join(export_dir, 'vocab.json'), 'w') as fp:
+            json.dump({
+                'encoder': [self.encoder_int_to_vocab[i] for i in range(len(self.encoder_int_to_vocab))],
+                'decoder': [self.decoder_int_to_vocab[i] for i in range(len(self.decoder_int_to_vocab))],
+                }, fp)
+
+        with open(os.path.join(export_dir, 'hparams.json'), 'w') as fp:
+            json.dump(self.hyparams._replace(beam_width=self.max_beam_width)._asdict(), fp, indent=2)
+
+        # Variables by name, for NumpySeq2seq which predicts without tensorflow
+        with self.graph.as_default():
+            variables = tf.trainable_variables()
+        weights = dict(zip([variable.op.name for variable in variables], self.sess.run(variables)))
+        if quantize:
+            for name, value in list(weights.items()):
+                if value.ndim >= 2 and value.size >= QUANTIZE_MIN_SIZE:
+                    # Same scales as the graph
+                    weights[name + QUANTIZED_SUFFIX], weights[name + '/scale'] = self._quantize_array(
+                            weights.pop(name), self._quantize_axis(name, value))
+        np.savez(os.path.join(export_dir, 'weights.npz'), **weights)
+
+        print('Export {} nodes to {}, {:.1f} MB'.format(
+            len(graph_def.node), export_dir, os.path.getsize(os.path.join(export_dir, 'frozen_graph.pb')) / 2**20))
+        return export_dir
+
+
+    @staticmethod
+    def _quantize_graph_def(graph_def):
+        '''
+        Store float32 weight matrices as int8 with a symmetric scale per channel, which is 4 times smaller.
+        Embeddings have a scale per row, kernels have a scale per output column, see _quantize_axis.
+        Each weight keeps its name and becomes int8 weights cast to float32 times the scales, so its consumers are unchanged.
+        This only makes the file smaller: _dequantize_graph_def turns them back into float32 constants when the graph is loaded,
+        so memory and speed are those of the float32 graph. Quantized matmuls of tensorflow take per-tensor quint8 ranges and are not used.
+        @graph_def: tf.GraphDef, the frozen and optimized graph
+        @return: tf.GraphDef, the quantized graph
+        '''
+        nodes = {node.name: node for node in graph_def.node}
+        quantized_graph_def = tf.GraphDef()
+        quantized_graph_def.versions.CopyFrom(graph_def.versions)
+        quantized_graph_def.library.CopyFrom(graph_def.library)
+        n_bytes = [0, 0]
+        for name, node in nodes.items():
+            value = tf.make_ndarray(node.attr['value'].tensor) if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum else None
+            if value is None or value.ndim < 2 or value.size < QUANTIZE_MIN_SIZE:
+                quantized_graph_def.node.add().CopyFrom(node)
+                continue
+
+            quantized_value, scale = Seq2seq._quantize_array(value, Seq2seq._quantize_axis(name, value))
+            n_bytes[0] += value.nbytes
+            n_bytes[1] += quantized_value.nbytes + scale.nbytes
+
+            weights_node = quantized_graph_def.node.add()
+            weights_node.name = name + QUANTIZED_SUFFIX
+            weights_node.op = 'Const'
+            weights_node.attr['dtype'].type = tf.int8.as_datatype_enum
+            weights_node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(quantized_value))
+
+            scale_node = quantized_graph_def.node.add()
+            scale_node.name = name + '/scale'
+            scale_node.op = 'Const'
+            scale_node.attr['dtype'].type = tf.float32.as_datatype_enum
+            scale_node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(scale))
+
+            cast_node = quantized_graph_def.node.add()
+            cast_node.name = name + '/dequantize'
+            cast_node.op = 'Cast'
+            cast_node.input.append(weights_node.name)
+            cast_node.attr['SrcT'].type = tf.int8.as_datatype_enum
+            cast_node.attr['DstT'].type = tf.float32.as_datatype_enum
+
+            mul_node = quantized_graph_def.node.add()
+            mul_node.name = name
+            mul_node.op = 'Mul'
+            mul_node.input.extend([cast_node.name, scale_node.name])
+            mul_node.attr['T'].type = tf.float32.as_datatype_enum
+
+        print('Quantize {:.1f} MB of weights into {:.1f} MB'.format(n_bytes[0] / 2**20, n_bytes[1] / 2**20))
+        return quantized_graph_def
+
+
+    @staticmethod
+    def _dequantize_graph_def(graph_def):
+        '''
+        Replace the int8 weights of _quantize_graph_def by float32 constants, computed once here rather than on every run
+        @graph_def: tf.GraphDef, the exported graph, quantized or not
+        @return: tf.GraphDef, the graph with float32 weights only
+        '''
+        nodes = {node.name: node for node in graph_def.node}
+        names = [name[:-len(QUANTIZED_SUFFIX)] for name in nodes if name.endswith(QUANTIZED_SUFFIX)]
+        if not names:
+            return graph_def
+
+        removed = set()
+        for name in names:
+            removed.update([name + QUANTIZED_SUFFIX, name + '/scale', name + '/dequantize'])
+        dequantized_graph_def = tf.GraphDef()
+        dequantized_graph_def.versions.CopyFrom(graph_def.versions)
+        dequantized_graph_def.library.CopyFrom(graph_def.library)
+        for node in graph_def.node:
+            if node.name in removed:
+                continue
+            if node.name not in names:
+                dequantized_graph_def.node.add().CopyFrom(node)
+                continue
+
+            # Same product as the Cast and Mul nodes, and as NumpySeq2seq
+            value = tf.make_ndarray(nodes[node.name + QUANTIZED_SUFFIX].attr['value'].tensor).astype(np.float32) \
+                    * tf.make_ndarray(nodes[node.name + '/scale'].attr['value'].tensor)
+            weights_node = dequantized_graph_def.node.add()
+            weights_node.name = node.name
+            weights_node.op = 'Const'
+            weights_node.attr['dtype'].type = tf.float32.as_datatype_enum
+            weights_node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value))
+        return dequantized_graph_def
+
+
+    @staticmethod
+    def _quantize_axis(name, value):
+        '''
+        The channel axis of a weight, chosen by its name so that the graph and weights.npz get the same scales.
+        Embeddings are gathered by rows, and the tied decoder embedding is also the transposed output kernel,
+        thus a row is a channel. Other weights are kernels, whose channels are output columns.
+        @name: str, name of the variable or of its frozen constant
+        @value: np.array, the weights
+        @return: int
+        '''
+        return 0 if re.search(r'(embeddings|embed_weight)(/read)?$', name) else value.ndim - 1
+
+
+    @staticmethod
+    def _quantize_array(value, axis):
+        '''
+        Symmetric int8 quantization with a scale per index of one axis
+        @value: np.array, float32 weights
+        @axis: int, the channel axis
+        @return: (np.array, np.array), int8 weights and float32 scales, value is about int8 weights times scales
+        '''
+        other_axes = tuple(i for i in range(value.ndim) if i != axis)
+        scale = np.max(np.abs(value), axis=other_axes, keepdims=True) / 127
+        scale[scale == 0] = 1.0
+        quantized_value = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+        return quantized_value, scale.astype(np.float32)
+
+
+    @staticmethod
+    def _optimize_graph_def(graph_def, input_names, output_names):
+        '''
+        Apply graph transforms for inference. Only training nodes are removed if graph_transforms is not available.
+        @graph_def: tf.GraphDef, the frozen graph
+        @input_names: list, names of the input placeholders
+        @output_names: list, names of the output nodes
+        @return: tf.GraphDef, the optimized graph
+        '''
+        try:
+            from tensorflow.tools.graph_transforms import TransformGraph
+        except ImportError:
+            print('graph_transforms is not available, only training nodes are removed')
+            return tf.graph_util.remove_training_nodes(graph_def, protected_nodes=input_names + output_names)
+
+        # Inputs are rewritten as placeholders, each keeps its own type
+        input_types = {node.name: tf.as_dtype(node.attr['dtype'].type) for node in graph_def.node if node.name in input_names}
+        strip_args = ', '.join('name={}, type_for_name={}'.format(name, 'float' if input_types[name] == tf.float32 else input_types[name].name) for name in input_names)
+
+        # Identity nodes are kept, since removing them breaks while loops of the decoder
+        transforms = [
+                'strip_unused_nodes({})'.format(strip_args),
+                'fold_constants(ignore_errors=true)',
+                'sort_by_execution_order',
+                ]
+        return TransformGraph(graph_def, input_names, output_names, transforms)
+
+
+def _import_tf():
+    '''
+    Import tensorflow on first use, so that the command line, TextProcessor, the data utilities and NumpySeq2seq start
+    without it. Called wherever a graph is built or loaded, it binds the module global tf and the classes subclassing
+    tensorflow ones: DeadlineBasicDecoder, DeadlineBeamSearchDecoder and OutputProjection.
+    @return: module, tensorflow
+    '''
+    global tf, DeadlineBasicDecoder, DeadlineBeamSearchDecoder, OutputProjection
+    if 'tf' in globals():
+        return tf
+
+    import tensorflow
+    # GatherTree ops don't load automatically. Adding import to force library to load
+    # Fixed the KeyError: GatherTree
+    from tensorflow.contrib.seq2seq.python.ops import beam_search_ops
+    # Suppress warning log
+    tensorflow.logging.set_verbosity(tensorflow.logging.FATAL)
+    tf = tensorflow
+
+    class DeadlineBasicDecoder(tf.contrib.seq2seq.BasicDecoder):
+        def __init__(self, *args, deadline=None, **kwargs):
+            '''
+            Greedy decoder which stops at a deadline, with the answers decoded so far.
+            @deadline: tf.Tensor, float64 scalar, the time to stop decoding in seconds since epoch, compared with tf.timestamp
+            '''
+            super(DeadlineBasicDecoder, self).__init__(*args, **kwargs)
+            self._deadline = deadline
+
+
+        def step(self, time, inputs, state, name=None):
+            outputs, next_state, next_inputs, finished = super(DeadlineBasicDecoder, self).step(time, inputs, state, name)
+            finished = tf.logical_or(finished, tf.greater(tf.timestamp(), self._deadline))
+            return outputs, next_state, next_inputs, finished
+
+
+    class DeadlineBeamSearchDecoder(tf.contrib.seq2seq.BeamSearchDecoder):
+        def __init__(self, *args, deadline=None, **kwargs):
+            '''
+            Beam search decoder which stops at a deadline, with the best beams so far.
+            A sentence also stops once its best finished beam can not be beaten. Without length penalty, the score of a beam
+            is its log probability, which only decreases while the beam grows. So once the best finished beam scores
+            no less than every alive beam, it is the answer, and the alive beams need not be decoded further.
+            @deadline: tf.Tensor, float64 scalar, the time to stop decoding in seconds since epoch, compared with tf.timestamp
+            '''
+            super(DeadlineBeamSearchDecoder, self).__init__(*args, **kwargs)
+            self._deadline = deadline
+
+
+        def step(self, time, inputs, state, name=None):
+            outputs, next_state, next_inputs, finished = super(DeadlineBeamSearchDecoder, self).step(time, inputs, state, name)
+
+            # The returned finished only ends the loop, beams in next_state keep their own finished flags
+            if getattr(self, '_length_penalty_weight', None) == 0.0:
+                no_score = tf.fill(tf.shape(next_state.log_probs), -np.inf)
+                best_finished = tf.reduce_max(tf.where(next_state.finished, next_state.log_probs, no_score), axis=1)
+                best_alive = tf.reduce_max(tf.where(next_state.finished, no_score, next_state.log_probs), axis=1)
+                finished = tf.logical_or(finished, tf.expand_dims(tf.greater_equal(best_finished, best_alive), 1))
+
+            finished = tf.logical_or(finished, tf.greater(tf.timestamp(), self._deadline))
+            return outputs, next_state, next_inputs, finished
+
+
+    class OutputProjection(tf.layers.Layer):
+        def __init__(self, vocab_size, rank=0, tied_embedding=None, kernel_initializer=None, **kwargs):
+            '''
+            Output projection of the decoder without bias, optionally tied or factorized.
+            logits = inputs x bottleneck x kernel, the bottleneck exists only if rank > 0,
+            and the kernel is the transposed tied embedding if it is given.
+            @vocab_size: int, the size of decoder vocabulary
+            @rank: int, the size of bottleneck, 0 for no bottleneck
+            @tied_embedding: tf.Variable, [vocab_size, embedding_dim] embedding used as the kernel, None to create a kernel
+            @kernel_initializer: initializer of the created variables
+            @return: None
+            '''
+            super(OutputProjection, self).__init__(**kwargs)
+            self.vocab_size = vocab_size
+            self.rank = rank
+            self.tied_embedding = tied_embedding
+            self.kernel_initializer = kernel_initializer
+
+        def build(self, input_shape):
+            input_dim = tf.TensorShape(input_shape)[-1].value
+            self.bottleneck = None
+            if self.rank:
+                self.bottleneck = self.add_variable('bottleneck', [input_dim, self.rank], initializer=self.kernel_initializer)
+                input_dim = self.rank
+            if self.tied_embedding is None:
+                self.kernel = self.add_variable('kernel', [input_dim, self.vocab_size], initializer=self.kernel_initializer)
+            super(OutputProjection, self).build(input_shape)
+
+        def call(self, inputs):
+            outputs = tf.reshape(inputs, [-1, tf.shape(inputs)[-1]])
+            if self.bottleneck is not None:
+                outputs = tf.matmul(outputs, self.bottleneck)
+            if self.tied_embedding is None:
+                outputs = tf.matmul(outputs, self.kernel)
+            else:
+                outputs = tf.matmul(outputs, self.tied_embedding, transpose_b=True)
+            return tf.reshape(outputs, tf.concat([tf.shape(inputs)[:-1], [self.vocab_size]], 0))
+
+        def compute_output_shape(self, input_shape):
+            return tf.TensorShape(input_shape)[:-1].concatenate(self.vocab_size)
+
+    return tf
+
+
+def __getattr__(name):
+    # from liteSeq2Seq import tf, or one of the tensorflow classes, imports tensorflow
+    if name in ('tf', 'DeadlineBasicDecoder', 'DeadlineBeamSearchDecoder', 'OutputProjection'):
+        _import_tf()
+        return globals()[name]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+class PredictionCache:
+    def __init__(self, size, db_path=None):
+        '''
+        Cache of predictions with a least recently used in-memory tier and an optional sqlite tier.
+        All entries belong to one checkpoint signature, and are dropped once the signature changes.
+        @size: int, max number of entries in memory
+        @db_path: str, path of the sqlite file, None to keep entries only in memory
+        '''
+        self.size = size
+        self.entries = OrderedDict()
+        self.signature = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if db_path is not None:
+            import sqlite3
+            # Serving workers share the file, a writer waits for the lock instead of failing, and readers do not block it
+            self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, signature TEXT, value TEXT)')
+            self.db.commit()
+
+
+    def validate(self, signature):
+        '''
+        Drop all entries if the checkpoint signature changes
+        @signature: str, the signature of the current checkpoint
+        @return: None
+        '''
+        with self.lock:
+            if signature == self.signature:
+                return
+            self.signature = signature
+            self.entries.clear()
+            if self.db is not None:
+                self.db.execute('DELETE FROM predictions WHERE signature != ?', (signature,))
+                self.db.commit()
+
+
+    def get(self, key):
+        '''
+        Look up a prediction, in memory first, then on disk
+        @key: str, the key of the prediction
+        @return: str, the cached prediction, None if missing
+        '''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            if self.db is not None:
+                row = self.db.execute('SELECT value FROM predictions WHERE key = ? AND signature = ?', (key, self.signature)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+
+    def put(self, items):
+        '''
+        Save predictions in both tiers
+        @items: list, pairs of key and prediction
+        @return: None
+        '''
+        with self.lock:
+            for key, value in items:
+                self._remember(key, value)
+            if self.db is not None and items:
+                self.db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)', [(key, self.signature, value) for key, value in items])
+                self.db.commit()
+
+
+    def _remember(self, key, value):
+        '''
+        Save a prediction in memory, evicting the least recently used ones beyond size
+        '''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+    def stats(self):
+        '''
+        @return: dict, keys are hits, disk_hits, misses, hit_rate and size
+        '''
+        with self.lock:
+            n_lookups = self.hits + self.disk_hits + self.misses
+            return {
+                    'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'hit_rate': (self.hits + self.disk_hits) / n_lookups if n_lookups else 0.0,
+                    'size': len(self.entries),
+                    }
+
+
+class MicroBatcher:
+    def __init__(self, model, max_batch_size=None, max_wait_ms=5):
+        '''
+        Collect concurrent predict requests into batches, so that many callers share one predict_batch run.
+        A batch is flushed once it has {max_batch_size} requests, or {max_wait_ms} after its first request arrives.
+        Requests of different decoding options in one batch are run as separate predict_batch calls.
+        All runs happen in one worker thread, call close to stop it.
+        @model: Seq2seq, a loaded model
+        @max_batch_size: int, max requests of a batch, default to hyperparameter infer_batch_size
+        @max_wait_ms: float, max milliseconds the first request of a batch waits for others
+        '''
+        self.model = model
+        self.max_batch_size = max_batch_size or model.hyparams.infer_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.n_requests = 0
+        self.n_batches = 0
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+
+    def submit(self, encode_str, beam_width=None, max_decode_len=None, timeout_ms=None, return_truncated=False):
+        '''
+        Queue a request
+        @encode_str: str, the input string
+        @beam_width: int, width of beam search, see Seq2seq.predict_batch
+        @max_decode_len: int, max length of the answer, see Seq2seq.predict_batch
+        @timeout_ms: float, latency budget counted from now, including the time waiting in the queue, see Seq2seq.predict_batch
+        @return_truncated: bool, whether the future is resolved with (answer, truncated)
+        @return: concurrent.futures.Future, resolved with the answer string
+        '''
+        future = Future()
+        self.requests.put((encode_str, (beam_width, max_decode_len, timeout_ms), future, time.time(), return_truncated))
+        return future
+
+
+    def predict(self, encode_str, beam_width=None, max_decode_len=None, timeout_ms=None, return_truncated=False, timeout=None):
+        '''
+        Predict in the calling thread, blocking until the batch of this request is run
+        @timeout: float, seconds to wait, None to wait forever
+        @return: str, the answer string. (str, bool) with return_truncated
+        '''
+        return self.submit(encode_str, beam_width, max_decode_len, timeout_ms, return_truncated).result(timeout)
+
+
+    async def predict_async(self, encode_str, beam_width=None, max_decode_len=None, timeout_ms=None, return_truncated=False):
+        '''
+        Predict in asyncio, the event loop is not blocked while waiting
+        @return: str, the answer string. (str, bool) with return_truncated
+        '''
+        import asyncio
+        return await asyncio.wrap_future(self.submit(encode_str, beam_width, max_decode_len, timeout_ms, return_truncated))
+
+
+    def close(self):
+        '''
+        Run the queued requests and stop the worker thread
+        @return: None
+        '''
+        self.requests.put(None)
+        self.worker.join()
+
+
+    def _run(self):
+        '''
+        Worker loop, collect a batch and run it until close is called
+        '''
+        closed = False
+        while not closed:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            batch = [request]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closed = True
+                    break
+                batch.append(request)
+
+            self._run_batch(batch)
+
+
+    def _run_batch(self, batch):
+        '''
+        Run the requests of a batch and resolve their futures
+        @batch: list, requests of (encode_str, decoding options, future, submit time, return_truncated)
+        '''
+        self.n_batches += 1
+        self.n_requests += len(batch)
+
+        groups = {}
+        for request in batch:
+            groups.setdefault(request[1], []).append(request)
+
+        # Truncation flags are always computed, so callers with and without return_truncated share a run
+        for (beam_width, max_decode_len, timeout_ms), requests in groups.items():
+            requests = [request for request in requests if request[2].set_running_or_notify_cancel()]
+            if not requests:
+                continue
+            if timeout_ms:
+                # The budget left to the request waiting longest
+                timeout_ms = max(timeout_ms - (time.time() - min(request[3] for request in requests)) * 1000, 1e-3)
+            try:
+                predict_strs, truncated = self.model.predict_batch(
+                        [request[0] for request in requests], beam_width, max_decode_len, timeout_ms, return_truncated=True)
+            except Exception as e:
+                for request in requests:
+                    request[2].set_exception(e)
+                continue
+            for request, predict_str, is_truncated in zip(requests, predict_strs, truncated):
+                request[2].set_result((predict_str, is_truncated) if request[4] else predict_str)
+
+
+class PredictorPool:
+    # Weights with fewer elements stay in the graph
+    SHARED_MIN_SIZE = 1024
+
+    def __init__(self, model_path, n_workers=2, **kwargs):
+        '''
+        Predict with several worker processes which share one copy of the weights.
+        The model is exported first if it is not, in a separate process. Weights of the variables, as listed in weights.npz
+        by export, are saved as raw files in <export dir>/shared, and their constants become ImmutableConst nodes of the graph.
+        Each worker memory-maps the files read-only when it creates its session, so the weights are in the page cache once
+        for all workers, rather than in a copy per worker. Other constants, e.g. those folded from several variables, stay in the graph.
+        Workers are spawned, the parent process never imports tensorflow.
+        Batches of {infer_batch_size} inputs are dispatched to free workers, and answers are returned in order.
+        @model_path: str, path of a trained or exported model
+        @n_workers: int, number of worker processes
+        @kwargs: hyperparameters given to Seq2seq, intra_op_threads default to the number of cpus divided by n_workers
+        '''
+        export_dir = model_path if os.path.isfile(os.path.join(model_path, 'frozen_graph.pb')) else os.path.join(model_path, 'exported')
+        context = multiprocessing.get_context('spawn')
+        if not os.path.isfile(os.path.join(export_dir, 'shared', 'weights.json')):
+            process = context.Process(target=PredictorPool._prepare, args=(model_path, export_dir, kwargs))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError('Failed to prepare the shared weights of {}'.format(model_path))
+
+        kwargs.setdefault('intra_op_threads', max(1, multiprocessing.cpu_count() // n_workers))
+        self.model = PredictorPool._exported_model(model_path, export_dir, kwargs)
+        self.hyparams = self.model.hyparams
+
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.lock = threading.Lock()
+        # Tasks of an interrupted call may still be answered, results are tagged with the call they belong to
+        self.n_calls = 0
+        self.broken = False
+        self.workers = [
+                context.Process(target=PredictorPool._work, args=(model_path, export_dir, kwargs, self.tasks, self.results), daemon=True)
+                for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+
+    @staticmethod
+    def _prepare(model_path, export_dir, kwargs):
+        '''
+        Export the model if needed, then move the weights of its variables out of the graph into raw files
+        @model_path: str, path of a trained or exported model
+        @export_dir: str, the export directory
+        @kwargs: hyperparameters given to Seq2seq
+        @return: None
+        '''
+        _import_tf()
+        if not os.path.isfile(os.path.join(export_dir, 'frozen_graph.pb')):
+            model = Seq2seq(**kwargs)
+            model.load(model_path)
+            model.export(export_dir)
+            model.sess.close()
+
+        if not os.path.isfile(os.path.join(export_dir, 'weights.npz')):
+            raise ValueError('There is no weights.npz file in {}, export the model again'.format(export_dir))
+        # Names of the variables at export, their frozen constants keep them
+        with np.load(os.path.join(export_dir, 'weights.npz')) as fp:
+            variable_names = set(name[:-len(QUANTIZED_SUFFIX)] if name.endswith(QUANTIZED_SUFFIX) else name
+                    for name in fp.files if not name.endswith('/scale'))
+
+        graph_def = tf.GraphDef()
+        with open(os.path.join(export_dir, 'frozen_graph.pb'), 'rb') as fp:
+            graph_def.ParseFromString(fp.read())
+        # Workers share float32 weights, as a quantized export is loaded
+        graph_def = Seq2seq._dequantize_graph_def(graph_def)
+
+        shared_dir = os.path.join(export_dir, 'shared')
+        if not os.path.isdir(shared_dir):
+            os.makedirs(shared_dir)
+
+        weights = {}
+        for node in graph_def.node:
+            if node.op != 'Const' or node.name not in variable_names or node.attr['dtype'].type != tf.float32.as_datatype_enum:
+                continue
+            value = tf.make_ndarray(node.attr['value'].tensor)
+            if value.size < PredictorPool.SHARED_MIN_SIZE:
+                continue
+
+            # Raw bytes at offset 0, the mapping is page aligned as tensorflow requires
+            filename = '{}.bin'.format(len(weights))
+            np.ascontiguousarray(value).tofile(os.path.join(shared_dir, filename))
+            weights[node.name] = filename
+
+            # The node keeps its name, thus consumers of the constant are unchanged.
+            # The file name is relative, the worker makes it absolute, so the export directory can be moved
+            node.op = 'ImmutableConst'
+            del node.attr['value']
+            node.attr['shape'].shape.CopyFrom(tf.TensorShape(value.shape).as_proto())
+            node.attr['memory_region_name'].s = filename.encode()
+
+        with open(os.path.join(shared_dir, 'graph.pb'), 'wb') as fp:
+            fp.write(graph_def.SerializeToString())
+        # Written last, it marks the shared directory complete
+        with open(os.path.join(shared_dir, 'weights.json'), 'w') as fp:
+            json.dump(weights, fp)
+
+
+    @staticmethod
+    def _exported_model(model_path, export_dir, kwargs):
+        '''
+        A model with the vocabulary and hyperparameters of the export, without session
+        @model_path: str, path of the trained or exported model, which names the model
+        @export_dir: str, the export directory
+        @kwargs: hyperparameters given to Seq2seq
+        @return: Seq2seq
+        '''
+        model = Seq2seq(**kwargs)
+        model._id = os.path.basename(model_path)
+        model.model_ckpt_dir = export_dir
+        model.frozen = True
+        model._load_exported_vocab(export_dir)
+        model.checkpoint_signature = model._checkpoint_signature(os.path.join(export_dir, 'frozen_graph.pb'))
+        return model
+
+
+    @staticmethod
+    def _work(model_path, export_dir, kwargs, tasks, results):
+        '''
+        Worker loop, predict batches from the task queue until None is received
+        @model_path: str, path of the trained or exported model
+        @export_dir: str, the export directory with the shared weights
+        @kwargs: hyperparameters given to Seq2seq
+        @tasks: multiprocessing.Queue, tasks of (call index, task index, encode_strs, decoding options)
+        @results: multiprocessing.Queue, results of (call index, task index, answers and truncated flags or Exception)
+        '''
+        _import_tf()
+        model = PredictorPool._exported_model(model_path, export_dir, kwargs)
+        shared_dir = os.path.join(export_dir, 'shared')
+        graph_def = tf.GraphDef()
+        with open(os.path.join(shared_dir, 'graph.pb'), 'rb') as fp:
+            graph_def.ParseFromString(fp.read())
+        for node in graph_def.node:
+            if node.op == 'ImmutableConst':
+                node.attr['memory_region_name'].s = os.path.join(os.path.abspath(shared_dir), node.attr['memory_region_name'].s.decode()).encode()
+        model._import_graph_def(graph_def)
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            call_i, task_i, encode_strs, decoding_options = task
+            try:
+                results.put((call_i, task_i, model.predict_batch(encode_strs, *decoding_options, return_truncated=True)))
+            except Exception as e:
+                results.put((call_i, task_i, e))
+
+
+    def predict_batch(self, encode_strs, beam_width=None, max_decode_len=None, timeout_ms=None, return_truncated=False):
+        '''
+        Predict with all workers, see Seq2seq.predict_batch. Calls from several threads run one after another,
+        use MicroBatcher on the pool to batch them. Once a worker exits unexpectedly, this call and all later ones raise RuntimeError.
+        @return: list, the answer strings, in the order of encode_strs. (list, list) of answers and truncated flags with return_truncated
+        '''
+        # Neighbours in length go to the same worker, so that batches are padded little
+        order = sorted(range(len(encode_strs)), key=lambda i: len(encode_strs[i].split()))
+        chunks = [order[i: i+self.hyparams.infer_batch_size] for i in range(0, len(order), self.hyparams.infer_batch_size)]
+
+        predict_strs = [None] * len(encode_strs)
+        truncated = [False] * len(encode_strs)
+        with self.lock:
+            if self.broken:
+                raise RuntimeError('A worker of PredictorPool exited unexpectedly, create a new pool')
+            self.n_calls += 1
+            for task_i, chunk in enumerate(chunks):
+                self.tasks.put((self.n_calls, task_i, [encode_strs[i] for i in chunk], (beam_width, max_decode_len, timeout_ms)))
+
+            error = None
+            for _ in chunks:
+                task_i, result = self._get_result(self.n_calls)
+                if isinstance(result, Exception):
+                    error = result
+                    continue
+                for i, predict_str, is_truncated in zip(chunks[task_i], *result):
+                    predict_strs[i] = predict_str
+                    truncated[i] = is_truncated
+
+        if error is not None:
+            raise error
+        if return_truncated:
+            return predict_strs, truncated
+        return predict_strs
+
+
+    def _get_result(self, call_i):
+        '''
+        Wait for the result of a task of a call, error is raised if a worker dies meanwhile and the pool is marked broken
+        @call_i: int, the call the task belongs to, results of earlier calls are dropped
+        @return: (int, list or Exception), index of the task in the call and its answers
+        '''
+        while True:
+            try:
+                result_call_i, task_i, result = self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    self.broken = True
+                    raise RuntimeError('A worker of PredictorPool exited unexpectedly')
+                continue
+            if result_call_i == call_i:
+                return task_i, result
+
+
+    def predict(self, encode_str, beam_width=None, max_decode_len=None, timeout_ms=None, return_truncated=False):
+        '''
+        Predict a single string in a worker, see Seq2seq.predict
+        @return: str, the answer string. (str, bool) with return_truncated
+        '''
+        results = self.predict_batch([encode_str], beam_width, max_decode_len, timeout_ms, return_truncated)
+        return (results[0][0], results[1][0]) if return_truncated else results[0]
+
+
+    def close(self):
+        '''
+        Stop the workers
+        @return: None
+        '''
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NumpySeq2seq(Seq2seq):
+    # Tensorflow DataType enums of the tensors read from checkpoints
+    CHECKPOINT_DTYPES = {1: np.float32, 2: np.float64, 3: np.int32, 6: np.int8, 9: np.int64, 10: np.bool_}
+    # Last 8 bytes of the checkpoint index, a sorted string table
+    TABLE_MAGIC = b'\x57\xfb\x80\x8b\x24\x75\x47\xdb'
+
+    def __init__(self, **kwargs):
+        '''
+        Predict with NumPy only, no session is created.
+        Weights are read from the latest checkpoint of a trained model, without tensorflow, or from weights.npz of an exported model.
+        The bidirectional encoder, the Luong attention decoder, greedy decoding and beam search run step by step as the graph does,
+        on whole batches, so answers are the same as Seq2seq.predict up to float rounding. Decoding options, the prediction cache
+        and truncation flags of predict_batch work the same way. Training, evaluation and export are not supported.
+        @kwargs: hyperparameters given to Seq2seq, e.g. beam_width or infer_batch_size
+        '''
+        super(NumpySeq2seq, self).__init__(**kwargs)
+
+
+    def load(self, path):
+        '''
+        Load the weights, vocabulary and hyperparameters of a trained or exported model
+        @path: str, the path of existed model
+        @return: None
+        '''
+        if not os.path.isdir(path):
+            raise ValueError('{} is not valid path, your model is probably untrained'.format(path))
+
+        self._id = os.path.basename(path)
+        self.model_ckpt_dir = path
+        self.model_ckpt_path = os.path.join(path, 'checkpoint.ckpt')
+        self.prediction_cache = None
+
+        if os.path.isfile(os.path.join(path, 'frozen_graph.pb')):
+            if not os.path.isfile(os.path.join(path, 'weights.npz')):
+                raise ValueError('There is no weights.npz file in {}, export the model again'.format(path))
+            self._load_exported_vocab(path)
+            with np.load(os.path.join(path, 'weights.npz')) as fp:
+                weights = {name: fp[name] for name in fp.files}
+            # Dequantized as the exported graph does
+            for name in [name for name in weights if name.endswith(QUANTIZED_SUFFIX)]:
+                weight_name = name[:-len(QUANTIZED_SUFFIX)]
+                weights[weight_name] = weights.pop(name).astype(np.float32) * weights.pop(weight_name + '/scale')
+            self.frozen = True
+            self.checkpoint_signature = self._checkpoint_signature(os.path.join(path, 'weights.npz'))
+        else:
+            self._load_trained_vocab(path)
+            checkpoint_path = self._latest_checkpoint(path)
+            weights = self._read_checkpoint(checkpoint_path)
+            self.frozen = False
+            self.checkpoint_signature = self._checkpoint_signature(checkpoint_path + '.index')
+
+        self._assign_weights(weights)
+
+
+    def _assign_weights(self, weights):
+        '''
+        Pick the weights of each part of the model by variable name
+        @weights: dict, np.array of each variable by name
+        @return: None
+        '''
+        def find(pattern, optional=False):
+            names = [name for name in weights if re.search(pattern, name)]
+            if len(names) == 1:
+                return weights[names[0]]
+            if not names and optional:
+                return None
+            raise ValueError('Expect one variable matching {}, found {}'.format(pattern, names))
+
+        def cell_params(scope):
+            # Rows of kernels for the inputs and for the state are split, so that inputs of all steps are multiplied at once
+            if self.hyparams.cell_type == 'gru':
+                gates_kernel, gates_bias = find(scope + r'.*gates/kernel$'), find(scope + r'.*gates/bias$')
+                candidate_kernel, candidate_bias = find(scope + r'.*candidate/kernel$'), find(scope + r'.*candidate/bias$')
+                input_dim = gates_kernel.shape[0] - candidate_bias.shape[0]
+                return (np.concatenate([gates_kernel[:input_dim], candidate_kernel[:input_dim]], 1),
+                        np.concatenate([gates_bias, candidate_bias]),
+                        (gates_kernel[input_dim:], candidate_kernel[input_dim:]))
+            kernel, bias = find(scope + r'.*kernel$'), find(scope + r'.*bias$')
+            input_dim = kernel.shape[0] - bias.shape[0] // 4
+            return kernel[:input_dim], bias, (kernel[input_dim:],)
+
+        self.encoder_embedding = find(r'^encoder/EmbedSequence/embeddings$')
+        self.decoder_embedding = self.encoder_embedding if self.hyparams.share_vocab else find(r'decoder_embed_weight$')
+        self.encoder_layers = [
+                tuple(cell_params(r'^encoder/.*cell_{}/bidirectional_rnn/{}/'.format(i, direction)) for direction in ('fw', 'bw'))
+                for i in range(self.hyparams.n_rnn_layers)]
+        self.decoder_layers = [cell_params(r'^decoder/.*multi_rnn_cell/cell_{}/'.format(i)) for i in range(self.hyparams.n_rnn_layers)]
+        self.memory_kernel = find(r'memory_layer/kernel$')
+        self.attention_kernel = find(r'attention_layer/kernel$')
+
+        # Matrices of the output projection, applied in turn, see OutputProjection
+        self.output_kernels = [find(r'decoder_output_embedding/bottleneck$', optional=True)]
+        if self.hyparams.tie_embeddings:
+            self.output_kernels.append(self.decoder_embedding.T)
+        else:
+            self.output_kernels.append(find(r'decoder_output_embedding/kernel$'))
+        self.output_kernels = [kernel for kernel in self.output_kernels if kernel is not None]
+
+        # Kept to tell that the model is loaded
+        self.weights = weights
+
+
+    def _is_loaded(self):
+        return hasattr(self, 'weights')
+
+
+    def train(self, *args, **kwargs):
+        raise ValueError('NumpySeq2seq can only predict, train with Seq2seq')
+
+
+    def _train(self, *args, **kwargs):
+        raise ValueError('NumpySeq2seq can only predict, train with Seq2seq')
+
+
+    def evaluate(self, *args, **kwargs):
+        raise ValueError('NumpySeq2seq can only predict, evaluate with Seq2seq')
+
+
+    def export(self, *args, **kwargs):
+        raise ValueError('NumpySeq2seq can only predict, export with Seq2seq')
+
+
+    def _predict_ids(self, batch_inputs, inputs_lens, beam_width, max_decode_len, timeout_ms, tracer):
+        '''
+        Decode a padded batch, see Seq2seq._predict_ids. There is no session run to trace, tracer is unused
+        @return: np.array, int array of shape [batch, decoded time], answer ids
+        '''
+        # The clock starts with the batch, as tf.timestamp in the graph
+        deadline = time.time() + timeout_ms / 1000 if timeout_ms > 0 else np.inf
+
+        inputs_lens = np.asarray(inputs_lens)
+        mask = np.arange(batch_inputs.shape[1])[None, :] < inputs_lens[:, None]
+        encoder_output, encoder_state = self._encode(batch_inputs, inputs_lens, mask)
+
+        # Memory of Luong attention, padded steps are zeroed and masked out of scores
+        values = encoder_output * mask[:, :, None]
+        keys = np.matmul(values, self.memory_kernel)
+        memory = (keys, values, mask)
+
+        maximum_iterations = max_decode_len if max_decode_len > 0 else 2 * int(inputs_lens.max())
+        if beam_width == 1:
+            return self._greedy_decode(memory, encoder_state, maximum_iterations, deadline)
+        return self._beam_search_decode(memory, encoder_state, beam_width, maximum_iterations, deadline)
+
+
+    def _encode(self, batch_inputs, inputs_lens, mask):
+        '''
+        Stacked bi-directional rnn encoder, see Seq2seq._encoder
+        @batch_inputs: np.array, int array of shape [batch, time], padded input ids
+        @inputs_lens: np.array, true lengths of inputs
+        @mask: np.array, bool array of shape [batch, time], true for the steps within lengths
+        @return: (np.array, list), encoder output of shape [batch, time, rnn_layer_size] and final state of each layer
+        '''
+        # Index of each step in its reversed sequence, padding stays in place as tf.reverse_sequence
+        steps = np.arange(batch_inputs.shape[1])[None, :]
+        reverse_index = np.where(mask, inputs_lens[:, None] - 1 - steps, steps)
+        rows = np.arange(len(batch_inputs))[:, None]
+
+        layer_input = self.encoder_embedding[batch_inputs]
+        final_state = []
+        for forward_params, backward_params in self.encoder_layers:
+            forward_output, forward_state = self._run_rnn(forward_params, layer_input, mask)
+            backward_output, backward_state = self._run_rnn(backward_params, layer_input[rows, reverse_index], mask)
+            layer_input = np.concatenate([forward_output, backward_output[rows, reverse_index]], -1)
+            final_state.append(tuple(np.concatenate([forward, backward], -1) for forward, backward in zip(forward_state, backward_state)))
+        return layer_input, final_state
+
+
+    def _run_rnn(self, params, inputs, mask):
+        '''
+        Run a rnn cell over padded sequences as tf.nn.dynamic_rnn, outputs past the lengths are zeros and states are kept
+        @params: tuple, weights of the cell, see _assign_weights
+        @inputs: np.array, [batch, time, input_dim]
+        @mask: np.array, bool array of shape [batch, time], true for the steps within lengths
+        @return: (np.array, tuple), outputs of shape [batch, time, units] and the final state
+        '''
+        input_parts = self._input_part(params, inputs)
+        units = params[2][0].shape[0]
+        state = tuple(np.zeros((len(inputs), units), dtype=np.float32) for _ in range(1 if self.hyparams.cell_type == 'gru' else 2))
+        outputs = np.zeros((inputs.shape[0], inputs.shape[1], units), dtype=np.float32)
+        for t in range(inputs.shape[1]):
+            output, next_state = self._cell_step(params, input_parts[:, t], state)
+            valid = mask[:, t:t+1]
+            state = tuple(np.where(valid, next_part, part) for next_part, part in zip(next_state, state))
+            outputs[:, t] = output * valid
+        return outputs, state
+
+
+    def _input_part(self, params, inputs):
+        '''
+        @params: tuple, weights of the cell, see _assign_weights
+        @inputs: np.array, [..., input_dim]
+        @return: np.array, inputs multiplied by the input rows of the kernels, plus the biases
+        '''
+        return np.matmul(inputs, params[0]) + params[1]
+
+
+    def _cell_step(self, params, input_part, state):
+        '''
+        One step of the rnn cell, same as the cells of Seq2seq._rnn_cell, forget bias of lstm is 1
+        @params: tuple, weights of the cell, see _assign_weights
+        @input_part: np.array, [batch, gates], see _input_part
+        @state: tuple, (c, h) of lstm, (h,) of gru
+        @return: (np.array, tuple), the output and the next state
+        '''
+        if self.hyparams.cell_type == 'gru':
+            gates_kernel, candidate_kernel = params[2]
+            h = state[0]
+            units = h.shape[1]
+            gates = self._sigmoid(input_part[:, :2*units] + np.matmul(h, gates_kernel))
+            r, u = gates[:, :units], gates[:, units:]
+            candidate = np.tanh(input_part[:, 2*units:] + np.matmul(r * h, candidate_kernel))
+            h = u * h + (1 - u) * candidate
+            return h, (h,)
+
+        c, h = state
+        i, j, f, o = np.split(input_part + np.matmul(h, params[2][0]), 4, axis=1)
+        c = self._sigmoid(f + 1.0) * c + self._sigmoid(i) * np.tanh(j)
+        h = self._sigmoid(o) * np.tanh(c)
+        return h, (c, h)
+
+
+    def _decode_step(self, inputs, attention, state, memory, beam_width):
+        '''
+        One step of the attention wrapped decoder cell and the output projection
+        @inputs: np.array, [batch * beam_width, embedding_dim], embedded previous tokens
+        @attention: np.array, [batch * beam_width, rnn_layer_size], attention of the previous step
+        @state: list, state of each decoder layer
+        @memory: tuple, keys, values and mask of Luong attention, not tiled by beam_width
+        @beam_width: int, rows of each sentence
+        @return: (np.array, np.array, list), logits, attention and state of the step
+        '''
+        keys, values, mask = memory
+        layer_output = np.concatenate([inputs, attention], -1)
+        next_state = []
+        for params, layer_state in zip(self.decoder_layers, state):
+            layer_output, layer_state = self._cell_step(params, self._input_part(params, layer_output), layer_state)
+            next_state.append(layer_state)
+
+        # Scores of the beams of a sentence against its memory, [batch, beam_width, time]
+        query = layer_output.reshape(len(keys), beam_width, -1)
+        scores = np.where(mask[:, None, :], np.matmul(query, keys.transpose(0, 2, 1)), -np.inf)
+        alignments = np.exp(scores - scores.max(-1, keepdims=True))
+        alignments /= alignments.sum(-1, keepdims=True)
+        context = np.matmul(alignments, values).reshape(len(layer_output), -1)
+        attention = np.matmul(np.concatenate([layer_output, context], -1), self.attention_kernel)
+
+        logits = attention
+        for kernel in self.output_kernels:
+            logits = np.matmul(logits, kernel)
+        return logits, attention, next_state
+
+
+    def _greedy_decode(self, memory, encoder_state, maximum_iterations, deadline):
+        '''
+        Greedy decoding, see greedy_decode of Seq2seq._build_graph
+        @memory: tuple, keys, values and mask of Luong attention
+        @encoder_state: list, final state of each encoder layer
+        @maximum_iterations: int, max decoding steps
+        @deadline: float, time to stop decoding in seconds since epoch
+        @return: np.array, [batch, decoded time] answer ids, 0 after <EOS>
+        '''
+        batch_size = len(memory[0])
+        eos_id = self.decoder_vocab_to_int['<EOS>']
+        inputs = self.decoder_embedding[np.full(batch_size, self.decoder_vocab_to_int['<GO>'])]
+        attention = np.zeros((batch_size, self.attention_kernel.shape[1]), dtype=np.float32)
+        state = encoder_state
+        finished = np.zeros(batch_size, dtype=bool)
+
+        sample_ids = []
+        for _ in range(maximum_iterations):
+            logits, attention, state = self._decode_step(inputs, attention, state, memory, 1)
+            step_ids = logits.argmax(-1)
+            sample_ids.append(np.where(finished, 0, step_ids))
+            finished |= step_ids == eos_id
+            if finished.all() or time.time() > deadline:
+                break
+            inputs = self.decoder_embedding[step_ids]
+
+        if not sample_ids:
+            return np.zeros((batch_size, 0), dtype=np.int32)
+        return np.stack(sample_ids, 1).astype(np.int32)
+
+
+    def _beam_search_decode(self, memory, encoder_state, beam_width, maximum_iterations, deadline, length_penalty_weight=0.0):
+        '''
+        Beam search as tf.contrib.seq2seq.BeamSearchDecoder, with the early stop of DeadlineBeamSearchDecoder
+        @memory: tuple, keys, values and mask of Luong attention
+        @encoder_state: list, final state of each encoder layer
+        @beam_width: int, the beam width
+        @maximum_iterations: int, max decoding steps
+        @deadline: float, time to stop decoding in seconds since epoch
+        @length_penalty_weight: float, weight of the length penalty of scores, 0.0 as the graph
+        @return: np.array, [batch, decoded time] answer ids of the best beams
+        '''
+        batch_size = len(memory[0])
+        vocab_size = self.output_kernels[-1].shape[1]
+        eos_id = self.decoder_vocab_to_int['<EOS>']
+        rows = np.arange(batch_size)[:, None]
+
+        # Finished beams can only be extended by <EOS>, which keeps their scores
+        finished_row = np.full(vocab_size, np.finfo(np.float32).min, dtype=np.float32)
+        finished_row[eos_id] = 0.0
+
+        # Only the first beam of each sentence is alive at start
+        log_probs = np.full((batch_size, beam_width), -np.inf, dtype=np.float32)
+        log_probs[:, 0] = 0.0
+        finished = np.ones((batch_size, beam_width), dtype=bool)
+        finished[:, 0] = False
+        lengths = np.zeros((batch_size, beam_width), dtype=np.int64)
+
+        inputs = self.decoder_embedding[np.full(batch_size * beam_width, self.decoder_vocab_to_int['<GO>'])]
+        attention = np.zeros((batch_size * beam_width, self.attention_kernel.shape[1]), dtype=np.float32)
+        state = [tuple(np.repeat(part, beam_width, axis=0) for part in layer_state) for layer_state in encoder_state]
+
+        predicted_ids = []
+        parent_ids = []
+        for _ in range(maximum_iterations):
+            logits, attention, state = self._decode_step(inputs, attention, state, memory, beam_width)
+            logits = logits.reshape(batch_size, beam_width, vocab_size)
+            step_log_probs = logits - logits.max(-1, keepdims=True)
+            step_log_probs -= np.log(np.exp(step_log_probs).sum(-1, keepdims=True))
+            step_log_probs = np.where(finished[:, :, None], finished_row, step_log_probs)
+            total_log_probs = (log_probs[:, :, None] + step_log_probs).reshape(batch_size, -1)
+            scores = total_log_probs
+            if length_penalty_weight:
+                # Lengths of scores grow for alive beams, except by <EOS>, as BeamSearchDecoder
+                score_lengths = lengths[:, :, None] + (~finished[:, :, None] & (np.arange(vocab_size) != eos_id))
+                scores = total_log_probs / (((5.0 + score_lengths) / 6.0) ** length_penalty_weight).reshape(batch_size, -1)
+
+            # Top beam_width of each sentence in descending order, ties go to the lower index as tf.nn.top_k
+            top = np.argpartition(-scores, beam_width - 1, axis=1)[:, :beam_width]
+            top = np.take_along_axis(top, np.lexsort((top, -scores[rows, top])), axis=1)
+            log_probs = total_log_probs[rows, top]
+            word_ids = top % vocab_size
+            beam_ids = top // vocab_size
+
+            previously_finished = finished[rows, beam_ids]
+            finished = previously_finished | (word_ids == eos_id)
+            # Kept lengths count the <EOS> step too, as lengths in the state of BeamSearchDecoder, which only bound gather_tree
+            lengths = lengths[rows, beam_ids] + ~previously_finished
+            parents = (rows * beam_width + beam_ids).reshape(-1)
+            state = [tuple(part[parents] for part in layer_state) for layer_state in state]
+            attention = attention[parents]
+            predicted_ids.append(word_ids)
+            parent_ids.append(beam_ids)
+
+            # A sentence is done once its best finished beam scores no less than every alive beam, only valid without length penalty
+            best_finished = np.where(finished, log_probs, -np.inf).max(1)
+            best_alive = np.where(finished, -np.inf, log_probs).max(1)
+            if np.all(finished) or (not length_penalty_weight and np.all(best_finished >= best_alive)) or time.time() > deadline:
+                break
+            inputs = self.decoder_embedding[word_ids.reshape(-1)]
+
+        if not predicted_ids:
+            return np.zeros((batch_size, 0), dtype=np.int32)
+        return self._gather_tree(np.stack(predicted_ids), np.stack(parent_ids), lengths.max(1), eos_id)
+
+
+    @staticmethod
+    def _gather_tree(predicted_ids, parent_ids, max_lens, eos_id):
+        '''
+        Trace the first beam of each sentence back through its parents, as tf.contrib.seq2seq.gather_tree
+        @predicted_ids: np.array, [time, batch, beam_width] token of each beam at each step
+        @parent_ids: np.array, [time, batch, beam_width] beam each beam is extended from
+        @max_lens: np.array, [batch] longest beam of each sentence, the trace starts from there
+        @eos_id: int, id of <EOS>, filled after the trace
+        @return: np.array, [batch, time] ids of the first beams
+        '''
+        n_steps, batch_size = predicted_ids.shape[:2]
+        max_lens = np.minimum(max_lens, n_steps)
+        ids = np.full((batch_size, n_steps), eos_id, dtype=np.int32)
+        beams = np.zeros(batch_size, dtype=np.int64)
+        for t in reversed(range(n_steps)):
+            tracing = np.nonzero(t < max_lens)[0]
+            ids[tracing, t] = predicted_ids[t, tracing, beams[tracing]]
+            beams[tracing] = parent_ids[t, tracing, beams[tracing]]
+        ids[np.cumsum(ids == eos_id, axis=1) > 0] = eos_id
+        return ids
+
+
+    @staticmethod
+    def _sigmoid(x):
+        # Same as 1 / (1 + exp(-x)), without overflow
+        return 0.5 * np.tanh(0.5 * x) + 0.5
+
+
+    @staticmethod
+    def _latest_checkpoint(path):
+        '''
+        Prefix of the latest checkpoint, read from the checkpoint state file as tf.train.latest_checkpoint
+        @path: str, the path of existed model
+        @return: str, the prefix
+        '''
+        with open(os.path.join(path, 'checkpoint')) as fp:
+            match = re.search(r'^model_checkpoint_path: "(.*)"$', fp.read(), re.M)
+        if match is None:
+            raise ValueError('There is no checkpoint in {}, your model has not finished training'.format(path))
+        # Relative paths are relative to the model directory
+        return os.path.join(path, match.group(1))
+
+
+    @staticmethod
+    def _read_checkpoint(prefix):
+        '''
+        Read variables of a checkpoint without tensorflow, optimizer slots are skipped.
+        {prefix}.index is a sorted string table of leveldb format, from variable names to BundleEntryProto,
+        each entry tells the shard, offset, size, dtype and shape of a tensor in the {prefix}.data-* files.
+        @prefix: str, the checkpoint prefix
+        @return: dict, np.array of each variable by name
+        '''
+        with open(prefix + '.index', 'rb') as fp:
+            table = fp.read()
+        if table[-8:] != NumpySeq2seq.TABLE_MAGIC:
+            raise ValueError('{}.index is not a checkpoint index'.format(prefix))
+
+        # Footer of 48 bytes starts with handles of the metaindex block and the index block
+        _, pos = NumpySeq2seq._varint(table, len(table) - 48)
+        _, pos = NumpySeq2seq._varint(table, pos)
+        index_offset, pos = NumpySeq2seq._varint(table, pos)
+        index_size, _ = NumpySeq2seq._varint(table, pos)
+
+        entries = {}
+        for _, handle in NumpySeq2seq._read_block(table, index_offset, index_size):
+            offset, pos = NumpySeq2seq._varint(handle, 0)
+            size, _ = NumpySeq2seq._varint(handle, pos)
+            entries.update(NumpySeq2seq._read_block(table, offset, size))
+
+        # The header is stored under the empty key
+        n_shards = NumpySeq2seq._parse_proto(entries.pop(b'', b'')).get(1, [1])[0]
+        shards = {}
+        weights = {}
+        try:
+            for key, value in entries.items():
+                name = key.decode('utf-8')
+                entry = NumpySeq2seq._parse_proto(value)
+                dtype = NumpySeq2seq.CHECKPOINT_DTYPES.get(entry.get(1, [0])[0])
+                if dtype is None or re.search(r'/Adam(_\d+)?$|^beta\d_power$', name):
+                    continue
+                if 7 in entry:
+                    raise ValueError('Partitioned variable {} is not supported'.format(name))
+
+                shape = [NumpySeq2seq._parse_proto(dim).get(1, [0])[0] for dim in NumpySeq2seq._parse_proto(entry.get(2, [b''])[0]).get(2, [])]
+                shard_id = entry.get(3, [0])[0]
+                if shard_id not in shards:
+                    shards[shard_id] = open('{}.data-{:05d}-of-{:05d}'.format(prefix, shard_id, n_shards), 'rb')
+                shards[shard_id].seek(entry.get(4, [0])[0])
+                weights[name] = np.frombuffer(shards[shard_id].read(entry.get(5, [0])[0]), dtype=dtype).reshape(shape)
+        finally:
+            for fp in shards.values():
+                fp.close()
+        return weights
+
+
+    @staticmethod
+    def _read_block(table, offset, size):
+        '''
+        Key value pairs of a block of sorted string table, keys share prefixes with their previous keys
+        @table: bytes, the table file
+        @offset: int, offset of the block
+        @size: int, size of the block without its trailer
+        @return: list, (bytes, bytes) pairs
+        '''
+        if table[offset + size] != 0:
+            raise ValueError('Compressed checkpoint index is not supported')
+        block = table[offset: offset + size]
+        n_restarts = int.from_bytes(block[-4:], 'little')
+        end = len(block) - 4 * (n_restarts + 1)
+
+        pairs = []
+        key = b''
+        pos = 0
+        while pos < end:
+            shared, pos = NumpySeq2seq._varint(block, pos)
+            non_shared, pos = NumpySeq2seq._varint(block, pos)
+            value_size, pos = NumpySeq2seq._varint(block, pos)
+            key = key[:shared] + block[pos: pos + non_shared]
+            pos += non_shared
+            pairs.append((key, block[pos: pos + value_size]))
+            pos += value_size
+        return pairs
+
+
+    @staticmethod
+    def _parse_proto(data):
+        '''
+        Decode a protocol buffer message without its schema
+        @data: bytes, the encoded message
+        @return: dict, list of values of each field number, ints for varints and bytes for the others
+        '''
+        fields = {}
+        pos = 0
+        while pos < len(data):
+            key, pos = NumpySeq2seq._varint(data, pos)
+            wire_type = key & 7
+            if wire_type == 0:
+                value, pos = NumpySeq2seq._varint(data, pos)
+            elif wire_type == 2:
+                size, pos = NumpySeq2seq._varint(data, pos)
+                value = data[pos: pos + size]
+                pos += size
+            elif wire_type in (1, 5):
+                size = 8 if wire_type == 1 else 4
+                value = data[pos: pos + size]
+                pos += size
+            else:
+                raise ValueError('Unsupported wire type {}'.format(wire_type))
+            fields.setdefault(key >> 3, []).append(value)
+        return fields
+
+
+    @staticmethod
+    def _varint(data, pos):
+        '''
+        @data: bytes
+        @pos: int, where the varint starts
+        @return: (int, int), the value and where it ends
+        '''
+        value = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value, pos
+            shift += 7
+
+
+class Tracer:
+    def __init__(self, steps, trace_dir):
+        '''
+        Trace chosen steps with full timeline.
+        For every traced step a chrome trace (open it at chrome://tracing) and a table of time aggregated per op are written.
+        @steps: str, steps to trace, e.g. '1000-1005' or '10,20,30-32', empty to disable
+        @trace_dir: str, directory to save traces
+        '''
+        self.steps = set()
+        for part in (steps or '').replace(' ', '').split(','):
+            if not part:
+                continue
+            start, _, end = part.partition('-')
+            self.steps.update(range(int(start), int(end or start) + 1))
+        self.trace_dir = trace_dir
+
+
+    def run_kwargs(self, step):
+        '''
+        Arguments for session.run, empty if this step should not be traced
+        @step: int, the step to run
+        @return: dict, options and run_metadata for session.run
+        '''
+        if step not in self.steps:
+            return {}
+        return {
+                'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': tf.RunMetadata()
+                }
+
+
+    def dump(self, step, run_kwargs, tag):
+        '''
+        Write the trace of a step run with run_kwargs
+        @step: int, the traced step
+        @run_kwargs: dict, returned by run_kwargs
+        @tag: str, prefix of file names, e.g. train or predict
+        @return: None
+        '''
+        if not run_kwargs:
+            return
+        from tensorflow.python.client import timeline
+
+        if not os.path.isdir(self.trace_dir):
+            os.makedirs(self.trace_dir)
+
+        step_stats = run_kwargs['run_metadata'].step_stats
+        file_prefix = os.path.join(self.trace_dir, '{}_step_{}'.format(tag, step))
+        with open(file_prefix + '.json', 'w') as fp:
+            fp.write(timeline.Timeline(step_stats).generate_chrome_trace_format())
+
+        section_times = Counter()
+        op_times = Counter()
+        op_counts = Counter()
+        for dev_stats in step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                op_time = (node_stats.op_end_rel_micros - node_stats.op_start_rel_micros) / 1e3
+                op_type = node_stats.timeline_label.split('(')[0].split('=')[-1].strip() or node_stats.node_name
+                section_times[self._section(node_stats.node_name)] += op_time
+                op_times[op_type] += op_time
+                op_counts[op_type] += 1
+
+        total_time = max(sum(section_times.values()), 1e-9)
+        lines = ['{:<24}{:>12}{:>10}'.format('section', 'time(ms)', 'share')]
+        for section, section_time in section_times.most_common():
+            lines.append('{:<24}{:>12.3f}{:>10.1%}'.format(section, section_time, section_time / total_time))
+        lines.append('')
+        lines.append('{:<32}{:>12}{:>10}{:>10}'.format('op', 'time(ms)', 'share', 'count'))
+        for op_type, op_time in op_times.most_common():
+            lines.append('{:<32}{:>12.3f}{:>10.1%}{:>10}'.format(op_type, op_time, op_time / total_time, op_counts[op_type]))
+
+        with open(file_prefix + '_ops.txt', 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        print('\nTrace of {} step {} is saved at {}.json'.format(tag, step, file_prefix))
+
+
+    def _section(self, node_name):
+        '''
+        Part of the model a node belongs to, judged by its name
+        '''
+        if 'gradients' in node_name:
+            return 'gradients'
+        if 'decoder_output_embedding' in node_name:
+            return 'output_projection'
+        if 'attention' in node_name or 'memory_layer' in node_name:
+            return 'attention'
+        if 'BeamSearch' in node_name or 'beam_search' in node_name:
+            return 'beam_search'
+        for section in ('encoder', 'decoder', 'optimization'):
+            if node_name.startswith(section):
+                return section
+        return 'other'
+
+
+class TrainingMonitor:
+    def __init__(self, phases):
+        '''
+        Measure time of each phase of the training loop and count the tokens processed.
+        Counters are cleared at every report, thus a report covers the steps since the last one.
+        @phases: list, names of the timed phases, time not spent in any of them is reported as 'other'
+        '''
+        self.phases = list(phases)
+        self.reset()
+
+
+    def reset(self):
+        self.start_time = time.time()
+        self.phase_times = {name: 0.0 for name in self.phases}
+        self.n_examples = 0
+        self.n_real_tokens = 0
+        self.n_padded_tokens = 0
+
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Context manager adding the time spent inside to phase {name}
+        '''
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times[name] += time.time() - start_time
+
+
+    def timed_iter(self, name, iterable):
+        '''
+        Wrap an iterable, time spent producing each item is added to phase {name}
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+    def count(self, inputs, targets, input_padding_val=0, target_padding_val=0):
+        '''
+        Count examples, real tokens and padded tokens of a training batch
+        @inputs: np.array, padded encoder batch
+        @targets: np.array, padded decoder batch
+        '''
+        self.n_examples += len(inputs)
+        self.n_real_tokens += np.count_nonzero(inputs != input_padding_val) + np.count_nonzero(targets != target_padding_val)
+        self.n_padded_tokens += np.size(inputs) + np.size(targets)
+
+
+    def report(self):
+        '''
+        Summarize the speed since last report and clear counters
+        @return: dict, examples_per_sec, real_tokens_per_sec, padding_ratio and share/<phase> for each phase and 'other'
+        '''
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        result = {
+                'examples_per_sec': self.n_examples / elapsed,
+                'real_tokens_per_sec': self.n_real_tokens / elapsed,
+                'padding_ratio': 1.0 - self.n_real_tokens / max(self.n_padded_tokens, 1),
+                }
+        for name in self.phases:
+            result['share/' + name] = self.phase_times[name] / elapsed
+        result['share/other'] = max(0.0, 1.0 - sum(self.phase_times.values()) / elapsed)
+        self.reset()
+        return result
+
+
+class CheckpointWriter:
+    def __init__(self, sess, var_list, ckpt_path, keep_last=3, keep_best=True):
+        '''
+        Write checkpoints on a background thread, so that saving does not stall training.
+        Values of variables are copied on the training thread, which only takes a memory copy. A shadow graph on cpu
+        holding variables of the same names writes the copy to disk, the checkpoint state file is updated only after
+        the write succeeded, and older checkpoints are deleted only after that.
+        @sess: tf.Session, the training session
+        @var_list: list, variables to save
+        @ckpt_path: str, prefix of checkpoint files, global step will be appended
+        @keep_last: int, keep the last {this} checkpoints
+        @keep_best: bool, also keep the checkpoint with the lowest validation loss
+        '''
+        self.sess = sess
+        self.var_list = var_list
+        self.ckpt_path = ckpt_path
+        self.ckpt_dir = os.path.dirname(ckpt_path)
+        self.keep_last = max(keep_last, 1)
+        self.keep_best = keep_best
+        self.best_path = os.path.join(self.ckpt_dir, 'best_checkpoint')
+
+        # Recover retention state of a continued training
+        ckpt_state = tf.train.get_checkpoint_state(self.ckpt_dir)
+        self.kept_prefixes = list(ckpt_state.all_model_checkpoint_paths) if ckpt_state else []
+        self.best = None
+        if os.path.isfile(self.best_path):
+            with open(self.best_path, 'rb') as fp:
+                self.best = pkl.load(fp)
+            if self.best[1] in self.kept_prefixes:
+                self.kept_prefixes.remove(self.best[1])
+
+        self.shadow_graph = tf.Graph()
+        with self.shadow_graph.as_default():
+            self.shadow_vars = [tf.Variable(tf.zeros(var.shape, dtype=var.dtype.base_dtype), trainable=False) for var in var_list]
+            self.shadow_saver = tf.train.Saver({var.op.name: shadow_var for var, shadow_var in zip(var_list, self.shadow_vars)}, max_to_keep=None)
+            self.shadow_sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+        self.shadow_inits = [shadow_var.initializer for shadow_var in self.shadow_vars]
+        self.shadow_values = [shadow_var.initializer.inputs[1] for shadow_var in self.shadow_vars]
+
+        # Only one snapshot waits in queue, a newer one replaces it
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def save(self, global_step, running_state, valid_loss=None):
+        '''
+        Take a snapshot of variables and queue it for writing
+        @global_step: int, global step of the snapshot
+        @running_state: object, pickled into running_state file together with the checkpoint
+        @valid_loss: float, validation loss of the snapshot, used to keep the best checkpoint
+        @return: None
+        '''
+        self._raise_error()
+        values = self.sess.run(self.var_list)
+        snapshot = (global_step, values, running_state, valid_loss)
+        try:
+            self.queue.put_nowait(snapshot)
+        except queue.Full:
+            # The writer is still busy with last checkpoint, the snapshot waiting is outdated
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put(snapshot)
+
+
+    def close(self):
+        '''
+        Wait until queued snapshot is written and stop the writer thread
+        @return: None
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        self.shadow_sess.close()
+        self._raise_error()
+
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Failed to write checkpoint: {}'.format(error))
+
+
+    def _run(self):
+        while True:
+            snapshot = self.queue.get()
+            if snapshot is None:
+                break
+            try:
+                self._write(*snapshot)
+            except Exception as e:
+                self.error = e
+
+
+    def _write(self, global_step, values, running_state, valid_loss):
+        '''
+        Write one snapshot, update checkpoint state and apply the retention policy
+        '''
+        self.shadow_sess.run(self.shadow_inits, feed_dict=dict(zip(self.shadow_values, values)))
+        prefix = self.shadow_saver.save(self.shadow_sess, self.ckpt_path, global_step=global_step,
+                write_meta_graph=False, write_state=False)
+
+        outdated = []
+        self.kept_prefixes.append(prefix)
+        if self.keep_best and valid_loss is not None and (self.best is None or valid_loss < self.best[0]):
+            if self.best is not None:
+                outdated.append(self.best[1])
+            self.best = (valid_loss, prefix)
+            self._atomic_dump(self.best, self.best_path)
+        while len(self.kept_prefixes) > self.keep_last:
+            outdated.append(self.kept_prefixes.pop(0))
+
+        all_prefixes = list(self.kept_prefixes)
+        if self.best is not None and self.best[1] not in all_prefixes:
+            all_prefixes.insert(0, self.best[1])
+        # update_checkpoint_state writes state file to a temp file and renames it
+        tf.train.update_checkpoint_state(self.ckpt_dir, prefix, all_model_checkpoint_paths=all_prefixes)
+        self._atomic_dump(running_state, os.path.join(self.ckpt_dir, 'running_state'))
+
+        for outdated_prefix in outdated:
+            if outdated_prefix in all_prefixes:
+                continue
+            for file_path in glob.glob(outdated_prefix + '.index') + glob.glob(outdated_prefix + '.data-*'):
+                os.remove(file_path)
+
+
+    def _atomic_dump(self, obj, file_path):
+        with open(file_path + '.tmp', 'wb') as fp:
+            pkl.dump(obj, fp)
+        os.replace(file_path + '.tmp', file_path)
 
 
 class TextProcessor:
@@ -1170,6 +3830,22 @@ if __name__ == '__main__':
             '--loop', action='store_true', help='Contitue predict answers until pressing ctrl-c')
     parser.add_argument(
             '--input', help='Input one string and get prediction return')
+    parser.add_argument(
+            '--export', help='Export the inference only model of --model to this directory')
+    parser.add_argument(
+            '--quantize', action='store_true', help='Store weights of the exported model as int8 with per-channel scales')
+    parser.add_argument(
+            '--numpy', action='store_true', help='Predict with NumpySeq2seq, no tensorflow session is created')
+    parser.add_argument(
+            '--serve', type=int, help='Serve --model over HTTP/JSON at this port, see serve.py for the endpoints')
+    parser.add_argument(
+            '--host', default='127.0.0.1', help='Address to serve on, default to 127.0.0.1')
+    parser.add_argument(
+            '--workers', type=int, default=1, help='Number of serving processes, each holds a copy of the model, default to 1')
+    parser.add_argument(
+            '--max_wait_ms', type=float, default=5, help='Max milliseconds a served request waits for others to fill a batch of {infer_batch_size}, default to 5')
+    parser.add_argument(
+            '--timeout', type=float, default=10, help='Seconds to wait for the answer of a served request, default to 10')
 
     # Advanced arguments
     parser.add_argument(
@@ -1179,7 +3855,7 @@ if __name__ == '__main__':
     parser.add_argument(
             '--n_rnn_layers', type=int, help='Number of rnn layers of both encoder and decoder, default to 3')
     parser.add_argument(
-            '--beam_width', type=int, help='The width of beam search, default to 3')
+            '--beam_width', type=int, help='The width of beam search, 1 for greedy decoding. When predicting, at most the width of training, default to 3')
     parser.add_argument(
             '--keep_prob', type=float, help='Output(dropout) keep probability for each rnn node, default to 0.8')
     parser.add_argument(
@@ -1187,7 +3863,7 @@ if __name__ == '__main__':
     parser.add_argument(
             '--train_batch_size', type=int, help='Batch size while training, default to 32')
     parser.add_argument(
-            '--infer_batch_size', type=int, help='Batch size while infering, default to 1')
+            '--infer_batch_size', type=int, help='Max number of distinct inputs in a batch of predict_batch, default to 32')
     parser.add_argument(
             '--max_gradient_norm', type=float, help='Clip value for global gradients, default to 5.0')
     parser.add_argument(
@@ -1222,23 +3898,78 @@ if __name__ == '__main__':
             '--summary_every', type=int, help='Save summary info for every {this} steps, only used when DEBUG=1, default to 50')
     parser.add_argument(
             '--save_every', type=int, help='Save the checkpoint for every {this} steps, default to 500')
+    parser.add_argument(
+            '--cell_type', type=str, choices=CELL_TYPES, help='Rnn cell backend of both encoder and decoder, lstm, block(LSTMBlockCell), fused(LSTMBlockFusedCell encoder) or gru, default to lstm')
+    parser.add_argument(
+            '--keep_checkpoints', type=int, help='Keep the last {this} checkpoints, default to 3')
+    parser.add_argument(
+            '--keep_best_checkpoint', type=int, help='Whether also keep the checkpoint with the lowest validation loss. 1=keep, 0=not keep. default to 1')
+    parser.add_argument(
+            '--eval_every', type=int, help='Evaluate loss and bleu on the whole validation set for every {this} steps, 0 to disable, default to 1000')
+    parser.add_argument(
+            '--eval_batch_size', type=int, help='Batch size while evaluating the whole validation set, default to 128')
+    parser.add_argument(
+            '--trace_steps', type=str, help='Steps to trace, e.g. 1000-1005 or 10,20. Chrome traces and op tables are saved in <model dir>/timeline. Counts training steps in training and predictions in prediction, default to none')
+    parser.add_argument(
+            '--intra_op_threads', type=int, help='Threads used within an op such as a matmul, 0 lets tensorflow decide, default to 0')
+    parser.add_argument(
+            '--inter_op_threads', type=int, help='Threads used to run independent ops in parallel, 0 lets tensorflow decide, default to 0')
+    parser.add_argument(
+            '--curriculum_steps', type=int, help='Train on short batches first, the max batch length grows to full over {this} steps, 0 to disable, default to 0')
+    parser.add_argument(
+            '--tie_embeddings', type=int, help='Whether use the decoder embedding as the output projection. 1=tie, 0=not tie. default to 0')
+    parser.add_argument(
+            '--share_vocab', type=int, help='Whether use one vocabulary and one embedding for both encoder and decoder. 1=share, 0=not share. default to 0')
+    parser.add_argument(
+            '--output_rank', type=int, help='Factorize the output projection through a bottleneck of {this} size, 0 to disable, default to 0')
+    parser.add_argument(
+            '--memory_saving', type=str, choices=MEMORY_SAVING_MODES, help='Memory saving mode for long sequences. none, swap(swap rnn activations to host memory), recompute(recompute activations for gradients) or all, default to none')
+    parser.add_argument(
+            '--jit', type=int, help='Whether compile the graph with XLA auto clustering, ignored if XLA is not available. 1=compile, 0=not compile. default to 0')
+    parser.add_argument(
+            '--calibration_steps', type=int, help='Time {this} training steps before training to estimate the epoch time, 0 to disable, default to 10')
+    parser.add_argument(
+            '--max_memory_mb', type=float, help='Reject the model if its weights and Adam slots need more than {this} MB, 0 for no limit, default to 0')
+    parser.add_argument(
+            '--max_epoch_hours', type=float, help='Reject the model if one epoch is estimated to take more than {this} hours, 0 for no limit, default to 0')
+    parser.add_argument(
+            '--cache_size', type=int, help='Number of predictions kept in memory, 0 to disable the cache, default to 1024')
+    parser.add_argument(
+            '--cache_on_disk', type=int, help='Whether keep predictions in sqlite of the model directory too. 1=keep, 0=not keep. default to 0')
+    parser.add_argument(
+            '--max_decode_len', type=int, help='Max length of predictions, 0 for twice the length of the longest input, default to 0')
+    parser.add_argument(
+            '--decode_timeout_ms', type=float, help='Latency budget of a prediction run in milliseconds, 0 for no limit, default to 0')
 
 
     args = parser.parse_args()
 
     model_args = vars(args).copy()
-    _ = [model_args.pop(key) for key in ['enc', 'dec', 'id', 'model', 'loop', 'input']]
+    _ = [model_args.pop(key) for key in ['enc', 'dec', 'id', 'model', 'loop', 'input', 'export', 'quantize', 'numpy', 'serve', 'host', 'workers', 'max_wait_ms', 'timeout']]
     model_args = {k:v for k, v in model_args.items() if v != None}
 
-    model = Seq2seq(**model_args)
+    if args.numpy and (args.enc != None or args.dec != None):
+        raise ValueError('--numpy can only predict, it can not train with --enc and --dec')
+
+    model = NumpySeq2seq(**model_args) if args.numpy else Seq2seq(**model_args)
 
     if args.id != None:
         model.set_id(args.id)
 
-    if args.model != None:
+    if args.serve != None:
+        if args.model == None:
+            raise ValueError('You should specify --model to serve')
+        from serve import serve
+        serve(args.model, args.serve, model_args, host=args.host, n_workers=args.workers,
+                max_wait_ms=args.max_wait_ms, request_timeout=args.timeout)
+
+    elif args.model != None:
         model_path = args.model
         model.load(model_path)
 
+        if args.export != None:
+            model.export(args.export, quantize=args.quantize)
+
         if args.loop:
             while True:
                 input_str = input('> ')
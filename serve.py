@@ -0,0 +1,279 @@
+'''
+Local HTTP/JSON serving of a trained or exported lite-seq2seq model.
+
+The listening socket is opened once, then shared by {n_workers} worker processes. Each worker loads its own copy
+of the model and collects the concurrent requests it accepts into batches with MicroBatcher.
+Counters and latency histograms are kept in shared memory, so /metrics reports all workers together.
+
+Endpoints:
+    POST /predict   {"input": "hello there"} -> {"output": "..."}
+                    {"inputs": ["hello there", "how are you"]} -> {"outputs": ["...", "..."]}
+                    "beam_width", "max_decode_len" and "timeout_ms" are optional, see Seq2seq.predict_batch
+                    answers carry "truncated", true if decoding stopped by timeout_ms or max_decode_len before <EOS>
+    GET  /health    200 once the model is loaded
+    GET  /metrics   counters and latency histogram in prometheus text format
+
+Usage:
+    python liteSeq2Seq.py --model ./models/model_id --serve 8000
+    python liteSeq2Seq.py --model ./exported/model_id --serve 8000 --host 0.0.0.0 --workers 4 --max_wait_ms 10 --timeout 5
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import socket
+import multiprocessing
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer
+from http.server import BaseHTTPRequestHandler
+from concurrent.futures import TimeoutError
+
+# Upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUSES = ('ok', 'bad_request', 'timeout', 'error')
+MAX_BODY_BYTES = 1 << 20
+
+
+class ServingMetrics:
+    def __init__(self, n_workers, context):
+        '''
+        Counters shared by worker processes
+        @n_workers: int, number of workers
+        @context: multiprocessing context the workers are started with
+        '''
+        self.requests = context.Array('l', len(STATUSES))
+        self.latency_buckets = context.Array('l', len(LATENCY_BUCKETS))
+        self.latency_sum = context.Value('d', 0.0)
+        self.sentences = context.Value('l', 0)
+        # Written by each worker for itself
+        self.batches = context.Array('l', n_workers)
+        self.ready = context.Array('b', n_workers)
+
+
+    def observe(self, status, seconds, n_sentences):
+        '''
+        Count a finished request
+        @status: str, one of STATUSES
+        @seconds: float, latency of the request
+        @n_sentences: int, number of sentences predicted
+        @return: None
+        '''
+        with self.requests.get_lock():
+            self.requests[STATUSES.index(status)] += 1
+            for i, bucket in enumerate(LATENCY_BUCKETS):
+                if seconds <= bucket:
+                    self.latency_buckets[i] += 1
+            self.latency_sum.value += seconds
+            self.sentences.value += n_sentences
+
+
+    def render(self):
+        '''
+        @return: str, metrics in prometheus text format
+        '''
+        with self.requests.get_lock():
+            requests = list(self.requests)
+            latency_buckets = list(self.latency_buckets)
+            latency_sum = self.latency_sum.value
+            sentences = self.sentences.value
+
+        lines = ['# TYPE liteseq2seq_requests_total counter']
+        lines += ['liteseq2seq_requests_total{{status="{}"}} {}'.format(status, n) for status, n in zip(STATUSES, requests)]
+        lines.append('# TYPE liteseq2seq_request_seconds histogram')
+        lines += ['liteseq2seq_request_seconds_bucket{{le="{}"}} {}'.format(bucket, n) for bucket, n in zip(LATENCY_BUCKETS, latency_buckets)]
+        lines.append('liteseq2seq_request_seconds_bucket{{le="+Inf"}} {}'.format(sum(requests)))
+        lines.append('liteseq2seq_request_seconds_sum {}'.format(latency_sum))
+        lines.append('liteseq2seq_request_seconds_count {}'.format(sum(requests)))
+        lines.append('# TYPE liteseq2seq_sentences_total counter')
+        lines.append('liteseq2seq_sentences_total {}'.format(sentences))
+        lines.append('# TYPE liteseq2seq_batches_total counter')
+        lines.append('liteseq2seq_batches_total {}'.format(sum(self.batches)))
+        lines.append('# TYPE liteseq2seq_workers_ready gauge')
+        lines.append('liteseq2seq_workers_ready {}'.format(sum(self.ready)))
+        return '\n'.join(lines) + '\n'
+
+
+def decoding_option(request, name, minimum, types=(int,)):
+    '''
+    Read an optional decoding option of a request
+    @request: dict, the parsed request body
+    @name: str, the name of the option
+    @minimum: int, the least valid value
+    @types: tuple, the accepted types, bool is never accepted
+    @return: the option, None if missing
+    '''
+    value = request.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, types) or value != value or value < minimum:
+        raise ValueError('{} should be {} not less than {}, got {!r}'.format(name, 'a number' if float in types else 'an integer', minimum, value))
+    return value
+
+
+class ServingHandler(BaseHTTPRequestHandler):
+    # Seconds to wait for a slow client
+    timeout = 30
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok', 'model': self.server.model_id, 'worker': os.getpid()})
+        elif self.path == '/metrics':
+            self._reply(200, self.server.metrics.render(), 'text/plain; version=0.0.4')
+        else:
+            self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+
+        start = time.time()
+        status, n_sentences = self._predict()
+        self.server.metrics.observe(status, time.time() - start, n_sentences)
+        self.server.metrics.batches[self.server.worker_i] = self.server.batcher.n_batches
+
+
+    def _predict(self):
+        '''
+        Answer a predict request
+        @return: (str, int), status of the request and number of predicted sentences
+        '''
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_BODY_BYTES:
+                raise ValueError('Request body is larger than {} bytes'.format(MAX_BODY_BYTES))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            encode_strs = [request['input']] if 'input' in request else request['inputs']
+            if not isinstance(encode_strs, list) or not encode_strs or not all(isinstance(encode_str, str) for encode_str in encode_strs):
+                raise ValueError('inputs should be a non-empty list of strings')
+            # 0 keeps its meaning of predict_batch: twice the input length, and no limit
+            decoding_options = (decoding_option(request, 'beam_width', 1), decoding_option(request, 'max_decode_len', 0),
+                    decoding_option(request, 'timeout_ms', 0, (int, float)))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._reply(400, {'error': 'Bad request: {}'.format(e)})
+            return 'bad_request', 0
+
+        futures = [self.server.batcher.submit(encode_str, *decoding_options, return_truncated=True) for encode_str in encode_strs]
+        deadline = time.time() + self.server.request_timeout
+        try:
+            predict_strs, truncated = zip(*[future.result(max(deadline - time.time(), 0)) for future in futures])
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            self._reply(504, {'error': 'Prediction is not finished in {} seconds'.format(self.server.request_timeout)})
+            return 'timeout', 0
+        except ValueError as e:
+            # e.g. beam_width wider than trained
+            self._reply(400, {'error': 'Bad request: {}'.format(e)})
+            return 'bad_request', 0
+        except Exception as e:
+            self._reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return 'error', 0
+
+        if 'input' in request:
+            self._reply(200, {'output': predict_strs[0], 'truncated': truncated[0]})
+        else:
+            self._reply(200, {'outputs': predict_strs, 'truncated': truncated})
+        return 'ok', len(predict_strs)
+
+
+    def _reply(self, code, body, content_type='application/json'):
+        '''
+        Send a response, dict bodies are sent as JSON
+        '''
+        data = (json.dumps(body) if isinstance(body, dict) else body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format, *args):
+        # Requests are counted in /metrics instead of logged one by one
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def run_worker(sock, worker_i, model_path, model_kwargs, max_wait_ms, request_timeout, metrics):
+    '''
+    Load the model and serve on the shared socket until the process is terminated
+    @sock: socket.socket, the listening socket
+    @worker_i: int, index of the worker
+    @model_path: str, path of the trained or exported model
+    @model_kwargs: dict, hyperparameters given to Seq2seq
+    @max_wait_ms: float, batch window of MicroBatcher
+    @request_timeout: float, seconds to wait for the answers of a request
+    @metrics: ServingMetrics, counters shared by workers
+    @return: None
+    '''
+    from liteSeq2Seq import Seq2seq
+    from liteSeq2Seq import MicroBatcher
+
+    model = Seq2seq(**model_kwargs)
+    model.load(model_path)
+
+    server = ThreadingServer(sock.getsockname()[:2], ServingHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.model_id = model.get_id()
+    server.worker_i = worker_i
+    server.batcher = MicroBatcher(model, max_wait_ms=max_wait_ms)
+    server.request_timeout = request_timeout
+    server.metrics = metrics
+
+    metrics.ready[worker_i] = 1
+    print('Worker {} (pid {}) is ready'.format(worker_i, os.getpid()), flush=True)
+    server.serve_forever()
+
+
+def serve(model_path, port, model_kwargs=None, host='127.0.0.1', n_workers=1, max_wait_ms=5, request_timeout=10):
+    '''
+    Serve the model over HTTP until interrupted
+    @model_path: str, path of the trained or exported model
+    @port: int, port to listen on
+    @model_kwargs: dict, hyperparameters given to Seq2seq, e.g. infer_batch_size or intra_op_threads
+    @host: str, address to listen on
+    @n_workers: int, number of worker processes, each holds a copy of the model
+    @max_wait_ms: float, max milliseconds a request waits for others to fill a batch
+    @request_timeout: float, seconds to wait for the answers of a request, 504 is returned after that
+    @return: None
+    '''
+    if not os.path.isdir(model_path):
+        raise ValueError('{} is not valid path'.format(model_path))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+
+    # Tensorflow is not fork safe, workers are spawned
+    context = multiprocessing.get_context('spawn')
+    metrics = ServingMetrics(n_workers, context)
+    workers = [
+            context.Process(target=run_worker, args=(sock, i, model_path, model_kwargs or {}, max_wait_ms, request_timeout, metrics))
+            for i in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    print('Serve {} at http://{}:{} with {} workers'.format(model_path, host, port, n_workers), flush=True)
+
+    try:
+        while all(worker.is_alive() for worker in workers):
+            time.sleep(1)
+        print('A worker exited unexpectedly, stop serving')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        sock.close()
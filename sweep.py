@@ -0,0 +1,297 @@
+'''
+Hyperparameter sweep of lite-seq2seq.
+
+Trials of a grid or random search over the hyperparameters of Seq2seq run in parallel.
+Each trial runs in its own process, pinned to a disjoint set of cpu cores, with intra op threads
+set to the number of its cores. The text files are processed and the dictionary is parsed only once,
+then shared by all trials. A trial is stopped early if its evaluation loss falls behind the best loss
+of all trials at the same global step. At the end, a ranked summary is written to sweep_summary.json.
+
+Usage:
+    python sweep.py --enc data/en --dec data/vi --grid rnn_layer_size=256,512 n_rnn_layers=1,2 --cores_per_trial 4
+    python sweep.py --enc data/en --dec data/vi --random 8 --grid learning_rate=log:1e-4:3e-3 keep_prob=0.6:0.9 --set max_global_step=20000
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import itertools
+import multiprocessing
+import _pickle as pkl
+
+import numpy as np
+
+from liteSeq2Seq import Seq2seq
+from liteSeq2Seq import TextProcessor
+
+# Hyperparameters which change the dictionary, it is not shared if they are searched
+DICTIONARY_FIELDS = ('vocab_remain_rate', 'share_vocab')
+
+
+def parse_value(field, value):
+    '''
+    Convert a string to the type of the default value of hyperparameter {field}
+    @field: str, name of hyperparameter
+    @value: str, the value
+    @return: the converted value
+    '''
+    if field not in Seq2seq.hyparams._fields:
+        raise ValueError('Unknown hyperparameter {}'.format(field))
+    default = getattr(Seq2seq.hyparams, field)
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes')
+    if isinstance(default, int):
+        return int(float(value))
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def parse_space(specs):
+    '''
+    Parse search space like ['rnn_layer_size=256,512', 'learning_rate=log:1e-4:1e-2', 'keep_prob=0.5:0.9']
+    @specs: list, each item is {field}={values}, values are comma seperated choices, or a range lo:hi, log:lo:hi sampled in log scale
+    @return: dict, field to a list of choices or a tuple (scale, lo, hi)
+    '''
+    space = {}
+    for spec in specs:
+        field, values = spec.split('=', 1)
+        parts = values.split(':')
+        if len(parts) == 3 and parts[0] == 'log':
+            space[field] = ('log', parse_value(field, parts[1]), parse_value(field, parts[2]))
+        elif len(parts) == 2:
+            space[field] = ('linear', parse_value(field, parts[0]), parse_value(field, parts[1]))
+        else:
+            space[field] = [parse_value(field, value) for value in values.split(',')]
+    return space
+
+
+def make_trials(space, n_random=0, seed=0):
+    '''
+    Hyperparameters of each trial
+    @space: dict, returned by parse_space
+    @n_random: int, number of random trials, 0 for the full grid, which only accepts choices
+    @seed: int, random seed of the random search
+    @return: list, each item is a dict of searched hyperparameters of one trial
+    '''
+    fields = sorted(space)
+    if not n_random:
+        if any(isinstance(space[field], tuple) for field in fields):
+            raise ValueError('Grid search only accepts choices, use --random for ranges')
+        return [dict(zip(fields, values)) for values in itertools.product(*[space[field] for field in fields])]
+
+    rng = np.random.RandomState(seed)
+    trials = []
+    for _ in range(n_random):
+        trial = {}
+        for field in fields:
+            if isinstance(space[field], list):
+                trial[field] = space[field][rng.randint(len(space[field]))]
+            else:
+                scale, lo, hi = space[field]
+                value = np.exp(rng.uniform(np.log(lo), np.log(hi))) if scale == 'log' else rng.uniform(lo, hi)
+                trial[field] = type(lo)(round(value) if isinstance(lo, int) else value)
+        trials.append(trial)
+    return trials
+
+
+def run_trial(sweep_dir, trial_id, hparams, cores, encode_file_paths, decode_file_paths, dictionary_path):
+    '''
+    Train one trial, the target of trial processes
+    @sweep_dir: str, directory of the sweep, models of trials are saved in it
+    @trial_id: str, id of the model of this trial
+    @hparams: dict, hyperparameters of this trial
+    @cores: list, cpu cores this trial is pinned to
+    @encode_file_paths: list, paths of the encoder files
+    @decode_file_paths: list, paths of the decoder files
+    @dictionary_path: str, path of the shared dictionary, None to parse one for this trial
+    @return: None
+    '''
+    os.sched_setaffinity(0, cores)
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    Seq2seq.set_model_dir(sweep_dir)
+    model = Seq2seq(intra_op_threads=len(cores), inter_op_threads=min(2, len(cores)), **hparams)
+    model.set_id(trial_id)
+    os.mkdir(model.model_ckpt_dir)
+
+    # Output of trials would be interleaved, each trial writes its own log
+    log_fd = os.open(os.path.join(model.model_ckpt_dir, 'train_log'), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(log_fd, sys.stdout.fileno())
+    os.dup2(log_fd, sys.stderr.fileno())
+
+    if dictionary_path is not None:
+        shutil.copy(dictionary_path, os.path.join(model.model_ckpt_dir, 'dictionary'))
+
+    model._train(encode_file_paths, decode_file_paths)
+
+
+def read_eval_log(trial_dir):
+    '''
+    Evaluation records of a trial, written by Seq2seq._train every {eval_every} steps
+    @return: list, each item is a dict with global_step, loss and bleu
+    '''
+    path = os.path.join(trial_dir, 'eval_log')
+    if not os.path.isfile(path):
+        return []
+    records = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            # The last line may be partly written
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def behind_best(records, all_records, margin, min_step):
+    '''
+    Whether the latest evaluation of a trial falls behind the best loss of all trials at the same step
+    @records: list, evaluation records of the trial
+    @all_records: list, evaluation records of all trials
+    @margin: float, a trial is behind if its loss > best loss * (1 + margin)
+    @min_step: int, trials are never stopped before this global step
+    @return: bool
+    '''
+    if not records or records[-1]['global_step'] < min_step:
+        return False
+    step = records[-1]['global_step']
+    best_loss = min(record['loss'] for record in all_records if record['global_step'] == step)
+    return records[-1]['loss'] > best_loss * (1 + margin)
+
+
+def summarize(sweep_dir, trials, status, wall_times):
+    '''
+    Rank trials by their best evaluation loss and write sweep_summary.json
+    @return: list, the ranked summary
+    '''
+    summary = []
+    for trial_id, hparams in trials:
+        records = read_eval_log(os.path.join(sweep_dir, trial_id))
+        best = min(records, key=lambda record: record['loss']) if records else None
+        summary.append({
+            'trial': trial_id,
+            'model_dir': os.path.join(sweep_dir, trial_id),
+            'hparams': hparams,
+            'status': status.get(trial_id, 'not started'),
+            'best_loss': best['loss'] if best else None,
+            'best_bleu': best['bleu'] if best else None,
+            'best_step': best['global_step'] if best else None,
+            'last_step': records[-1]['global_step'] if records else None,
+            'wall_time': wall_times.get(trial_id),
+            })
+    summary.sort(key=lambda item: (item['best_loss'] is None, item['best_loss']))
+
+    with open(os.path.join(sweep_dir, 'sweep_summary.json'), 'w') as fp:
+        json.dump(summary, fp, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter sweep of lite-seq2seq')
+    parser.add_argument('--enc', nargs='+', required=True, help='Encoder files for training')
+    parser.add_argument('--dec', nargs='+', required=True, help='Decoder files for training')
+    parser.add_argument('--grid', nargs='+', required=True, help='Search space, e.g. rnn_layer_size=256,512 learning_rate=log:1e-4:1e-2 keep_prob=0.5:0.9')
+    parser.add_argument('--set', nargs='*', default=[], help='Fixed hyperparameters of all trials, e.g. max_global_step=20000')
+    parser.add_argument('--random', type=int, default=0, help='Number of random trials, 0 for the full grid, default to 0')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the random search, default to 0')
+    parser.add_argument('--cores_per_trial', type=int, default=4, help='Cpu cores of each trial, default to 4')
+    parser.add_argument('--parallel', type=int, help='Max number of trials running at once, default to as many as the cores allow')
+    parser.add_argument('--stop_margin', type=float, default=0.1, help='Stop a trial whose evaluation loss > best loss at the same step * (1 + {this}), default to 0.1')
+    parser.add_argument('--min_step', type=int, default=2000, help='Never stop a trial before this global step, default to 2000')
+    parser.add_argument('--poll_every', type=float, default=10, help='Check trials every {this} seconds, default to 10')
+    parser.add_argument('--sweep_dir', default='./sweeps/' + time.strftime('%Y%m%d_%H%M%S'), help='Directory of the models of trials, default to ./sweeps/<time>')
+    args = parser.parse_args()
+
+    space = parse_space(args.grid)
+    fixed = dict(spec.split('=', 1) for spec in args.set)
+    fixed = {field: parse_value(field, value) for field, value in fixed.items()}
+    if not fixed.get('eval_every', Seq2seq.hyparams.eval_every):
+        raise ValueError('eval_every should not be 0, trials are compared by the evaluation loss')
+    trials = [('trial_{}'.format(i), dict(fixed, **hparams)) for i, hparams in enumerate(make_trials(space, args.random, args.seed))]
+
+    cores = sorted(os.sched_getaffinity(0))
+    core_groups = [cores[i: i+args.cores_per_trial] for i in range(0, len(cores) - args.cores_per_trial + 1, args.cores_per_trial)]
+    if not core_groups:
+        core_groups = [cores]
+    core_groups = core_groups[:args.parallel or len(core_groups)]
+    print('{} trials, {} at once on cores {}'.format(len(trials), len(core_groups), core_groups))
+
+    os.makedirs(args.sweep_dir)
+
+    # Process text files once, as the CLI does
+    tp = TextProcessor()
+    for filepath in args.enc + args.dec:
+        if not os.path.isfile('origin_'+filepath):
+            tp.read(filepath).process(inplace=True)
+
+    # Parse the dictionary once for all trials
+    dictionary_path = None
+    if not any(field in space for field in DICTIONARY_FIELDS):
+        Seq2seq.set_model_dir(args.sweep_dir)
+        model = Seq2seq(**fixed)
+        if model.hyparams.share_vocab:
+            model.encoder_int_to_vocab, model.encoder_vocab_to_int = model._parse_dict(args.enc + args.dec)
+            model.decoder_int_to_vocab, model.decoder_vocab_to_int = model.encoder_int_to_vocab, model.encoder_vocab_to_int
+        else:
+            model.encoder_int_to_vocab, model.encoder_vocab_to_int = model._parse_dict(args.enc)
+            model.decoder_int_to_vocab, model.decoder_vocab_to_int = model._parse_dict(args.dec)
+        dictionary_path = os.path.join(args.sweep_dir, 'dictionary')
+        with open(dictionary_path, 'wb') as fp:
+            pkl.dump((model.encoder_int_to_vocab, model.encoder_vocab_to_int, model.decoder_int_to_vocab, model.decoder_vocab_to_int), fp)
+
+    # Tensorflow is not safe to fork, trials are spawned
+    context = multiprocessing.get_context('spawn')
+    pending = list(trials)
+    running = {}
+    free_groups = list(core_groups)
+    status = {}
+    start_times = {}
+    wall_times = {}
+
+    while pending or running:
+        while pending and free_groups:
+            trial_id, hparams = pending.pop(0)
+            group = free_groups.pop(0)
+            process = context.Process(target=run_trial, args=(
+                args.sweep_dir, trial_id, hparams, group, args.enc, args.dec, dictionary_path))
+            process.start()
+            running[trial_id] = (process, group)
+            status[trial_id] = 'running'
+            start_times[trial_id] = time.time()
+            print('Start {} on cores {}: {}'.format(trial_id, group, hparams))
+
+        time.sleep(args.poll_every)
+
+        all_records = {trial_id: read_eval_log(os.path.join(args.sweep_dir, trial_id)) for trial_id, _ in trials}
+        flat_records = list(itertools.chain(*all_records.values()))
+        for trial_id, (process, group) in list(running.items()):
+            if not process.is_alive():
+                status[trial_id] = 'finished' if process.exitcode == 0 else 'failed'
+            elif behind_best(all_records[trial_id], flat_records, args.stop_margin, args.min_step):
+                process.terminate()
+                process.join()
+                status[trial_id] = 'stopped'
+            else:
+                continue
+            wall_times[trial_id] = time.time() - start_times[trial_id]
+            del running[trial_id]
+            free_groups.append(group)
+            records = all_records[trial_id]
+            print('{} {} at step {}, loss {}'.format(trial_id, status[trial_id],
+                records[-1]['global_step'] if records else None, records[-1]['loss'] if records else None))
+
+    summary = summarize(args.sweep_dir, trials, status, wall_times)
+    print('rank\ttrial\tstatus\tbest loss\tbest bleu\tbest step\thparams')
+    for rank, item in enumerate(summary, 1):
+        print('{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(rank, item['trial'], item['status'], item['best_loss'], item['best_bleu'], item['best_step'],
+            {field: item['hparams'][field] for field in space}))
+    print('Summary is saved at {}'.format(os.path.join(args.sweep_dir, 'sweep_summary.json')))